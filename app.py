@@ -1,13 +1,31 @@
 import sqlite3
 import os
 import requests
+import threading
+import atexit
 import time
-from flask import Flask, request, jsonify, session, redirect, send_from_directory, send_file
-from datetime import datetime
+import random
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+from bisect import bisect_left
+from flask import Flask, request, jsonify, session, redirect, send_from_directory, send_file, Response, stream_with_context, g, has_app_context
+from datetime import datetime, timedelta, timezone
 import hashlib
 import secrets
 import json
-from typing import Dict, List, Any
+import zlib
+import queue
+import base64
+import binascii
+import html
+import re
+import unicodedata
+from typing import Dict, List, Any, Optional
+from dataclasses import dataclass, field
+from collections import deque, OrderedDict
+from functools import lru_cache
+from contextlib import contextmanager
 
 # محاولة استيراد المكتبات الاختيارية
 try:
@@ -57,62 +75,217 @@ print(f"  - Claude API: {'✅' if CLAUDE_API_KEY else '❌'} ({len(CLAUDE_API_KE
 print(f"  - OpenRouter: {'✅' if OPENROUTER_API_KEY else '❌'} ({len(OPENROUTER_API_KEY) if OPENROUTER_API_KEY else 0} chars)")
 print(f"  - Serper Search: {'✅' if SERPER_API_KEY else '❌'}")
 
+# عناوين المزودين الأساسية - قابلة للتغيير لتوجيه الطلبات إلى خادم محلي (mock_providers.py)
+GOOGLE_API_BASE = os.getenv("GOOGLE_API_BASE", "https://generativelanguage.googleapis.com").rstrip("/")
+OPENAI_API_BASE = os.getenv("OPENAI_API_BASE", "https://api.openai.com").rstrip("/")
+ANTHROPIC_API_BASE = os.getenv("ANTHROPIC_API_BASE", "https://api.anthropic.com").rstrip("/")
+OPENROUTER_API_BASE = os.getenv("OPENROUTER_API_BASE", "https://openrouter.ai/api").rstrip("/")
+SERPER_API_BASE = os.getenv("SERPER_API_BASE", "https://google.serper.dev").rstrip("/")
+
 # استخدام قاعدة بيانات في الذاكرة لـ Vercel
 DB_PATH = "/tmp/clainai.db" if 'VERCEL' in os.environ else "clainai.db"
 
+# =============================================================================
+# مطابقة الكلمات المفتاحية - مطابق واحد يُبنى مرة واحدة عند التشغيل
+# =============================================================================
+
+AGENT_INTENTS = {
+    "track_price": ["تابع", "تتبع", "راقب", "شوف", "اسعار", "سعر"],
+    "schedule_reminder": ["ذكرني", "تذكير", "موعد", "غداً", "بكرا"],
+    "research_topic": ["ابحث", "اعرف", "معلومات", "دراسة", "بحث"],
+    "automate_task": ["اتمتع", "شغل", "افعل", "نفذ", "اعمل"]
+}
+INSTRUCTION_KEYWORDS = ["افعل", "نفذ", "اعمل", "اتمتع"]
+DEVELOPER_KEYWORDS = ['مطور', 'مبرمج', 'صاحب', 'خالق', 'من صنع', 'who made you', 'developer', 'creator']
+
+# الردود الجاهزة عند فشل جميع النماذج - ترتيب المفاتيح هو أولوية المطابقة
+FALLBACK_RESPONSES = {
+    "من هو مطورك": "🤖 **معلومات المطور:**\n\n✅ تم تطويري بواسطة **المهندس السوداني محمد عبد القادر السراج**\n🎓 **المؤهلات:**\n• خريج جامعة العلوم وتقانة المعلومات (IT)\n• خريج تكنولوجيا المعلومات والاتصالات (ICT)\n📧 **البريد الإلكتروني:** mohammedu3615@gmail.com\n\nأعمل دائماً على تطوير وتحسين أدائي لخدمة المستخدمين العرب بأفضل صورة! 💪",
+
+    "ماهو الذكاء الاصطناعي": "الذكاء الاصطناعي (Artificial Intelligence) هو مجال من مجالات علوم الكمبيوتر يهتم بتطوير أنظمة قادرة على أداء مهام تتطلب ذكاءً بشرياً مثل:\n\n• 🤖 **التعلم** (Learning): قدرة النظام على تحسين أدائه من خلال التجربة\n• 💭 **التفكير** (Reasoning): القدرة على استنتاج النتائج المنطقية\n• 🔍 **حل المشكلات** (Problem Solving): إيجاد حلول للتحديات المعقدة\n\nيشمل الذكاء الاصطناعي مجالات فرعية مثل التعلم الآلي، الشبكات العصبية، الرؤية الحاسوبية، ومعالجة اللغة الطبيعية.",
+
+    "ما هي المجالات": "مجالات الذكاء الاصطناعي تشمل:\n\n🎯 **المجالات الرئيسية:**\n• التعلم الآلي (Machine Learning)\n• الشبكات العصبية (Neural Networks)\n• معالجة اللغة الطبيعية (NLP)\n• الرؤية الحاسوبية (Computer Vision)\n• الروبوتات (Robotics)\n\n💼 **التطبيقات العملية:**\n• المساعدات الذكية (مثل ClainAI)\n• السيارات ذاتية القيادة\n• التشخيص الطبي\n• التوصيات الذكية\n• الترجمة الآلية",
+
+    "عرف الحوسبة السحابية": "الحوسبة السحابية (Cloud Computing) هي نموذج لتقديم خدمات حاسوبية عبر الإنترنت تشمل:\n\n☁️ **الخدمات الأساسية:**\n• **الخوادم** (Servers): قوة معالجة مرنة\n• **التخزين** (Storage): مساحة تخزين غير محدودة\n• **قواعد البيانات** (Databases): أنواع متعددة من قواعد البيانات\n\n🎯 **نماذج الخدمة:**\n• **IaaS** (البنية التحتية كخدمة)\n• **PaaS** (المنصة كخدمة)  \n• **SaaS** (البرمجيات كخدمة)\n\n💫 **المزايا:**\n• توفير التكاليف\n• المرونة والتوسع\n• الأمان المتقدم\n• الابتكار السريع",
+
+    "ما اسمك": "🤖 **أنا ClainAI - المساعد الذكي العربي المتطور!**\n\n✨ **ما أقدمه لك:**\n• محادثات ذكية متقدمة\n• تحليل الملفات (PDF, Word, الصور)\n• بحث ذكي على الإنترنت\n• إجابات إبداعية ومفيدة\n• دعم متعدد النماذج الذكية\n• نظام وكيل ذكي للمهام التلقائية\n\n🚀 **تم تطويري بواسطة المهندس محمد عبد القادر السراج** لخدمة المستخدمين العرب بكل احترافية وإبداع!",
+
+    "اشهر مزودين الكلاود منو": "🌐 **أشهر مزودي خدمات الحوسبة السحابية:**\n\n🏆 **المزودون العالميون:**\n• **Amazon Web Services (AWS)** - الرائد عالمياً\n• **Microsoft Azure** - حلول متكاملة\n• **Google Cloud Platform (GCP)** - تقنيات متقدمة\n\n🚀 **مزودون آخرون:**\n• **IBM Cloud** - حلول المؤسسات\n• **Oracle Cloud** - قواعد البيانات\n• **Alibaba Cloud** - الرائد في آسيا\n\n💡 **نصائح للاختيار:**\n• AWS للمشاريع الكبيرة\n• Azure للبيئة Microsoft\n• GCP للذكاء الاصطناعي",
+
+    "اخبار اليوم": "📰 **أخبار اليوم - النسخة الذكية**\n\n🔍 *جاري جمع أحدث الأخبار...*\n\n📊 **أهم الفئات:**\n• 📈 أخبار التكنولوجيا والذكاء الاصطناعي\n• 💼 الأخبار الاقتصادية والأسواق\n• 🌍 الأخبار العالمية\n• 🏆 الأخبار الرياضية\n\n⚡ *لتحميل أحدث الأخبار، تأكد من تفعيل مفتاح Serper API في إعدادات التطبيق*",
+
+    "ما هي أخبار اليوم": "📰 **أخبار اليوم - النسخة الذكية**\n\n🔍 *جاري جمع أحدث الأخبار...*\n\n📊 **أهم الفئات:**\n• 📈 أخبار التكنولوجيا والذكاء الاصطناعي\n• 💼 الأخبار الاقتصادية والأسواق\n• 🌍 الأخبار العالمية\n• 🏆 الأخبار الرياضية\n\n⚡ *لتحميل أحدث الأخبار، تأكد من تفعيل مفتاح Serper API في إعدادات التطبيق*"
+
+}
+
+# التشكيل والتطويل تُحذف، وأشكال الألف والياء والتاء المربوطة تُوحد
+ARABIC_FOLDS = tuple(
+    [(chr(code), "") for code in range(0x064B, 0x0660)]
+    + [("\u0670", ""), ("\u0640", "")]  # ألف خنجرية وتطويل
+    + [("أ", "ا"), ("إ", "ا"), ("آ", "ا"), ("ٱ", "ا"), ("ى", "ي"), ("ة", "ه")]
+)
+
+def normalize_arabic(text: str) -> str:
+    """توحيد النص العربي للمطابقة: أحرف صغيرة، بدون تشكيل، وأشكال موحدة للحروف"""
+    text = text.lower()
+    # str.translate بجدول غير ASCII بطيء؛ replace المشروط أسرع بكثير للنصوص الطويلة
+    for source, target in ARABIC_FOLDS:
+        if source in text:
+            text = text.replace(source, target)
+    return text
+
+class KeywordMatcher:
+    """مطابقة كل الكلمات المفتاحية للرسالة في استدعاء واحد.
+
+    الكلمات تُطبّع وتُزال المكررة منها مرة واحدة عند البناء، والرسالة تُطبّع مرة
+    واحدة لكل مطابقة. البحث نفسه يتم بعملية `in` لأنها تُنفذ في C وهي أسرع في
+    CPython من آلة Aho-Corasick مكتوبة بـ Python عند هذا العدد من الكلمات
+    (انظر bench_keywords.py).
+    """
+
+    def __init__(self):
+        self._labels: Dict[str, List[tuple]] = {}  # كلمة مطبعة -> [(priority, kind, name)]
+        self._priority = 0
+        self._keywords: tuple = ()
+
+    def add(self, kind: str, name: str, keywords: List[str]):
+        for keyword in keywords:
+            normalized = normalize_arabic(keyword)
+            if normalized:
+                self._labels.setdefault(normalized, []).append((self._priority, kind, name))
+                self._priority += 1
+
+    def build(self) -> "KeywordMatcher":
+        self._keywords = tuple(self._labels)
+        return self
+
+    def match(self, text: str) -> Dict[str, List[str]]:
+        """التصنيفات المطابقة: {kind: [names بترتيب الأولوية]}"""
+        normalized = normalize_arabic(text)
+        found = [label for keyword in self._keywords if keyword in normalized for label in self._labels[keyword]]
+
+        matches: Dict[str, List[str]] = {}
+        for _, kind, name in sorted(found):
+            names = matches.setdefault(kind, [])
+            if name not in names:
+                names.append(name)
+        return matches
+
+def build_keyword_matcher() -> KeywordMatcher:
+    matcher = KeywordMatcher()
+    for intent, keywords in AGENT_INTENTS.items():
+        matcher.add("intent", intent, keywords)
+    matcher.add("instruction", "instruction", INSTRUCTION_KEYWORDS)
+    matcher.add("developer", "developer", DEVELOPER_KEYWORDS)
+    for key in FALLBACK_RESPONSES:
+        matcher.add("fallback", key, [key])
+    return matcher.build()
+
+KEYWORD_MATCHER = build_keyword_matcher()
+
+@lru_cache(maxsize=1024)
+def _match_keywords_cached(message: str) -> Dict[str, List[str]]:
+    return KEYWORD_MATCHER.match(message)
+
+def match_keywords(message: str) -> Dict[str, List[str]]:
+    """نتيجة المطابقة لرسالة - تُحسب مرة واحدة لكل رسالة وتُشارك بين المسارات"""
+    if len(message) > 4096:
+        # الرسائل الطويلة جداً لا تُحفظ في الذاكرة المؤقتة
+        return KEYWORD_MATCHER.match(message)
+    return {kind: list(names) for kind, names in _match_keywords_cached(message).items()}
+
 # =============================================================================
 # 🔧 نظام الوكيل الذكي (AI Agent) - محسن
 # =============================================================================
 
 class AgentMemory:
-    """نظام الذاكرة للوكيل الذكي"""
+    """
+    نظام الذاكرة للوكيل الذكي.
+    كل تفضيلات المستخدم تُحمّل باستعلام واحد عند أول قراءة وتُخدم من agent_memory_cache؛
+    الكتابة في معاملة واحدة ثم تحديث الذاكرة تحت قفل المستخدم.
+    """
 
     def __init__(self, user_id: str):
         self.user_id = user_id
-        self.conn = get_db_connection()
 
-    def save_preference(self, key: str, value: str) -> bool:
-        """حفظ تفضيلات المستخدم"""
+    def _lock(self) -> threading.Lock:
+        # القفل نفسه لكل كائنات المستخدم: التحميل لا يكتب خريطة أقدم من كتابة متزامنة
+        return agent_memory_locks[zlib.crc32(self.user_id.encode("utf-8")) % len(agent_memory_locks)]
+
+    def _preferences(self) -> Dict[str, str]:
+        preferences = agent_memory_cache.get(self.user_id)
+        if preferences is not None:
+            return preferences
+
+        with self._lock():
+            preferences = agent_memory_cache.get(self.user_id)
+            if preferences is None:
+                with user_db_connection(self.user_id) as conn:
+                    rows = conn.execute(
+                        'SELECT key, value FROM agent_memory WHERE user_id = ?', (self.user_id,)
+                    ).fetchall()
+                preferences = {row['key']: row['value'] for row in rows}
+                agent_memory_cache.set(self.user_id, preferences)
+        return preferences
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        """جلب عدة تفضيلات دفعة واحدة - المفاتيح غير الموجودة لا تظهر في النتيجة"""
         try:
-            memory_id = hashlib.md5(f"{self.user_id}_{key}".encode()).hexdigest()
-            self.conn.execute(
-                'INSERT OR REPLACE INTO agent_memory (id, user_id, key, value) VALUES (?, ?, ?, ?)',
-                (memory_id, self.user_id, key, value)
-            )
-            self.conn.commit()
-            return True
+            preferences = self._preferences()
+            return {key: preferences[key] for key in keys if key in preferences}
         except Exception as e:
-            print(f"❌ خطأ في حفظ الذاكرة: {e}")
-            return False
+            print(f"❌ خطأ في جلب الذاكرة: {e}")
+            return {}
+
+    def set_many(self, preferences: Dict[str, str]) -> bool:
+        """حفظ عدة تفضيلات في معاملة واحدة"""
+        if not preferences:
+            return True
+        with self._lock():
+            try:
+                with user_db_connection(self.user_id) as conn:
+                    conn.executemany(
+                        'INSERT INTO agent_memory (id, user_id, key, value) VALUES (?, ?, ?, ?) '
+                        'ON CONFLICT(user_id, key) DO UPDATE SET value = excluded.value, updated_at = CURRENT_TIMESTAMP',
+                        [(new_id(), self.user_id, key, value) for key, value in preferences.items()]
+                    )
+                    conn.commit()
+            except Exception as e:
+                # حالة الذاكرة غير مؤكدة - تُعاد قراءتها من القاعدة
+                agent_memory_cache.delete(self.user_id)
+                print(f"❌ خطأ في حفظ الذاكرة: {e}")
+                return False
+
+            # نسخة جديدة بدلاً من التعديل في المكان: القراء الحاليون يرون خريطة متسقة
+            cached = agent_memory_cache.get(self.user_id)
+            if cached is not None:
+                agent_memory_cache.set(self.user_id, {**cached, **preferences})
+        return True
+
+    def save_preference(self, key: str, value: str) -> bool:
+        """حفظ تفضيلات المستخدم"""
+        return self.set_many({key: value})
 
     def get_preference(self, key: str) -> str:
         """جلب تفضيلات المستخدم"""
-        try:
-            result = self.conn.execute(
-                'SELECT value FROM agent_memory WHERE user_id = ? AND key = ?',
-                (self.user_id, key)
-            ).fetchone()
-            return result['value'] if result else ""
-        except Exception as e:
-            print(f"❌ خطأ في جلب الذاكرة: {e}")
-            return ""
+        return self.get_many([key]).get(key, "")
 
 class TaskManager:
     """مدير المهام للوكيل الذكي"""
 
     def __init__(self, user_id: str):
         self.user_id = user_id
-        self.conn = get_db_connection()
 
     def create_task(self, task_type: str, description: str, data: Dict = None) -> str:
         """إنشاء مهمة جديدة"""
         try:
-            task_id = hashlib.md5(f"{self.user_id}_{task_type}_{datetime.now().timestamp()}".encode()).hexdigest()
-            self.conn.execute(
-                'INSERT INTO agent_tasks (id, user_id, task_type, description, data, status) VALUES (?, ?, ?, ?, ?, ?)',
-                (task_id, self.user_id, task_type, description, json.dumps(data or {}), "pending")
-            )
-            self.conn.commit()
+            task_id = new_id()
+            with user_db_connection(self.user_id) as conn:
+                conn.execute(
+                    'INSERT INTO agent_tasks (id, user_id, task_type, description, data, status) VALUES (?, ?, ?, ?, ?, ?)',
+                    (task_id, self.user_id, task_type, description, json.dumps(data or {}), "pending")
+                )
+                conn.commit()
             return task_id
         except Exception as e:
             print(f"❌ خطأ في إنشاء المهمة: {e}")
@@ -121,10 +294,11 @@ class TaskManager:
     def get_pending_tasks(self) -> List[Dict]:
         """جلب المهام المعلقة"""
         try:
-            tasks = self.conn.execute(
-                'SELECT id, task_type, description, data, created_at FROM agent_tasks WHERE user_id = ? AND status = ?',
-                (self.user_id, "pending")
-            ).fetchall()
+            with user_db_connection(self.user_id) as conn:
+                tasks = conn.execute(
+                    'SELECT id, task_type, description, data, created_at FROM agent_tasks WHERE user_id = ? AND status = ?',
+                    (self.user_id, "pending")
+                ).fetchall()
             return [dict(task) for task in tasks]
         except Exception as e:
             print(f"❌ خطأ في جلب المهام: {e}")
@@ -133,11 +307,12 @@ class TaskManager:
     def complete_task(self, task_id: str, result: str = "") -> bool:
         """إكمال المهمة"""
         try:
-            self.conn.execute(
-                'UPDATE agent_tasks SET status = ?, completed_at = ?, result = ? WHERE id = ?',
-                ("completed", datetime.now().isoformat(), result, task_id)
-            )
-            self.conn.commit()
+            with user_db_connection(self.user_id) as conn:
+                conn.execute(
+                    'UPDATE agent_tasks SET status = ?, completed_at = ?, result = ? WHERE id = ?',
+                    ("completed", db_timestamp(), result, task_id)
+                )
+                conn.commit()
             return True
         except Exception as e:
             print(f"❌ خطأ في إكمال المهمة: {e}")
@@ -153,24 +328,13 @@ class SmartAgent:
 
     def analyze_intent(self, message: str) -> Dict[str, Any]:
         """تحليل نية المستخدم"""
-        intents = {
-            "track_price": ["تابع", "تتبع", "راقب", "شوف", "اسعار", "سعر"],
-            "schedule_reminder": ["ذكرني", "تذكير", "موعد", "غداً", "بكرا"],
-            "research_topic": ["ابحث", "اعرف", "معلومات", "دراسة", "بحث"],
-            "automate_task": ["اتمتع", "شغل", "افعل", "نفذ", "اعمل"]
-        }
-
-        message_lower = message.lower()
-        detected_intents = []
-
-        for intent, keywords in intents.items():
-            if any(keyword in message_lower for keyword in keywords):
-                detected_intents.append(intent)
+        matches = match_keywords(message)
+        detected_intents = matches.get("intent", [])
 
         return {
             "intents": detected_intents,
             "needs_agent": len(detected_intents) > 0,
-            "is_instruction": any(word in message_lower for word in ["افعل", "نفذ", "اعمل", "اتمتع"])
+            "is_instruction": "instruction" in matches
         }
 
     def create_tracking_task(self, topic: str, condition: str = "") -> str:
@@ -178,7 +342,7 @@ class SmartAgent:
         return self.tasks.create_task(
             "price_tracking",
             f"متابعة {topic}",
-            {"topic": topic, "condition": condition, "last_checked": datetime.now().isoformat()}
+            {"topic": topic, "condition": condition, "last_checked": db_timestamp()}
         )
 
     def create_research_task(self, topic: str, depth: str = "basic") -> str:
@@ -214,14 +378,16 @@ class AgentAutomation:
     def send_notification(user_id: str, title: str, message: str) -> bool:
         """إرسال إشعار للمستخدم"""
         try:
-            conn = get_db_connection()
-            notification_id = hashlib.md5(f"notif_{user_id}_{datetime.now().timestamp()}".encode()).hexdigest()
-            conn.execute(
+            notification_id = new_id()
+            created_at = db_timestamp()
+            user_db_writer(user_id).enqueue(
                 'INSERT INTO agent_notifications (id, user_id, title, message, created_at) VALUES (?, ?, ?, ?, ?)',
-                (notification_id, user_id, title, message, datetime.now().isoformat())
+                (notification_id, user_id, title, message, created_at)
             )
-            conn.commit()
-            conn.close()
+            notification_hub.publish(user_id, "notification", {
+                'id': notification_id, 'title': title, 'message': message,
+                'created_at': created_at, 'is_read': False
+            })
             return True
         except Exception as e:
             print(f"❌ خطأ في إرسال الإشعار: {e}")
@@ -267,27 +433,32 @@ app.config.update(
 AI_MODELS = {
     "google": {
         "name": "Google Gemini Pro",
-        "endpoint": "https://generativelanguage.googleapis.com/v1/models/gemini-pro:generateContent",
+        "endpoint": f"{GOOGLE_API_BASE}/v1/models/gemini-pro:generateContent",
         "key": GOOGLE_API_KEY,
-        "enabled": bool(GOOGLE_API_KEY and len(GOOGLE_API_KEY) > 10)
+        "enabled": bool(GOOGLE_API_KEY and len(GOOGLE_API_KEY) > 10),
+        # التكلفة التقريبية بالدولار لكل 1000 توكن (لسياسة التوجيه cheapest)
+        "cost": float(os.getenv("GOOGLE_COST", "0.0005"))
     },
     "openai": {
         "name": "OpenAI GPT-4",
-        "endpoint": "https://api.openai.com/v1/chat/completions",
+        "endpoint": f"{OPENAI_API_BASE}/v1/chat/completions",
         "key": OPENAI_API_KEY,
-        "enabled": bool(OPENAI_API_KEY and len(OPENAI_API_KEY) > 10)
+        "enabled": bool(OPENAI_API_KEY and len(OPENAI_API_KEY) > 10),
+        "cost": float(os.getenv("OPENAI_COST", "0.0015"))
     },
     "claude": {
         "name": "Claude 3 Sonnet",
-        "endpoint": "https://api.anthropic.com/v1/messages",
+        "endpoint": f"{ANTHROPIC_API_BASE}/v1/messages",
         "key": CLAUDE_API_KEY,
-        "enabled": bool(CLAUDE_API_KEY and len(CLAUDE_API_KEY) > 10)
+        "enabled": bool(CLAUDE_API_KEY and len(CLAUDE_API_KEY) > 10),
+        "cost": float(os.getenv("CLAUDE_COST", "0.015"))
     },
     "llama": {
         "name": "Llama 3 70B",
-        "endpoint": "https://openrouter.ai/api/v1/chat/completions",
+        "endpoint": f"{OPENROUTER_API_BASE}/v1/chat/completions",
         "key": OPENROUTER_API_KEY,
-        "enabled": bool(OPENROUTER_API_KEY and len(OPENROUTER_API_KEY) > 10)
+        "enabled": bool(OPENROUTER_API_KEY and len(OPENROUTER_API_KEY) > 10),
+        "cost": float(os.getenv("LLAMA_COST", "0.0008"))
     }
 }
 
@@ -296,6 +467,291 @@ for model, config in AI_MODELS.items():
     status = "✅ مفعل" if config["enabled"] else "❌ معطل"
     print(f"  - {config['name']}: {status}")
 
+# =============================================================================
+# طبقة النقل - جلسات HTTP مجمعة (Keep-Alive) لكل مزود
+# =============================================================================
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+HTTP_POOL_CONNECTIONS = _env_int("HTTP_POOL_CONNECTIONS", 4)
+HTTP_POOL_MAXSIZE = _env_int("HTTP_POOL_MAXSIZE", 32)
+HTTP_CONNECT_TIMEOUT = _env_float("HTTP_CONNECT_TIMEOUT", 5)
+HTTP_KEEP_ALIVE = os.getenv("HTTP_KEEP_ALIVE", "true").lower() not in ("0", "false", "no")
+
+# مهلة القراءة الافتراضية لكل وجهة (بالثواني)، قابلة للتغيير عبر <NAME>_READ_TIMEOUT
+_DEFAULT_READ_TIMEOUTS = {
+    "google": 30,
+    "openai": 30,
+    "claude": 30,
+    "llama": 30,
+    "serper": 15,
+    "oauth": 15
+}
+
+PROVIDER_TRANSPORT = {
+    name: {
+        "pool_size": _env_int(f"{name.upper()}_POOL_SIZE", HTTP_POOL_MAXSIZE),
+        "connect_timeout": _env_float(f"{name.upper()}_CONNECT_TIMEOUT", HTTP_CONNECT_TIMEOUT),
+        "read_timeout": _env_float(f"{name.upper()}_READ_TIMEOUT", read_timeout)
+    }
+    for name, read_timeout in _DEFAULT_READ_TIMEOUTS.items()
+}
+
+_http_sessions: Dict[str, requests.Session] = {}
+_http_sessions_lock = threading.Lock()
+
+def get_http_session(provider: str) -> requests.Session:
+    """جلسة HTTP مشتركة لكل مزود تعيد استخدام اتصالات TCP/TLS"""
+    http_session = _http_sessions.get(provider)
+    if http_session is not None:
+        return http_session
+
+    with _http_sessions_lock:
+        http_session = _http_sessions.get(provider)
+        if http_session is None:
+            config = PROVIDER_TRANSPORT.get(provider, {})
+            adapter = HTTPAdapter(
+                pool_connections=HTTP_POOL_CONNECTIONS,
+                pool_maxsize=config.get("pool_size", HTTP_POOL_MAXSIZE),
+                max_retries=0
+            )
+            http_session = requests.Session()
+            http_session.mount("https://", adapter)
+            http_session.mount("http://", adapter)
+            if not HTTP_KEEP_ALIVE:
+                http_session.headers["Connection"] = "close"
+            _http_sessions[provider] = http_session
+        return http_session
+
+def get_provider_timeout(provider: str) -> tuple:
+    """مهلة (الاتصال، القراءة) الخاصة بالمزود"""
+    config = PROVIDER_TRANSPORT.get(provider, {})
+    return (
+        config.get("connect_timeout", HTTP_CONNECT_TIMEOUT),
+        config.get("read_timeout", 30)
+    )
+
+def provider_post(provider: str, url: str, **kwargs) -> requests.Response:
+    """POST عبر الجلسة المجمعة للمزود"""
+    kwargs.setdefault("timeout", get_provider_timeout(provider))
+    return get_http_session(provider).post(url, **kwargs)
+
+def provider_get(provider: str, url: str, **kwargs) -> requests.Response:
+    """GET عبر الجلسة المجمعة للمزود"""
+    kwargs.setdefault("timeout", get_provider_timeout(provider))
+    return get_http_session(provider).get(url, **kwargs)
+
+@atexit.register
+def close_http_sessions():
+    with _http_sessions_lock:
+        for http_session in _http_sessions.values():
+            http_session.close()
+        _http_sessions.clear()
+
+# =============================================================================
+# المقاييس (Prometheus) - عدادات ومدرجات زمنية خفيفة
+# =============================================================================
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() not in ("0", "false", "no")
+
+# حدود المدرج الزمني بالثواني (تغطي استعلامات SQLite حتى ردود النماذج الطويلة)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1.0):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # label_values -> [bucket_counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        if not METRICS_ENABLED:
+            return
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, (bucket_counts, total, count) in self._series.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), bucket_counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    labels = _format_labels(self.labels + ("le",), label_values + (le,))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labels, label_values)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class Gauge:
+    """قيمة تُحسب لحظة القراءة من دالة"""
+
+    TYPE = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: tuple, collect):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.collect = collect  # () -> {label_values: value}
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        for label_values, value in self.collect().items():
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+class CallbackCounter(Gauge):
+    """عداد تراكمي يُقرأ لحظة الجمع من إحصاءات موجودة - يعمل معه rate()"""
+
+    TYPE = "counter"
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                print(f"❌ خطأ في جمع المقياس {metric.name}: {e}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+HTTP_REQUESTS = metrics.register(Counter(
+    "clainai_http_requests_total", "HTTP requests by route, method and status", ("route", "method", "status")))
+HTTP_LATENCY = metrics.register(Histogram(
+    "clainai_http_request_duration_seconds", "HTTP request latency by route", ("route", "method")))
+PROVIDER_REQUESTS = metrics.register(Counter(
+    "clainai_provider_requests_total", "AI provider calls by outcome", ("provider", "outcome")))
+PROVIDER_LATENCY = metrics.register(Histogram(
+    "clainai_provider_latency_seconds", "AI provider call latency including retries", ("provider",)))
+STREAM_TTFT = metrics.register(Histogram(
+    "clainai_stream_time_to_first_token_seconds", "Time to first streamed token", ("provider",)))
+SQLITE_LATENCY = metrics.register(Histogram(
+    "clainai_sqlite_query_duration_seconds", "SQLite statement execution time", ("operation",)))
+SERPER_REQUESTS = metrics.register(Counter(
+    "clainai_serper_requests_total", "Serper API calls by endpoint and status", ("endpoint", "status")))
+SERPER_LATENCY = metrics.register(Histogram(
+    "clainai_serper_request_duration_seconds", "Serper API call latency", ("endpoint",)))
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = getattr(g, "request_started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        method = request.method
+        HTTP_REQUESTS.inc(route, method, str(response.status_code))
+        if response.is_streamed:
+            # الرد المبثوث يُرسل بعد هذه الدالة - الزمن يُسجل عند انتهاء البث أو انقطاع العميل
+            response.call_on_close(lambda: HTTP_LATENCY.observe(time.perf_counter() - started, route, method))
+        else:
+            HTTP_LATENCY.observe(time.perf_counter() - started, route, method)
+    return response
+
+class InstrumentedConnection(sqlite3.Connection):
+    """اتصال SQLite يقيس زمن تنفيذ كل استعلام"""
+
+    def execute(self, sql, *args):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, *args)
+        finally:
+            SQLITE_LATENCY.observe(time.perf_counter() - started, _sql_operation(sql))
+
+    def executemany(self, sql, *args):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, *args)
+        finally:
+            SQLITE_LATENCY.observe(time.perf_counter() - started, _sql_operation(sql))
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            SQLITE_LATENCY.observe(time.perf_counter() - started, "COMMIT")
+
+def _sql_operation(sql: str) -> str:
+    words = sql.split(None, 1)
+    return words[0].upper() if words else "OTHER"
+
+def serper_post(endpoint: str, payload: Dict[str, Any]) -> requests.Response:
+    """طلب Serper عبر الجلسة المجمعة مع قياس الزمن"""
+    started = time.perf_counter()
+    status = "error"
+    try:
+        response = provider_post("serper", f"{SERPER_API_BASE}/{endpoint}", headers={
+            'X-API-KEY': SERPER_API_KEY,
+            'Content-Type': 'application/json'
+        }, json=payload)
+        status = str(response.status_code)
+        return response
+    finally:
+        SERPER_REQUESTS.inc(endpoint, status)
+        SERPER_LATENCY.observe(time.perf_counter() - started, endpoint)
+
 def test_api_connection():
     """اختبار اتصال APIs"""
     print("\n🔧 جاري اختبار اتصال APIs...")
@@ -304,7 +760,7 @@ def test_api_connection():
     if AI_MODELS["llama"]["enabled"]:
         try:
             print("🔄 اختبار اتصال OpenRouter...")
-            url = "https://openrouter.ai/api/v1/chat/completions"
+            url = AI_MODELS["llama"]["endpoint"]
             headers = {
                 "Content-Type": "application/json",
                 "Authorization": f"Bearer {OPENROUTER_API_KEY}",
@@ -316,7 +772,7 @@ def test_api_connection():
                 "messages": [{"role": "user", "content": "Hello, test connection. Reply with 'SUCCESS' only."}],
                 "max_tokens": 10
             }
-            response = requests.post(url, headers=headers, json=payload, timeout=10)
+            response = provider_post("llama", url, headers=headers, json=payload, timeout=10)
             print(f"  OpenRouter: {'✅' if response.status_code == 200 else '❌'} ({response.status_code})")
         except Exception as e:
             print(f"  OpenRouter: ❌ ({str(e)})")
@@ -325,13 +781,13 @@ def test_api_connection():
     if AI_MODELS["google"]["enabled"]:
         try:
             print("🔄 اختبار اتصال Google AI...")
-            url = f"https://generativelanguage.googleapis.com/v1/models/gemini-pro:generateContent?key={GOOGLE_API_KEY}"
+            url = f"{AI_MODELS['google']['endpoint']}?key={GOOGLE_API_KEY}"
             headers = {"Content-Type": "application/json"}
             payload = {
                 "contents": [{"parts": [{"text": "Test connection"}]}],
                 "generationConfig": {"maxOutputTokens": 10}
             }
-            response = requests.post(url, headers=headers, json=payload, timeout=10)
+            response = provider_post("google", url, headers=headers, json=payload, timeout=10)
             print(f"  Google AI: {'✅' if response.status_code == 200 else '❌'} ({response.status_code})")
         except Exception as e:
             print(f"  Google AI: ❌ ({str(e)})")
@@ -339,37 +795,557 @@ def test_api_connection():
 # تشغيل اختبار الاتصال عند البدء
 test_api_connection()
 
-def get_ai_response(message, model_type="google"):
-    """الحصول على رد ذكي من النماذج المتاحة"""
-    try:
-        print(f"🔄 محاولة النموذج: {model_type}")
-
-        if model_type == "google" and AI_MODELS["google"]["enabled"]:
-            return get_google_response(message)
-        elif model_type == "openai" and AI_MODELS["openai"]["enabled"]:
-            return get_openai_response(message)
-        elif model_type == "claude" and AI_MODELS["claude"]["enabled"]:
-            return get_claude_response(message)
-        elif model_type == "llama" and AI_MODELS["llama"]["enabled"]:
-            return get_llama_response(message)
-        else:
-            print(f"❌ النموذج {model_type} غير مفعل")
-            return get_fallback_response(message)
-    except Exception as e:
-        print(f"❌ خطأ في النموذج {model_type}: {str(e)}")
-        return get_fallback_response(message)
+# =============================================================================
+# تحديد المعدل (Token Bucket) لكل مستخدم ولكل مزود
+# =============================================================================
+
+USER_RATE_PER_MINUTE = _env_float("USER_RATE_PER_MINUTE", 30)
+USER_RATE_BURST = _env_float("USER_RATE_BURST", 10)
+# الدفعات تُحسب برسائلها في دلو منفصل: سعته يجب أن تتسع لدفعة كاملة (BATCH_MAX_ITEMS)
+USER_BATCH_RATE_PER_MINUTE = _env_float("USER_BATCH_RATE_PER_MINUTE", 100)
+USER_BATCH_RATE_BURST = _env_float("USER_BATCH_RATE_BURST", 100)
+PROVIDER_RATE_PER_MINUTE = _env_float("PROVIDER_RATE_PER_MINUTE", 120)
+PROVIDER_RATE_BURST = _env_float("PROVIDER_RATE_BURST", 20)
+
+# إعادة المحاولة مع المزودين
+PROVIDER_MAX_RETRIES = _env_int("PROVIDER_MAX_RETRIES", 2)
+PROVIDER_RETRY_BASE_DELAY = _env_float("PROVIDER_RETRY_BASE_DELAY", 0.5)
+PROVIDER_RETRY_MAX_DELAY = _env_float("PROVIDER_RETRY_MAX_DELAY", 8)
+PROVIDER_RETRY_DEADLINE = _env_float("PROVIDER_RETRY_DEADLINE", 45)
+# أقصى انتظار لحد المعدل المحلي أو لـ Retry-After قبل التخلي عن المزود (throttled)
+# حتى ينتقل الموجه إلى المزود التالي بدلاً من حجز خيط الطلب
+PROVIDER_RATE_MAX_WAIT = _env_float("PROVIDER_RATE_MAX_WAIT", 1)
+
+class TokenBucket:
+    """دلو رموز: rate رمز في الثانية بسعة capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = max(rate, 1e-9)
+        self.capacity = max(capacity, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1.0):
+        """إرجاع (True, 0) عند النجاح أو (False, ثوانٍ حتى التوفر)"""
+        now = time.monotonic()
+        with self._lock:
+            if now < self._paused_until:
+                return False, self._paused_until - now
+            self._refill(now)
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True, 0.0
+            return False, (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens: float = 1.0, deadline: float = None) -> bool:
+        """الانتظار حتى توفر الرموز أو حلول الموعد النهائي"""
+        while True:
+            acquired, wait_for = self.try_acquire(tokens)
+            if acquired:
+                return True
+            if deadline is not None and time.monotonic() + wait_for > deadline:
+                return False
+            time.sleep(wait_for)
+
+    def pause(self, seconds: float):
+        """إيقاف الدلو مؤقتاً (مثلاً بعد 429 مع Retry-After)"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+class KeyedRateLimiter:
+    """دلاء رموز لكل مفتاح مع حد أقصى لعدد المفاتيح المحفوظة"""
+
+    def __init__(self, rate_per_minute: float, burst: float, max_keys: int = 10000):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def bucket(self, key: str) -> TokenBucket:
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+                self._buckets[key] = bucket
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return bucket
 
-def get_google_response(message):
-    """نموذج جوجل جيميني"""
+    def try_acquire(self, key: str, tokens: float = 1.0):
+        return self.bucket(key).try_acquire(tokens)
+
+user_rate_limiter = KeyedRateLimiter(USER_RATE_PER_MINUTE, USER_RATE_BURST)
+batch_rate_limiter = KeyedRateLimiter(USER_BATCH_RATE_PER_MINUTE, USER_BATCH_RATE_BURST)
+
+provider_rate_limiters = {
+    model_type: TokenBucket(
+        _env_float(f"{model_type.upper()}_RATE_PER_MINUTE", PROVIDER_RATE_PER_MINUTE) / 60.0,
+        _env_float(f"{model_type.upper()}_RATE_BURST", PROVIDER_RATE_BURST)
+    )
+    for model_type in AI_MODELS
+}
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """تحويل ترويسة Retry-After (ثوانٍ أو تاريخ HTTP) إلى ثوانٍ"""
+    if not value:
+        return None
     try:
-        print(f"🚀 جاري الاتصال بـ Google Gemini...")
-        url = f"https://generativelanguage.googleapis.com/v1/models/gemini-pro:generateContent?key={GOOGLE_API_KEY}"
-        headers = {"Content-Type": "application/json"}
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt: int) -> float:
+    """تأخير أُسّي مع تشويش كامل (full jitter)"""
+    return random.uniform(0, min(PROVIDER_RETRY_MAX_DELAY, PROVIDER_RETRY_BASE_DELAY * (2 ** attempt)))
+
+def rate_limit_response(retry_after: float, status: int = 429,
+                        error: str = 'تم تجاوز الحد المسموح من الطلبات، يرجى المحاولة لاحقاً'):
+    """رد 429 (أو 413 للطلب الأكبر من سعة الحد) مع ترويسة Retry-After"""
+    seconds = max(1, int(retry_after + 0.999))
+    response = jsonify({
+        'success': False,
+        'error': error,
+        'retry_after': seconds
+    })
+    response.status_code = status
+    response.headers['Retry-After'] = str(seconds)
+    return response
 
+def check_user_rate_limit(user_id: str, cost: float = 1.0, limiter: KeyedRateLimiter = None):
+    """إرجاع رد 429 إذا تجاوز المستخدم حده (أو 413 إذا تجاوزت الكلفة سعة الدلو)، وإلا None"""
+    limiter = limiter or user_rate_limiter
+    capacity = limiter.bucket(user_id).capacity
+    if cost > capacity:
+        # لا يمكن أن ينجح أبداً - يُرفض بدلاً من خصم جزء من الكلفة فقط
+        print(f"🚦 طلب المستخدم {user_id} أكبر من سعة حده ({cost} > {capacity})")
+        return rate_limit_response(
+            capacity / limiter.rate, status=413,
+            error=f'الدفعة أكبر من الحد المسموح ({int(capacity)} رسالة)، يرجى تقسيمها'
+        )
+    acquired, retry_after = limiter.try_acquire(user_id, cost)
+    if acquired:
+        return None
+    print(f"🚦 تجاوز المستخدم {user_id} حد الطلبات")
+    return rate_limit_response(retry_after)
+
+# =============================================================================
+# قاطع الدائرة (Circuit Breaker) وتقييم صحة المزودين
+# =============================================================================
+
+CIRCUIT_WINDOW_SECONDS = _env_float("CIRCUIT_WINDOW_SECONDS", 60)
+CIRCUIT_MIN_CALLS = _env_int("CIRCUIT_MIN_CALLS", 5)
+CIRCUIT_ERROR_THRESHOLD = _env_float("CIRCUIT_ERROR_THRESHOLD", 0.5)
+CIRCUIT_TIMEOUT_THRESHOLD = _env_int("CIRCUIT_TIMEOUT_THRESHOLD", 3)
+CIRCUIT_COOLDOWN_SECONDS = _env_float("CIRCUIT_COOLDOWN_SECONDS", 30)
+
+class CircuitBreaker:
+    """قاطع دائرة لكل مزود: closed -> open -> half_open -> closed"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, window: float = CIRCUIT_WINDOW_SECONDS, min_calls: int = CIRCUIT_MIN_CALLS,
+                 error_threshold: float = CIRCUIT_ERROR_THRESHOLD, timeout_threshold: int = CIRCUIT_TIMEOUT_THRESHOLD,
+                 cooldown: float = CIRCUIT_COOLDOWN_SECONDS, probe_timeout: float = 60):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_threshold = error_threshold
+        self.timeout_threshold = timeout_threshold
+        self.cooldown = cooldown
+        self.probe_timeout = probe_timeout
+        self._events = deque()  # (timestamp, success, timed_out)
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._probe_started_at = None
+        self._lock = threading.Lock()
+
+    def _prune(self, now: float):
+        while self._events and now - self._events[0][0] > self.window:
+            self._events.popleft()
+
+    def _current_state(self, now: float) -> str:
+        if self._state == self.OPEN and now - self._opened_at >= self.cooldown:
+            self._state = self.HALF_OPEN
+            self._probe_started_at = None
+        return self._state
+
+    def is_open(self) -> bool:
+        """هل الدائرة مفتوحة (يجب تخطي المزود)"""
+        with self._lock:
+            return self._current_state(time.monotonic()) == self.OPEN
+
+    def allow_request(self) -> bool:
+        """السماح بالطلب؛ في half_open يُسمح بطلب تجريبي واحد فقط"""
+        now = time.monotonic()
+        with self._lock:
+            state = self._current_state(now)
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN:
+                if self._probe_started_at is None or now - self._probe_started_at > self.probe_timeout:
+                    self._probe_started_at = now
+                    return True
+            return False
+
+    def release_probe(self):
+        """إلغاء حجز الطلب التجريبي إذا لم يُرسل (مثلاً لتجاوز حد المعدل المحلي)"""
+        with self._lock:
+            self._probe_started_at = None
+
+    def record_success(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._current_state(now) == self.HALF_OPEN:
+                print(f"🟢 إغلاق دائرة المزود {self.name} بعد نجاح الطلب التجريبي")
+                self._events.clear()
+                self._state = self.CLOSED
+                self._probe_started_at = None
+            self._events.append((now, True, False))
+            self._prune(now)
+
+    def record_failure(self, timed_out: bool = False):
+        now = time.monotonic()
+        with self._lock:
+            self._events.append((now, False, timed_out))
+            self._prune(now)
+            state = self._current_state(now)
+            if state == self.HALF_OPEN:
+                self._trip(now)
+            elif state == self.CLOSED:
+                calls = len(self._events)
+                failures = sum(1 for _, success, _ in self._events if not success)
+                timeouts = sum(1 for _, _, timeout in self._events if timeout)
+                if (calls >= self.min_calls and failures / calls >= self.error_threshold) \
+                        or timeouts >= self.timeout_threshold:
+                    self._trip(now)
+
+    def _trip(self, now: float):
+        print(f"🔴 فتح دائرة المزود {self.name} لمدة {self.cooldown} ثانية")
+        self._state = self.OPEN
+        self._opened_at = now
+        self._probe_started_at = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        """حالة القاطع ودرجة الصحة الحالية"""
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            state = self._current_state(now)
+            calls = len(self._events)
+            failures = sum(1 for _, success, _ in self._events if not success)
+            timeouts = sum(1 for _, _, timeout in self._events if timeout)
+            error_rate = failures / calls if calls else 0.0
+            return {
+                "state": state,
+                "calls": calls,
+                "failures": failures,
+                "timeouts": timeouts,
+                "error_rate": round(error_rate, 3),
+                "health_score": round(0.0 if state == self.OPEN else 1.0 - error_rate, 3),
+                "retry_in": round(max(0.0, self.cooldown - (now - self._opened_at)), 1) if state == self.OPEN else 0
+            }
+
+provider_breakers = {model_type: CircuitBreaker(model_type) for model_type in AI_MODELS}
+
+# =============================================================================
+# التوجيه التكيفي بين النماذج (Adaptive Routing)
+# =============================================================================
+
+# fastest: أقل زمن متوقع للإجابة | cheapest: أقل تكلفة | round_robin: توزيع الحمل | static: ترتيب AI_MODELS
+AI_ROUTING_POLICY = os.getenv("AI_ROUTING_POLICY", "fastest").lower()
+AI_ROUTER_ALPHA = _env_float("AI_ROUTER_ALPHA", 0.3)
+# زمن افتراضي متفائل للمزود الذي لم يُجرَّب بعد حتى يحصل على فرصة
+AI_ROUTER_PRIOR_LATENCY = _env_float("AI_ROUTER_PRIOR_LATENCY", 2.0)
+
+class ProviderRouter:
+    """ترتيب المزودين حسب متوسط متحرك أُسّي (EWMA) للزمن ونسبة النجاح"""
+
+    POLICIES = ("fastest", "cheapest", "round_robin", "static")
+
+    def __init__(self, policy: str = AI_ROUTING_POLICY, alpha: float = AI_ROUTER_ALPHA,
+                 prior_latency: float = AI_ROUTER_PRIOR_LATENCY):
+        self.policy = policy if policy in self.POLICIES else "fastest"
+        self.alpha = alpha
+        self.prior_latency = prior_latency
+        self._stats = {}  # model_type -> {"latency", "success", "calls"}
+        self._rotation = 0
+        self._lock = threading.Lock()
+
+    def observe(self, model_type: str, latency: float, success: bool):
+        with self._lock:
+            stats = self._stats.get(model_type)
+            if stats is None:
+                self._stats[model_type] = {"latency": latency, "success": 1.0 if success else 0.0, "calls": 1}
+                return
+            stats["latency"] += self.alpha * (latency - stats["latency"])
+            stats["success"] += self.alpha * ((1.0 if success else 0.0) - stats["success"])
+            stats["calls"] += 1
+
+    def expected_time(self, model_type: str) -> float:
+        """الزمن المتوقع حتى الحصول على إجابة ناجحة = الزمن / نسبة النجاح"""
+        stats = self._stats.get(model_type)
+        if stats is None:
+            return self.prior_latency
+        return stats["latency"] / max(stats["success"], 0.05)
+
+    def order(self, models: List[str], policy: str = None) -> List[str]:
+        policy = policy or self.policy
+        with self._lock:
+            if policy == "fastest":
+                return sorted(models, key=self.expected_time)
+            if policy == "cheapest":
+                return sorted(models, key=lambda m: (AI_MODELS[m].get("cost", 0), self.expected_time(m)))
+            if policy == "round_robin" and models:
+                start = self._rotation % len(models)
+                self._rotation += 1
+                return models[start:] + models[:start]
+            return list(models)
+
+    def table(self) -> Dict[str, Any]:
+        enabled_models = [model_type for model_type, model in AI_MODELS.items() if model["enabled"]]
+        with self._lock:
+            providers = {}
+            for model_type in AI_MODELS:
+                stats = self._stats.get(model_type, {})
+                providers[model_type] = {
+                    "enabled": AI_MODELS[model_type]["enabled"],
+                    "ewma_latency": round(stats["latency"], 3) if stats else None,
+                    "ewma_success": round(stats["success"], 3) if stats else None,
+                    "calls": stats.get("calls", 0),
+                    "expected_time": round(self.expected_time(model_type), 3),
+                    "cost": AI_MODELS[model_type].get("cost", 0)
+                }
+        return {
+            "policy": self.policy,
+            "alpha": self.alpha,
+            "order": self.order(enabled_models),
+            "providers": providers
+        }
+
+provider_router = ProviderRouter()
+
+def record_provider_outcome(model_type: str, success: bool, timed_out: bool = False, latency: float = None):
+    """تسجيل نتيجة استدعاء المزود في قاطع الدائرة وجدول التوجيه"""
+    breaker = provider_breakers.get(model_type)
+    if breaker is None:
+        return
+    if latency is not None:
+        provider_router.observe(model_type, latency, success)
+    if success:
+        breaker.record_success()
+    else:
+        breaker.record_failure(timed_out)
+
+def get_providers_health() -> Dict[str, Dict[str, Any]]:
+    return {model_type: breaker.snapshot() for model_type, breaker in provider_breakers.items()}
+
+# =============================================================================
+# طبقة المزودين - نتيجة موحدة لكل استدعاء
+# =============================================================================
+
+CLAINAI_SYSTEM_PROMPT = "أنت ClainAI - مساعد ذكي عربي متخصص. قدم إجابات دقيقة ومفيدة ومفصلة باللغة العربية."
+CLAINAI_INLINE_PROMPT = "أنت ClainAI - مساعد ذكي عربي متخصص. أجب على السؤال التالي بطريقة مفيدة ودقيقة ومفصلة باللغة العربية:\n\n{message}"
+
+@dataclass
+class ProviderResult:
+    """نتيجة استدعاء مزود واحد"""
+    provider: str
+    text: str = ""
+    latency: float = 0.0
+    usage: Dict[str, int] = field(default_factory=dict)
+    finish_reason: str = ""
+    # None عند النجاح، وإلا: disabled | circuit_open | throttled | timeout | connection | rate_limited | http_error | bad_response | empty | exception
+    error_kind: Optional[str] = None
+    error: str = ""
+    status_code: Optional[int] = None
+    retry_after: Optional[float] = None
+    attempts: int = 1
+
+    @property
+    def ok(self) -> bool:
+        return self.error_kind is None and bool(self.text)
+
+def classify_exception(e: Exception) -> str:
+    if isinstance(e, requests.Timeout):
+        return "timeout"
+    if isinstance(e, requests.ConnectionError):
+        return "connection"
+    return "exception"
+
+def classify_status(status_code: int) -> str:
+    return "rate_limited" if status_code == 429 else "http_error"
+
+# أخطاء مؤقتة تستحق إعادة المحاولة
+RETRYABLE_ERRORS = ("timeout", "connection", "rate_limited")
+RETRYABLE_STATUS = (500, 502, 503, 504, 529)
+
+class AIProvider:
+    """واجهة موحدة لمزودي النماذج: بناء الطلب، تحليل الرد، والبث"""
+
+    label = ""
+
+    def __init__(self, model_type: str):
+        self.model_type = model_type
+
+    @property
+    def config(self) -> Dict[str, Any]:
+        return AI_MODELS[self.model_type]
+
+    def build_request(self, message: str, stream: bool = False):
+        """إرجاع (url, headers, payload)"""
+        raise NotImplementedError
+
+    def parse_response(self, result: Dict[str, Any]):
+        """إرجاع (text, usage, finish_reason) من رد غير متدفق"""
+        raise NotImplementedError
+
+    def parse_stream_event(self, event: Dict[str, Any]) -> str:
+        """استخراج النص من حدث بث واحد"""
+        raise NotImplementedError
+
+    def complete(self, message: str) -> ProviderResult:
+        """
+        استدعاء المزود وإرجاع نتيجة موحدة دون أي رد احتياطي، مع إعادة المحاولة
+        للأخطاء المؤقتة (احترام Retry-After وتأخير أُسّي مع تشويش) ضمن موعد نهائي كلي.
+        """
+        started = time.monotonic()
+        deadline = started + PROVIDER_RETRY_DEADLINE
+        attempt = 0
+
+        while True:
+            result = self._attempt(message, deadline)
+            retryable = result.error_kind in RETRYABLE_ERRORS or result.status_code in RETRYABLE_STATUS
+            if result.ok or not retryable or attempt >= PROVIDER_MAX_RETRIES:
+                break
+
+            delay = result.retry_after if result.retry_after is not None else backoff_delay(attempt)
+            if result.retry_after is not None and delay > PROVIDER_RATE_MAX_WAIT:
+                print(f"🚦 {self.label} طلب الانتظار {delay:.1f}s، الانتقال لمزود آخر")
+                break
+            if time.monotonic() + delay >= deadline:
+                print(f"⌛ لا وقت لإعادة المحاولة مع {self.label}")
+                break
+
+            attempt += 1
+            print(f"⏳ إعادة المحاولة {attempt} مع {self.label} بعد {delay:.2f}s")
+            time.sleep(delay)
+
+        result.attempts = attempt + 1
+        return self._finish(result, started)
+
+    def _attempt(self, message: str, deadline: float) -> ProviderResult:
+        """محاولة واحدة ضمن حد المعدل الخاص بالمزود"""
+        wait_until = min(deadline, time.monotonic() + PROVIDER_RATE_MAX_WAIT)
+        if not provider_rate_limiters[self.model_type].acquire(deadline=wait_until):
+            print(f"🚦 تجاوز حد المعدل المحلي لـ {self.label}")
+            return ProviderResult(self.model_type, error_kind="throttled")
+
+        try:
+            print(f"🚀 جاري الاتصال بـ {self.label}...")
+            url, headers, payload = self.build_request(message)
+            connect_timeout, read_timeout = get_provider_timeout(self.model_type)
+            remaining = max(0.1, deadline - time.monotonic())
+            response = provider_post(
+                self.model_type, url, headers=headers, json=payload,
+                timeout=(min(connect_timeout, remaining), min(read_timeout, remaining))
+            )
+            print(f"📥 استجابة {self.label}: {response.status_code}")
+
+            if response.status_code != 200:
+                print(f"❌ خطأ {self.label} API: {response.status_code} - {response.text}")
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                if response.status_code == 429 and retry_after:
+                    # إيقاف الطلبات لهذا المزود حتى انتهاء المهلة التي طلبها
+                    provider_rate_limiters[self.model_type].pause(retry_after)
+                return ProviderResult(
+                    self.model_type,
+                    error_kind=classify_status(response.status_code),
+                    error=response.text[:500],
+                    status_code=response.status_code,
+                    retry_after=retry_after
+                )
+
+            try:
+                text, usage, finish_reason = self.parse_response(response.json())
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                print(f"❌ رد غير متوقع من {self.label}: {str(e)}")
+                return ProviderResult(self.model_type, error_kind="bad_response", error=str(e), status_code=200)
+
+            if not text:
+                return ProviderResult(self.model_type, error_kind="empty", status_code=200)
+
+            print(f"✅ نجح {self.label}: {text[:100]}...")
+            return ProviderResult(
+                self.model_type, text=text, usage=usage, finish_reason=finish_reason or "", status_code=200
+            )
+        except Exception as e:
+            print(f"❌ استثناء في {self.label} API: {str(e)}")
+            return ProviderResult(self.model_type, error_kind=classify_exception(e), error=str(e))
+
+    def _finish(self, result: ProviderResult, started: float) -> ProviderResult:
+        result.latency = time.monotonic() - started
+        PROVIDER_REQUESTS.inc(self.model_type, result.error_kind or "ok")
+        PROVIDER_LATENCY.observe(result.latency, self.model_type)
+        if result.error_kind != "throttled":
+            record_provider_outcome(self.model_type, result.ok, result.error_kind == "timeout", result.latency)
+        else:
+            # الحد المحلي ليس عطلاً في المزود، والطلب التجريبي لم يُرسل
+            provider_breakers[self.model_type].release_probe()
+        return result
+
+    def stream(self, message: str):
+        """بث الرد كأجزاء نصية؛ يرفع استثناء عند الفشل"""
+        url, headers, payload = self.build_request(message, stream=True)
+        response = provider_post(self.model_type, url, headers=headers, json=payload, stream=True)
+        try:
+            print(f"📥 بث {self.label}: {response.status_code}")
+            if response.status_code != 200:
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                if response.status_code == 429 and retry_after:
+                    provider_rate_limiters[self.model_type].pause(retry_after)
+                raise RuntimeError(f"{response.status_code} - {response.text[:200]}")
+
+            for data in iter_sse_data(response):
+                if data == "[DONE]":
+                    break
+                text = self.parse_stream_event(json.loads(data))
+                if text:
+                    yield text
+        finally:
+            response.close()
+
+class GeminiProvider(AIProvider):
+    label = "Google Gemini"
+
+    def build_request(self, message: str, stream: bool = False):
+        endpoint = self.config["endpoint"]
+        key = self.config["key"]
+        if stream:
+            url = f"{endpoint.replace(':generateContent', ':streamGenerateContent')}?alt=sse&key={key}"
+        else:
+            url = f"{endpoint}?key={key}"
+        headers = {"Content-Type": "application/json"}
         payload = {
             "contents": [{
                 "parts": [{
-                    "text": f"أنت ClainAI - مساعد ذكي عربي متخصص. أجب على السؤال التالي بطريقة مفيدة ودقيقة ومفصلة باللغة العربية:\n\n{message}"
+                    "text": CLAINAI_INLINE_PROMPT.format(message=message)
                 }]
             }],
             "generationConfig": {
@@ -377,42 +1353,45 @@ def get_google_response(message):
                 "maxOutputTokens": 2048,
             }
         }
+        return url, headers, payload
+
+    def parse_response(self, result: Dict[str, Any]):
+        candidate = result["candidates"][0]
+        metadata = result.get("usageMetadata", {})
+        usage = {
+            "prompt_tokens": metadata.get("promptTokenCount", 0),
+            "completion_tokens": metadata.get("candidatesTokenCount", 0)
+        }
+        return candidate["content"]["parts"][0]["text"], usage, candidate.get("finishReason", "")
 
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
-        print(f"📥 استجابة Google: {response.status_code}")
+    def parse_stream_event(self, event: Dict[str, Any]) -> str:
+        candidates = event.get("candidates") or []
+        if not candidates:
+            return ""
+        parts = candidates[0].get("content", {}).get("parts", [])
+        return "".join(part.get("text", "") for part in parts)
 
-        if response.status_code == 200:
-            result = response.json()
-            if 'candidates' in result and result['candidates']:
-                response_text = result["candidates"][0]["content"]["parts"][0]["text"]
-                print(f"✅ نجح Google Gemini: {response_text[:100]}...")
-                return response_text
-            else:
-                print(f"❌ لا توجد مرشحات في الاستجابة: {result}")
-        else:
-            print(f"❌ خطأ Google API: {response.status_code} - {response.text}")
+class ChatCompletionsProvider(AIProvider):
+    """صيغة chat/completions المشتركة بين OpenAI و OpenRouter"""
 
-        return get_fallback_response(message)
-    except Exception as e:
-        print(f"❌ استثناء في Google API: {str(e)}")
-        return get_fallback_response(message)
+    def __init__(self, model_type: str, label: str, model_name: str, extra_headers: Dict[str, str] = None):
+        super().__init__(model_type)
+        self.label = label
+        self.model_name = model_name
+        self.extra_headers = extra_headers or {}
 
-def get_openai_response(message):
-    """نموذج OpenAI"""
-    try:
-        print(f"🚀 جاري الاتصال بـ OpenAI...")
-        url = "https://api.openai.com/v1/chat/completions"
+    def build_request(self, message: str, stream: bool = False):
         headers = {
             "Content-Type": "application/json",
-            "Authorization": f"Bearer {OPENAI_API_KEY}"
+            "Authorization": f"Bearer {self.config['key']}",
+            **self.extra_headers
         }
-
         payload = {
-            "model": "gpt-3.5-turbo",
+            "model": self.model_name,
             "messages": [
                 {
                     "role": "system",
-                    "content": "أنت ClainAI - مساعد ذكي عربي متخصص. قدم إجابات دقيقة ومفيدة ومفصلة باللغة العربية."
+                    "content": CLAINAI_SYSTEM_PROMPT
                 },
                 {
                     "role": "user",
@@ -422,34 +1401,35 @@ def get_openai_response(message):
             "temperature": 0.7,
             "max_tokens": 2000
         }
+        if stream:
+            payload["stream"] = True
+        return self.config["endpoint"], headers, payload
+
+    def parse_response(self, result: Dict[str, Any]):
+        choice = result["choices"][0]
+        usage = result.get("usage") or {}
+        return choice["message"]["content"], {
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "completion_tokens": usage.get("completion_tokens", 0)
+        }, choice.get("finish_reason") or ""
+
+    def parse_stream_event(self, event: Dict[str, Any]) -> str:
+        if "error" in event:
+            raise RuntimeError(str(event["error"]))
+        choices = event.get("choices") or []
+        if not choices:
+            return ""
+        return choices[0].get("delta", {}).get("content") or ""
 
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
-        print(f"📥 استجابة OpenAI: {response.status_code}")
-
-        if response.status_code == 200:
-            result = response.json()
-            response_text = result["choices"][0]["message"]["content"]
-            print(f"✅ نجح OpenAI: {response_text[:100]}...")
-            return response_text
-        else:
-            print(f"❌ خطأ OpenAI API: {response.status_code} - {response.text}")
-
-        return get_fallback_response(message)
-    except Exception as e:
-        print(f"❌ استثناء في OpenAI API: {str(e)}")
-        return get_fallback_response(message)
+class AnthropicProvider(AIProvider):
+    label = "Claude"
 
-def get_claude_response(message):
-    """نموذج Claude"""
-    try:
-        print(f"🚀 جاري الاتصال بـ Claude...")
-        url = "https://api.anthropic.com/v1/messages"
+    def build_request(self, message: str, stream: bool = False):
         headers = {
             "Content-Type": "application/json",
-            "x-api-key": CLAUDE_API_KEY,
+            "x-api-key": self.config["key"],
             "anthropic-version": "2023-06-01"
         }
-
         payload = {
             "model": "claude-3-sonnet-20240229",
             "max_tokens": 2000,
@@ -457,99 +1437,123 @@ def get_claude_response(message):
             "messages": [
                 {
                     "role": "user",
-                    "content": f"أنت ClainAI - مساعد ذكي عربي متخصص. أجب على السؤال التالي بطريقة مفيدة ودقيقة ومفصلة باللغة العربية:\n\n{message}"
+                    "content": CLAINAI_INLINE_PROMPT.format(message=message)
                 }
             ]
         }
+        if stream:
+            payload["stream"] = True
+        return self.config["endpoint"], headers, payload
+
+    def parse_response(self, result: Dict[str, Any]):
+        usage = result.get("usage") or {}
+        return result["content"][0]["text"], {
+            "prompt_tokens": usage.get("input_tokens", 0),
+            "completion_tokens": usage.get("output_tokens", 0)
+        }, result.get("stop_reason") or ""
+
+    def parse_stream_event(self, event: Dict[str, Any]) -> str:
+        if event.get("type") == "error":
+            raise RuntimeError(event.get("error", {}).get("message", "stream error"))
+        if event.get("type") == "content_block_delta":
+            return event.get("delta", {}).get("text", "")
+        return ""
+
+AI_PROVIDERS = {
+    "google": GeminiProvider("google"),
+    "openai": ChatCompletionsProvider("openai", "OpenAI", "gpt-3.5-turbo"),
+    "claude": AnthropicProvider("claude"),
+    "llama": ChatCompletionsProvider("llama", "OpenRouter (Llama)", "meta-llama/llama-3-70b-instruct", {
+        "HTTP-Referer": f"{BASE_URL}",
+        "X-Title": "ClainAI Chat"
+    })
+}
 
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
-        print(f"📥 استجابة Claude: {response.status_code}")
+def get_ai_response(message, model_type="google") -> ProviderResult:
+    """الحصول على نتيجة موحدة من نموذج واحد"""
+    print(f"🔄 محاولة النموذج: {model_type}")
 
-        if response.status_code == 200:
-            result = response.json()
-            response_text = result["content"][0]["text"]
-            print(f"✅ نجح Claude: {response_text[:100]}...")
-            return response_text
-        else:
-            print(f"❌ خطأ Claude API: {response.status_code} - {response.text}")
+    provider = AI_PROVIDERS.get(model_type)
+    if provider is None or not AI_MODELS[model_type]["enabled"]:
+        print(f"❌ النموذج {model_type} غير مفعل")
+        return ProviderResult(model_type, error_kind="disabled")
 
-        return get_fallback_response(message)
-    except Exception as e:
-        print(f"❌ استثناء في Claude API: {str(e)}")
-        return get_fallback_response(message)
+    breaker = provider_breakers.get(model_type)
+    if breaker and not breaker.allow_request():
+        print(f"⛔ دائرة النموذج {model_type} مفتوحة، تخطي")
+        return ProviderResult(model_type, error_kind="circuit_open")
 
-def get_llama_response(message):
-    """نموذج Llama عبر OpenRouter"""
-    try:
-        print(f"🚀 جاري الاتصال بـ OpenRouter (Llama)...")
-        url = "https://openrouter.ai/api/v1/chat/completions"
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-            "HTTP-Referer": f"{BASE_URL}",
-            "X-Title": "ClainAI Chat"
-        }
+    return provider.complete(message)
 
-        payload = {
-            "model": "meta-llama/llama-3-70b-instruct",
-            "messages": [
-                {
-                    "role": "system",
-                    "content": "أنت ClainAI - مساعد ذكي عربي متخصص. قدم إجابات دقيقة ومفيدة ومفصلة باللغة العربية."
-                },
-                {
-                    "role": "user",
-                    "content": message
-                }
-            ],
-            "temperature": 0.7,
-            "max_tokens": 2000
-        }
+# =============================================================================
+# البث التدريجي للردود (Streaming)
+# =============================================================================
 
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
-        print(f"📥 استجابة OpenRouter: {response.status_code}")
+def iter_sse_data(response: requests.Response):
+    """قراءة حقول data: من استجابة Server-Sent Events"""
+    response.encoding = "utf-8"
+    for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+        if line and line.startswith("data:"):
+            yield line[5:].strip()
 
-        if response.status_code == 200:
-            result = response.json()
-            response_text = result["choices"][0]["message"]["content"]
-            print(f"✅ نجح Llama: {response_text[:100]}...")
-            return response_text
-        else:
-            print(f"❌ خطأ OpenRouter API: {response.status_code} - {response.text}")
+def stream_smart_response(message: str):
+    """
+    بث الرد من أول نموذج متاح كأزواج (model_type, chunk).
+    يُنتقل للنموذج التالي فقط إذا فشل النموذج قبل إرسال أول جزء.
+    """
+    enabled_models = provider_router.order([
+        model_type for model_type, model in AI_MODELS.items()
+        if model["enabled"] and not provider_breakers[model_type].is_open()
+    ])
 
-        return get_fallback_response(message)
-    except Exception as e:
-        print(f"❌ استثناء في OpenRouter API: {str(e)}")
-        return get_fallback_response(message)
+    for model_type in enabled_models:
+        # القاطع أولاً كما في get_ai_response - الدائرة المفتوحة لا تستهلك رموز الحد
+        if not provider_breakers[model_type].allow_request():
+            continue
+        acquired, _ = provider_rate_limiters[model_type].try_acquire()
+        if not acquired:
+            print(f"🚦 تجاوز حد المعدل المحلي لـ {model_type}، تخطي")
+            provider_breakers[model_type].release_probe()
+            continue
+
+        started = False
+        call_started = time.monotonic()
+        try:
+            print(f"🔄 بث من النموذج: {model_type}")
+            for chunk in AI_PROVIDERS[model_type].stream(message):
+                if not started:
+                    started = True
+                    STREAM_TTFT.observe(time.monotonic() - call_started, model_type)
+                yield model_type, chunk
+
+            PROVIDER_LATENCY.observe(time.monotonic() - call_started, model_type)
+            PROVIDER_REQUESTS.inc(model_type, "ok" if started else "empty")
+            if started:
+                record_provider_outcome(model_type, True, latency=time.monotonic() - call_started)
+                return
+            record_provider_outcome(model_type, False, latency=time.monotonic() - call_started)
+        except Exception as e:
+            print(f"❌ خطأ في بث النموذج {model_type}: {str(e)}")
+            PROVIDER_REQUESTS.inc(model_type, classify_exception(e))
+            record_provider_outcome(model_type, False, isinstance(e, requests.Timeout), time.monotonic() - call_started)
+            if started:
+                # لا يمكن تبديل النموذج بعد بدء إرسال الرد
+                yield model_type, "\n\n⚠️ انقطع الاتصال بالنموذج قبل اكتمال الرد"
+                return
+
+    yield "fallback", get_fallback_response(message)
 
 def get_fallback_response(message):
     """رد احتياطي عندما تفشل جميع النماذج"""
     print("🔄 استخدام الرد الافتراضي...")
 
-    fallback_responses = {
-        "من هو مطورك": "🤖 **معلومات المطور:**\n\n✅ تم تطويري بواسطة **المهندس السوداني محمد عبد القادر السراج**\n🎓 **المؤهلات:**\n• خريج جامعة العلوم وتقانة المعلومات (IT)\n• خريج تكنولوجيا المعلومات والاتصالات (ICT)\n📧 **البريد الإلكتروني:** mohammedu3615@gmail.com\n\nأعمل دائماً على تطوير وتحسين أدائي لخدمة المستخدمين العرب بأفضل صورة! 💪",
-
-        "ماهو الذكاء الاصطناعي": "الذكاء الاصطناعي (Artificial Intelligence) هو مجال من مجالات علوم الكمبيوتر يهتم بتطوير أنظمة قادرة على أداء مهام تتطلب ذكاءً بشرياً مثل:\n\n• 🤖 **التعلم** (Learning): قدرة النظام على تحسين أدائه من خلال التجربة\n• 💭 **التفكير** (Reasoning): القدرة على استنتاج النتائج المنطقية\n• 🔍 **حل المشكلات** (Problem Solving): إيجاد حلول للتحديات المعقدة\n\nيشمل الذكاء الاصطناعي مجالات فرعية مثل التعلم الآلي، الشبكات العصبية، الرؤية الحاسوبية، ومعالجة اللغة الطبيعية.",
-
-        "ما هي المجالات": "مجالات الذكاء الاصطناعي تشمل:\n\n🎯 **المجالات الرئيسية:**\n• التعلم الآلي (Machine Learning)\n• الشبكات العصبية (Neural Networks)\n• معالجة اللغة الطبيعية (NLP)\n• الرؤية الحاسوبية (Computer Vision)\n• الروبوتات (Robotics)\n\n💼 **التطبيقات العملية:**\n• المساعدات الذكية (مثل ClainAI)\n• السيارات ذاتية القيادة\n• التشخيص الطبي\n• التوصيات الذكية\n• الترجمة الآلية",
-
-        "عرف الحوسبة السحابية": "الحوسبة السحابية (Cloud Computing) هي نموذج لتقديم خدمات حاسوبية عبر الإنترنت تشمل:\n\n☁️ **الخدمات الأساسية:**\n• **الخوادم** (Servers): قوة معالجة مرنة\n• **التخزين** (Storage): مساحة تخزين غير محدودة\n• **قواعد البيانات** (Databases): أنواع متعددة من قواعد البيانات\n\n🎯 **نماذج الخدمة:**\n• **IaaS** (البنية التحتية كخدمة)\n• **PaaS** (المنصة كخدمة)  \n• **SaaS** (البرمجيات كخدمة)\n\n💫 **المزايا:**\n• توفير التكاليف\n• المرونة والتوسع\n• الأمان المتقدم\n• الابتكار السريع",
-
-        "ما اسمك": "🤖 **أنا ClainAI - المساعد الذكي العربي المتطور!**\n\n✨ **ما أقدمه لك:**\n• محادثات ذكية متقدمة\n• تحليل الملفات (PDF, Word, الصور)\n• بحث ذكي على الإنترنت\n• إجابات إبداعية ومفيدة\n• دعم متعدد النماذج الذكية\n• نظام وكيل ذكي للمهام التلقائية\n\n🚀 **تم تطويري بواسطة المهندس محمد عبد القادر السراج** لخدمة المستخدمين العرب بكل احترافية وإبداع!",
 
-        "اشهر مزودين الكلاود منو": "🌐 **أشهر مزودي خدمات الحوسبة السحابية:**\n\n🏆 **المزودون العالميون:**\n• **Amazon Web Services (AWS)** - الرائد عالمياً\n• **Microsoft Azure** - حلول متكاملة\n• **Google Cloud Platform (GCP)** - تقنيات متقدمة\n\n🚀 **مزودون آخرون:**\n• **IBM Cloud** - حلول المؤسسات\n• **Oracle Cloud** - قواعد البيانات\n• **Alibaba Cloud** - الرائد في آسيا\n\n💡 **نصائح للاختيار:**\n• AWS للمشاريع الكبيرة\n• Azure للبيئة Microsoft\n• GCP للذكاء الاصطناعي",
-
-        "اخبار اليوم": "📰 **أخبار اليوم - النسخة الذكية**\n\n🔍 *جاري جمع أحدث الأخبار...*\n\n📊 **أهم الفئات:**\n• 📈 أخبار التكنولوجيا والذكاء الاصطناعي\n• 💼 الأخبار الاقتصادية والأسواق\n• 🌍 الأخبار العالمية\n• 🏆 الأخبار الرياضية\n\n⚡ *لتحميل أحدث الأخبار، تأكد من تفعيل مفتاح Serper API في إعدادات التطبيق*",
-
-        "ما هي أخبار اليوم": "📰 **أخبار اليوم - النسخة الذكية**\n\n🔍 *جاري جمع أحدث الأخبار...*\n\n📊 **أهم الفئات:**\n• 📈 أخبار التكنولوجيا والذكاء الاصطناعي\n• 💼 الأخبار الاقتصادية والأسواق\n• 🌍 الأخبار العالمية\n• 🏆 الأخبار الرياضية\n\n⚡ *لتحميل أحدث الأخبار، تأكد من تفعيل مفتاح Serper API في إعدادات التطبيق*"
-    }
-
-    # البحث عن رد مناسب
-    message_lower = message.lower()
-    for key, response in fallback_responses.items():
-        if key in message_lower:
-            print(f"✅ وجد رد افتراضي مخصص: {key}")
-            return response
+    # البحث عن رد مناسب (المفاتيح مرتبة حسب الأولوية)
+    matched = match_keywords(message).get("fallback")
+    if matched:
+        key = matched[0]
+        print(f"✅ وجد رد افتراضي مخصص: {key}")
+        return FALLBACK_RESPONSES[key]
 
     # رد ذكي افتراضي محسن
     smart_fallback = f"""🤖 **أهلاً بك في ClainAI!**
@@ -572,10 +1576,230 @@ def get_fallback_response(message):
     print("ℹ️ استخدام الرد الذكي الافتراضي")
     return smart_fallback
 
-def get_smart_response(message):
+# =============================================================================
+# سباق النماذج (Racing / Hedging)
+# =============================================================================
+
+# sequential: تجربة النماذج بالترتيب | race: إرسال الطلب لعدة نماذج معاً | hedge: طلب احتياطي بعد مهلة
+AI_RESPONSE_MODE = os.getenv("AI_RESPONSE_MODE", "sequential").lower()
+# الحد الأقصى لعدد المزودين الذين يمكن استدعاؤهم في الطلب الواحد (للتحكم في التكلفة)
+AI_RACE_FANOUT = max(1, _env_int("AI_RACE_FANOUT", 2))
+# المهلة قبل إطلاق طلب احتياطي في وضع hedge (بالثواني)
+AI_HEDGE_DELAY = max(0.0, _env_float("AI_HEDGE_DELAY", 3.0))
+
+_provider_executor = ThreadPoolExecutor(
+    max_workers=_env_int("AI_PROVIDER_WORKERS", 16),
+    thread_name_prefix="ai-provider"
+)
+
+def is_quality_response(result: ProviderResult) -> bool:
+    """هل نجح المزود برد بجودة مقبولة"""
+    return result.ok and len(result.text) > 50
+
+def race_models(message: str, models: List[str], hedge_delay: float, budget: int):
+    """
+    إطلاق الطلب على عدة نماذج وإرجاع أول رد يجتاز فحص الجودة.
+    hedge_delay = 0 يعني إطلاق كل النماذج المسموح بها معاً (race)،
+    وإلا يُطلق نموذج احتياطي كلما مرت المهلة دون رد صالح (hedge).
+    """
+    candidates = list(models[:budget])
+    pending = {}
+
+    def launch_next():
+        model_type = candidates.pop(0)
+        print(f"🏁 إطلاق النموذج: {model_type}")
+        pending[_provider_executor.submit(get_ai_response, message, model_type)] = model_type
+
+    launch_next()
+    while candidates and hedge_delay <= 0:
+        launch_next()
+
+    while pending:
+        done, _ = wait(pending, timeout=hedge_delay if candidates else None, return_when=FIRST_COMPLETED)
+
+        if not done:
+            # لم يصل رد خلال المهلة - إطلاق طلب احتياطي
+            launch_next()
+            continue
+
+        for future in done:
+            model_type = pending.pop(future)
+            result = future.result()
+
+            if is_quality_response(result):
+                print(f"✅ فاز في السباق: {model_type} ({result.latency:.2f}s)")
+                # تجاهل بقية الطلبات وإلغاء ما لم يبدأ منها
+                for other in pending:
+                    other.cancel()
+                return result
+
+            print(f"❌ النموذج {model_type} فشل: {result.error_kind or 'رد قصير'}")
+            if candidates:
+                launch_next()
+
+    return None
+
+# =============================================================================
+# ذاكرة تخزين مؤقت للردود (LRU + TTL)
+# =============================================================================
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() not in ("0", "false", "no")
+RESPONSE_CACHE_SIZE = _env_int("RESPONSE_CACHE_SIZE", 1024)
+RESPONSE_CACHE_TTL = _env_float("RESPONSE_CACHE_TTL", 3600)
+
+class LRUCache:
+    """ذاكرة مؤقتة محدودة الحجم مع إزالة الأقدم استخداماً ومدة صلاحية لكل عنصر"""
+
+    def __init__(self, max_size: int, default_ttl: float):
+        self.max_size = max(1, max_size)
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= now:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        expires_at = time.monotonic() + (self.default_ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0
+            }
+
+response_cache = LRUCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+def response_cache_key(message: str, models: List[str]) -> tuple:
+    """مفتاح الذاكرة المؤقتة: النص بعد التطبيع + ترتيب النماذج"""
+    normalized = " ".join(message.split()).casefold()
+    return normalized, tuple(models)
+
+# =============================================================================
+# دمج الطلبات المتطابقة الجارية (Single-Flight)
+# =============================================================================
+
+class _FlightCall:
+    __slots__ = ("event", "result", "error", "waiters")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    """تنفيذ دالة مرة واحدة لكل مفتاح جارٍ؛ الطلبات المتزامنة بنفس المفتاح تنتظر نفس النتيجة"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = _FlightCall()
+                self._calls[key] = call
+                self.leaders += 1
+                leader = True
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            print("🔗 انضمام لطلب مطابق جارٍ")
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "leaders": self.leaders,
+                "coalesced": self.coalesced
+            }
+
+llm_single_flight = SingleFlight()
+
+def get_smart_response(message, mode=None, fanout=None):
     """
     الحصول على رد ذكي من أفضل نموذج متاح
+    mode: sequential | race | hedge (الافتراضي AI_RESPONSE_MODE)
+    fanout: أقصى عدد مزودين يُستدعى في هذا الطلب (الافتراضي AI_RACE_FANOUT)
     """
+    enabled_models = [model_type for model_type, model in AI_MODELS.items() if model["enabled"]]
+
+    cache_key = response_cache_key(message, enabled_models)
+    if RESPONSE_CACHE_ENABLED and enabled_models:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            print(f"⚡ رد من الذاكرة المؤقتة ({cached[1]})")
+            return cached
+
+    # الطلبات المتطابقة المتزامنة تشترك في استدعاء واحد للمزود
+    return llm_single_flight.do(
+        (cache_key, mode, fanout),
+        query_models, message, enabled_models, cache_key, mode, fanout
+    )
+
+def query_models(message, enabled_models, cache_key, mode=None, fanout=None):
+    """استدعاء النماذج فعلياً (بعد فشل الذاكرة المؤقتة) وتخزين الرد الناجح"""
     print(f"\n🎯 بدء get_smart_response للرسالة: {message}")
 
     # تحقق من API Keys
@@ -584,54 +1808,333 @@ def get_smart_response(message):
     print(f"  - OpenAI: {'✅' if OPENAI_API_KEY else '❌'} ({'مفعل' if AI_MODELS['openai']['enabled'] else 'معطل'})")
     print(f"  - Claude: {'✅' if CLAUDE_API_KEY else '❌'} ({'مفعل' if AI_MODELS['claude']['enabled'] else 'معطل'})")
     print(f"  - OpenRouter: {'✅' if OPENROUTER_API_KEY else '❌'} ({'مفعل' if AI_MODELS['llama']['enabled'] else 'معطل'})")
-
-    enabled_models = [model_type for model_type, model in AI_MODELS.items() if model["enabled"]]
     print(f"🎯 النماذج المفعلة: {enabled_models}")
 
+    # تخطي المزودين ذوي الدوائر المفتوحة
+    open_circuits = [model_type for model_type in enabled_models if provider_breakers[model_type].is_open()]
+    if open_circuits:
+        print(f"⛔ دوائر مفتوحة: {open_circuits}")
+        enabled_models = [model_type for model_type in enabled_models if model_type not in open_circuits]
+
     if not enabled_models:
         print("⚠️ لا توجد نماذج مفعلة، استخدام الرد الافتراضي")
         return get_fallback_response(message), "fallback"
 
-    # محاولة النماذج بالترتيب
-    for model_type in enabled_models:
-        try:
-            print(f"🔄 محاولة النموذج: {model_type}")
-            response = get_ai_response(message, model_type)
-
-            # تحقق إذا كان الرد مختلف عن الافتراضي
-            fallback_response = get_fallback_response(message)
-            if response and response != fallback_response and len(response) > 50:
-                print(f"✅ نجح النموذج: {model_type}")
-                return response, model_type
-            else:
-                print(f"❌ النموذج {model_type} فشل أو أعاد رد افتراضي")
-        except Exception as e:
-            print(f"❌ خطأ في النموذج {model_type}: {str(e)}")
-            continue
+    enabled_models = provider_router.order(enabled_models)
+    print(f"🧭 ترتيب التوجيه ({provider_router.policy}): {enabled_models}")
+
+    mode = (mode or AI_RESPONSE_MODE).lower()
+    winner = None
+
+    if mode in ("race", "hedge") and len(enabled_models) > 1:
+        budget = max(1, min(fanout or AI_RACE_FANOUT, len(enabled_models)))
+        hedge_delay = AI_HEDGE_DELAY if mode == "hedge" else 0
+        print(f"🏁 وضع {mode}: حتى {budget} نماذج")
+        winner = race_models(message, enabled_models, hedge_delay, budget)
+    else:
+        # محاولة النماذج بالترتيب
+        for model_type in enabled_models:
+            result = get_ai_response(message, model_type)
+            if is_quality_response(result):
+                print(f"✅ نجح النموذج: {model_type} ({result.latency:.2f}s)")
+                winner = result
+                break
+            print(f"❌ النموذج {model_type} فشل: {result.error_kind or 'رد قصير'}")
+
+    if winner:
+        reply = (winner.text, winner.provider)
+        if RESPONSE_CACHE_ENABLED:
+            response_cache.set(cache_key, reply)
+        return reply
 
     print("⚠️ جميع النماذج فشلت، استخدام الرد الافتراضي")
     return get_fallback_response(message), "fallback"
 
 # =============================================================================
-# دالة الاتصال بقاعدة البيانات
+# معرفات مرتبة زمنياً (ULID)
 # =============================================================================
 
-def get_db_connection():
+# Crockford base32: 48 بت للوقت بالميلي ثانية + 80 بت عشوائية = 26 حرفاً
+ULID_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+_ulid_lock = threading.Lock()
+_ulid_last_ms = 0
+_ulid_last_random = 0
+
+def _encode_ulid(timestamp_ms: int, randomness: int) -> str:
+    value = (timestamp_ms << 80) | randomness
+    chars = []
+    for _ in range(26):
+        chars.append(ULID_ALPHABET[value & 31])
+        value >>= 5
+    return "".join(reversed(chars))
+
+def db_timestamp(moment: datetime = None) -> str:
+    """وقت بنفس صيغة CURRENT_TIMESTAMP في SQLite (UTC، مسافة بين التاريخ والوقت)
+    حتى تبقى مقارنة أعمدة التاريخ كنصوص صحيحة أياً كان من كتبها"""
+    return (moment or datetime.utcnow()).strftime("%Y-%m-%d %H:%M:%S")
+
+def new_id() -> str:
+    """معرف فريد يزداد مع الزمن - الإدخالات الجديدة تقع في نهاية فهرس المفتاح الأساسي"""
+    global _ulid_last_ms, _ulid_last_random
+    timestamp_ms = int(time.time() * 1000)
+    with _ulid_lock:
+        if timestamp_ms <= _ulid_last_ms:
+            # نفس الميلي ثانية (أو رجوع الساعة): زيادة الجزء العشوائي للحفاظ على الترتيب
+            timestamp_ms = _ulid_last_ms
+            randomness = (_ulid_last_random + 1) & ((1 << 80) - 1)
+        else:
+            randomness = secrets.randbits(80)
+        _ulid_last_ms, _ulid_last_random = timestamp_ms, randomness
+    return _encode_ulid(timestamp_ms, randomness)
+
+def ulid_from_timestamp(value: str, seed: str) -> str:
+    """معرف لصف موجود مشتق من تاريخ إنشائه؛ الجزء العشوائي ثابت من المعرف القديم"""
     try:
-        conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=30)
+        moment = datetime.fromisoformat(value.replace("Z", "")) if value else datetime(1970, 1, 1)
+    except ValueError:
+        moment = datetime(1970, 1, 1)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    randomness = int(hashlib.md5(seed.encode()).hexdigest()[:20], 16)
+    return _encode_ulid(max(0, int(moment.timestamp() * 1000)), randomness)
+
+# =============================================================================
+# دالة الاتصال بقاعدة البيانات
+# =============================================================================
+
+DB_POOL_SIZE = max(1, _env_int("DB_POOL_SIZE", 8))
+# الحد الأقصى للاتصالات المستخدمة في آن واحد لكل ملف؛ الطلب الزائد ينتظر حتى DB_POOL_TIMEOUT
+DB_POOL_MAX_CONNECTIONS = max(1, _env_int("DB_POOL_MAX_CONNECTIONS", 32))
+DB_POOL_TIMEOUT = _env_float("DB_POOL_TIMEOUT", 10)
+DB_BUSY_TIMEOUT_MS = _env_int("DB_BUSY_TIMEOUT_MS", 30000)
+
+def sql_normalize_arabic(text):
+    """arabic_normalize() داخل SQL - استخدمتها الترحيلات 3 و5 لتعبئة فهرس البحث"""
+    return normalize_arabic(text) if text else text
+
+def register_sql_functions(conn):
+    """
+    دوال التطبيق داخل SQL. مشغلات فهرس البحث الحالية (الترحيل 7) لا تحتاجها - فأي
+    اتصال، بما فيه sqlite3 من سطر الأوامر، يمكنه الكتابة في conversations؛ لكن
+    الترحيلات الأقدم تستدعيها عند تطبيقها على قاعدة قديمة.
+    """
+    conn.create_function("arabic_normalize", 1, sql_normalize_arabic, deterministic=True)
+
+# عمق replace() المتداخلة في استعلام فرعي واحد - محلل SQLite يتوقف عند نحو 30
+SQL_FOLD_DEPTH = 12
+
+def sql_fold_select(message: str, reply: str) -> str:
+    """
+    نفس توحيد ARABIC_FOLDS كاستعلام SQL يعيد عمودي message وreply، دون دوال مسجلة.
+    السلسلة تُقسم على استعلامات فرعية متداخلة حتى لا يتجاوز التعبير حد المحلل.
+    الأحرف الكبيرة لا تحتاج lower(): مقسّم unicode61 يوحدها عند الفهرسة والبحث.
+    """
+    select = f"SELECT {message} AS message, {reply} AS reply"
+    for start in range(0, len(ARABIC_FOLDS), SQL_FOLD_DEPTH):
+        columns = []
+        for column in ("message", "reply"):
+            expression = column
+            for source, target in ARABIC_FOLDS[start:start + SQL_FOLD_DEPTH]:
+                expression = f"replace({expression}, '{source}', '{target}')"
+            columns.append(f"{expression} AS {column}")
+        select = f"SELECT {', '.join(columns)} FROM ({select})"
+    return select
+
+class PooledConnection(InstrumentedConnection):
+    """اتصال يعود إلى المجمع عند close() بدلاً من إغلاقه فعلياً"""
+
+    pool = None
+    in_use = False
+    lease = 0  # يزداد مع كل استعارة لتمييز المالك الحالي
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.release(self)
+        else:
+            super().close()
+
+    def close_for_real(self):
+        super().close()
+
+class ConnectionPool:
+    """
+    مجمع اتصالات SQLite محدود - يُعاد استخدام آخر اتصال محرر (LIFO).
+    max_idle يحد الاتصالات المحفوظة، وmax_open يحد المستخدمة في آن واحد: الاستعارة
+    الزائدة تنتظر تحرير اتصال حتى timeout ثم ترفع sqlite3.OperationalError.
+    """
+
+    def __init__(self, path: str, max_idle: int, max_open: int = None, timeout: float = None):
+        self.path = path
+        self.max_idle = max_idle
+        self.max_open = max(max_idle, max_open or DB_POOL_MAX_CONNECTIONS)
+        self.timeout = DB_POOL_TIMEOUT if timeout is None else timeout
+        self._idle: List[PooledConnection] = []
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self.created = 0
+        self.in_use = 0
+        self.waiting = 0
+        self.exhausted = 0
+
+    def _connect(self) -> PooledConnection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                               factory=PooledConnection)
         conn.row_factory = sqlite3.Row
+        # الإعدادات تُضبط مرة واحدة عند إنشاء الاتصال
+        conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+        if self.path != ":memory:":
+            # يسري فقط على قاعدة جديدة قبل إنشاء أول جدول - يسمح بـ incremental_vacuum
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+        register_sql_functions(conn)
+        conn.pool = self
+        self.created += 1
+        return conn
+
+    def acquire(self, track: bool = True) -> PooledConnection:
+        """track: تسجيل الاتصال في g ليُحرر عند نهاية الطلب إن لم يُغلق (لا تحتاجه with)"""
+        with self._lock:
+            if self.in_use >= self.max_open:
+                deadline = time.monotonic() + self.timeout
+                self.waiting += 1
+                try:
+                    while self.in_use >= self.max_open:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.exhausted += 1
+                            raise sqlite3.OperationalError(
+                                f"connection pool exhausted: {self.max_open} connections in use ({self.path})")
+                        self._available.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            conn = self._idle.pop() if self._idle else None
+            self.in_use += 1
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._lock:
+                    self.in_use -= 1
+                    self._available.notify()
+                raise
+        conn.in_use = True
+        conn.lease += 1
+        if track and has_app_context():
+            g.setdefault("db_connections", []).append((conn, conn.lease))
         return conn
+
+    def release(self, conn: PooledConnection, lease: Optional[int] = None):
+        with self._lock:
+            # lease يمنع تحرير اتصال أعيد استعارته من طلب آخر
+            if not conn.in_use or (lease is not None and conn.lease != lease):
+                return
+            conn.in_use = False
+            self.in_use -= 1
+            self._available.notify()
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close_for_real()
+            return
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close_for_real()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close_for_real()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"idle": len(self._idle), "in_use": self.in_use, "created": self.created,
+                    "waiting": self.waiting, "exhausted": self.exhausted}
+
+db_pool = ConnectionPool(DB_PATH, DB_POOL_SIZE)
+
+# التقسيم (Sharding) الاختياري: بيانات كل مستخدم في الجداول الخاصة به تُوجه إلى ملف
+# من SHARD_COUNT ملفات حسب crc32(user_id)؛ الجداول العامة (users) تبقى في القاعدة المشتركة
+SHARD_COUNT = max(1, _env_int("SHARD_COUNT", 1))
+SHARDED_TABLES = ("conversations", "agent_tasks", "agent_memory", "agent_notifications", "uploaded_files")
+
+def shard_path(index: int) -> str:
+    base, extension = os.path.splitext(DB_PATH)
+    return f"{base}.shard-{index}{extension or '.db'}"
+
+def shard_for_user(user_id: str, shard_count: int = None) -> int:
+    """رقم الملف الخاص بالمستخدم - ثابت لنفس المعرف وعدد الأقسام"""
+    return zlib.crc32(user_id.encode("utf-8")) % (shard_count or SHARD_COUNT)
+
+# بدون تقسيم، القاعدة المشتركة هي القسم الوحيد
+shard_pools = [ConnectionPool(shard_path(index), DB_POOL_SIZE) for index in range(SHARD_COUNT)] \
+    if SHARD_COUNT > 1 else [db_pool]
+all_db_pools = [db_pool] + [pool for pool in shard_pools if pool is not db_pool]
+
+def user_db_pool(user_id: str) -> ConnectionPool:
+    return shard_pools[shard_for_user(user_id)]
+
+def get_db_connection(track: bool = True):
+    """اتصال من المجمع - close() يعيده إلى المجمع"""
+    try:
+        return db_pool.acquire(track)
     except Exception as e:
+        # لا بديل صامت: قاعدة فارغة في الذاكرة بلا مخطط تخفي العطل خلف أخطاء "no such table"
         print(f"❌ Database error: {e}")
-        # بديل في الذاكرة
-        conn = sqlite3.connect(":memory:", check_same_thread=False)
-        conn.row_factory = sqlite3.Row
-        return conn
+        raise
+
+def get_user_db_connection(user_id: str):
+    """اتصال بالقسم الذي يحوي بيانات المستخدم"""
+    pool = user_db_pool(user_id)
+    return get_db_connection() if pool is db_pool else pool.acquire()
+
+@contextmanager
+def db_connection(pool: ConnectionPool = None):
+    """with db_connection() as conn: - يعيد الاتصال إلى المجمع عند الخروج"""
+    # finally يحرره دائماً، فلا يُسجل في g.db_connections - مهم للبث الطويل الذي
+    # يفتح اتصالات كثيرة داخل طلب واحد لا ينتهي
+    conn = get_db_connection(track=False) if pool is None or pool is db_pool else pool.acquire(track=False)
+    try:
+        yield conn
+    except Exception:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        conn.close()
 
-# تهيئة قاعدة البيانات
-def init_db():
-    conn = get_db_connection()
+@app.teardown_appcontext
+def release_db_connections(exception=None):
+    """إعادة أي اتصال لم يُغلق خلال الطلب إلى المجمع"""
+    for conn, lease in g.pop("db_connections", []):
+        conn.pool.release(conn, lease)
+
+def user_db_connection(user_id: str):
+    """with user_db_connection(user_id) as conn: - اتصال بقسم المستخدم"""
+    return db_connection(user_db_pool(user_id))
+
+for _pool in all_db_pools:
+    atexit.register(_pool.close_all)
+
+metrics.register(Gauge(
+    "clainai_db_pool_connections", "SQLite pool connections by state", ("state",),
+    lambda: {(state,): sum(pool.stats()[state] for pool in all_db_pools) for state in ("idle", "in_use", "created", "waiting")}
+))
+metrics.register(CallbackCounter(
+    "clainai_db_pool_exhausted_total", "Connection acquisitions that timed out waiting for a free connection", (),
+    lambda: {(): sum(pool.stats()["exhausted"] for pool in all_db_pools)}
+))
+
+# =============================================================================
+# ترحيلات مخطط قاعدة البيانات (PRAGMA user_version)
+# =============================================================================
 
+def _migration_initial_schema(conn):
     # جدول المستخدمين
     conn.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -696,43 +2199,832 @@ def init_db():
         )
     ''')
 
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS agent_memory (
-            id TEXT PRIMARY KEY,
-            user_id TEXT,
-            key TEXT,
-            value TEXT,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS agent_memory (
+            id TEXT PRIMARY KEY,
+            user_id TEXT,
+            key TEXT,
+            value TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS agent_notifications (
+            id TEXT PRIMARY KEY,
+            user_id TEXT,
+            title TEXT,
+            message TEXT,
+            is_read BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS price_tracking (
+            id TEXT PRIMARY KEY,
+            user_id TEXT,
+            topic TEXT,
+            price_info TEXT,
+            checked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+def _migration_per_user_indexes(conn):
+    # كل استعلامات الجداول الخاصة بالمستخدم تُصفى على user_id؛ الفهارس تطابق نمط كل استعلام
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_conversations_user_created ON conversations (user_id, created_at, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_notifications_user_created ON agent_notifications (user_id, created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_notifications_user_read ON agent_notifications (user_id, is_read)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_tasks_user_status ON agent_tasks (user_id, status)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_searches_user_created ON searches (user_id, created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_uploaded_files_user ON uploaded_files (user_id, uploaded_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_price_tracking_user ON price_tracking (user_id, checked_at)')
+
+    # مفتاح واحد لكل مستخدم - حذف أي تكرار قديم قبل إنشاء الفهرس الفريد
+    conn.execute('''
+        DELETE FROM agent_memory WHERE rowid NOT IN (
+            SELECT MAX(rowid) FROM agent_memory GROUP BY user_id, key
+        )
+    ''')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_agent_memory_user_key ON agent_memory (user_id, key)')
+
+def _create_conversations_fts_update_trigger(conn):
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_update AFTER UPDATE ON conversations BEGIN
+            DELETE FROM conversations_fts WHERE rowid = old.rowid;
+            INSERT INTO conversations_fts (rowid, conversation_id, user_id, message, reply)
+            VALUES (new.rowid, new.id, new.user_id, arabic_normalize(new.message), arabic_normalize(new.reply));
+        END
+    ''')
+
+def _migration_conversations_fts(conn):
+    # نسخة مطبّعة (بدون تشكيل، مع توحيد الألف والياء والتاء المربوطة) من نص المحادثة؛
+    # rowid يطابق rowid في conversations. user_id مفهرس ليُقيد البحث بمحادثات المستخدم
+    # داخل FTS نفسه بدلاً من تصفية نتائج كل المستخدمين
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts USING fts5(
+            conversation_id UNINDEXED,
+            user_id,
+            message,
+            reply,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_insert AFTER INSERT ON conversations BEGIN
+            INSERT INTO conversations_fts (rowid, conversation_id, user_id, message, reply)
+            VALUES (new.rowid, new.id, new.user_id, arabic_normalize(new.message), arabic_normalize(new.reply));
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_delete AFTER DELETE ON conversations BEGIN
+            DELETE FROM conversations_fts WHERE rowid = old.rowid;
+        END
+    ''')
+    _create_conversations_fts_update_trigger(conn)
+
+    # تعبئة الفهرس بالمحادثات الموجودة
+    conn.execute('''
+        INSERT INTO conversations_fts (rowid, conversation_id, user_id, message, reply)
+        SELECT rowid, id, user_id, arabic_normalize(message), arabic_normalize(reply) FROM conversations
+        WHERE rowid NOT IN (SELECT rowid FROM conversations_fts)
+    ''')
+
+def _migration_conversations_fts_plain_sql_triggers(conn):
+    # المشغلات السابقة تستدعي arabic_normalize() فتفشل كل كتابة في conversations من
+    # اتصال لم يسجلها (sqlite3 من سطر الأوامر، أدوات الصيانة). التوحيد نفسه كتعبير SQL.
+    # المحتوى المفهرس لا يتغير (الفرق في حالة الأحرف فقط ويوحدها المقسّم) فلا حاجة لإعادة البناء
+    folded = sql_fold_select("new.message", "new.reply")
+    conn.execute('DROP TRIGGER IF EXISTS conversations_fts_insert')
+    conn.execute('DROP TRIGGER IF EXISTS conversations_fts_update')
+    conn.execute(f'''
+        CREATE TRIGGER conversations_fts_insert AFTER INSERT ON conversations BEGIN
+            INSERT INTO conversations_fts (rowid, conversation_id, user_id, message, reply)
+            SELECT new.rowid, new.id, new.user_id, message, reply FROM ({folded});
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER conversations_fts_update AFTER UPDATE ON conversations BEGIN
+            DELETE FROM conversations_fts WHERE rowid = old.rowid;
+            INSERT INTO conversations_fts (rowid, conversation_id, user_id, message, reply)
+            SELECT new.rowid, new.id, new.user_id, message, reply FROM ({folded});
+        END
+    ''')
+
+def _migration_retention_indexes(conn):
+    # مهمة الاحتفاظ تحذف حسب التاريخ فقط (بدون user_id)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_searches_created ON searches (created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_notifications_created ON agent_notifications (created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_conversations_created ON conversations (created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_uploaded_files_uploaded ON uploaded_files (uploaded_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_price_tracking_checked ON price_tracking (checked_at)')
+
+# الجداول ذات المعرفات المولدة وعمود تاريخ الإنشاء لكل منها
+ULID_TABLES = {
+    "conversations": "created_at",
+    "agent_tasks": "created_at",
+    "agent_notifications": "created_at",
+    "agent_memory": "updated_at",
+    "searches": "created_at",
+    "uploaded_files": "uploaded_at",
+    "price_tracking": "checked_at"
+}
+
+def _migration_time_ordered_ids(conn):
+    # تغيير المعرف فقط لا يستدعي إعادة تطبيع النص في فهرس البحث
+    conn.execute('DROP TRIGGER IF EXISTS conversations_fts_update')
+
+    for table, timestamp_column in ULID_TABLES.items():
+        rows = conn.execute(
+            f'SELECT rowid, id, {timestamp_column} AS created FROM {table} ORDER BY rowid'
+        ).fetchall()
+        conn.executemany(
+            f'UPDATE {table} SET id = ? WHERE rowid = ?',
+            [(ulid_from_timestamp(row["created"], row["id"] or str(row["rowid"])), row["rowid"]) for row in rows]
+        )
+
+    conn.execute('''
+        UPDATE conversations_fts SET conversation_id = (
+            SELECT id FROM conversations WHERE conversations.rowid = conversations_fts.rowid
+        )
+    ''')
+    _create_conversations_fts_update_trigger(conn)
+
+def _migration_notification_counters(conn):
+    # عداد غير المقروء لكل مستخدم تحدثه المشغلات بدلاً من COUNT(*) في كل استعلام.
+    # يبقى في ملف الإشعارات نفسه (القسم نفسه) ويُحذف الصف عند وصوله إلى الصفر
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS notification_counters (
+            user_id TEXT PRIMARY KEY,
+            unread INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS agent_notifications_unread_insert
+        AFTER INSERT ON agent_notifications WHEN NOT new.is_read BEGIN
+            INSERT INTO notification_counters (user_id, unread) VALUES (new.user_id, 1)
+            ON CONFLICT(user_id) DO UPDATE SET unread = unread + 1;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS agent_notifications_unread_delete
+        AFTER DELETE ON agent_notifications WHEN NOT old.is_read BEGIN
+            UPDATE notification_counters SET unread = unread - 1 WHERE user_id = old.user_id;
+            DELETE FROM notification_counters WHERE user_id = old.user_id AND unread <= 0;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS agent_notifications_unread_update
+        AFTER UPDATE OF is_read, user_id ON agent_notifications
+        WHEN old.is_read IS NOT new.is_read OR old.user_id IS NOT new.user_id BEGIN
+            UPDATE notification_counters SET unread = unread - 1 WHERE user_id = old.user_id AND NOT old.is_read;
+            DELETE FROM notification_counters WHERE user_id = old.user_id AND unread <= 0;
+            INSERT INTO notification_counters (user_id, unread) SELECT new.user_id, 1 WHERE NOT new.is_read
+            ON CONFLICT(user_id) DO UPDATE SET unread = unread + 1;
+        END
+    ''')
+    conn.execute('''
+        INSERT OR REPLACE INTO notification_counters (user_id, unread)
+        SELECT user_id, COUNT(*) FROM agent_notifications WHERE NOT is_read GROUP BY user_id
+    ''')
+
+def _migration_user_last_active(conn):
+    # انتهاء حسابات الضيوف يُحسب من آخر نشاط لا من تاريخ الإنشاء
+    add_column(conn, "users", "last_active_at", "TIMESTAMP")
+    conn.execute('UPDATE users SET last_active_at = created_at WHERE last_active_at IS NULL')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_last_active ON users (last_active_at)')
+
+def _migration_utc_timestamps(conn):
+    # الإشعارات وإكمال المهام كانت تُكتب بوقت محلي بصيغة isoformat (بحرف T)، فتختل
+    # مقارنتها بالتاريخ الحدي للاحتفاظ. تحويلها إلى صيغة CURRENT_TIMESTAMP بتوقيت UTC
+    # (الوقت المحلي هنا هو وقت خادم SQLite نفسه الذي كتبها)
+    for table, column in (("agent_notifications", "created_at"), ("agent_tasks", "completed_at")):
+        conn.execute(
+            f"UPDATE {table} SET {column} = datetime({column}, 'utc') WHERE {column} LIKE '____-__-__T%'"
+        )
+
+def column_exists(conn, table: str, column: str) -> bool:
+    return any(row["name"] == column for row in conn.execute(f"PRAGMA table_info({table})"))
+
+def add_column(conn, table: str, column: str, definition: str):
+    """إضافة عمود إن لم يكن موجوداً - آمن على القواعد المنشأة سابقاً"""
+    if not column_exists(conn, table, column):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+# الترحيلات مرتبة؛ رقم الإصدار = موضع الترحيل في القائمة. لا تعدل ترحيلاً
+# منشوراً - أضف ترحيلاً جديداً في النهاية. كلها تعمل داخل معاملة run_migrations:
+# استخدم conn.execute فقط - executescript وcommit ينهيان المعاملة ويفقدان القفل.
+MIGRATIONS = [
+    ("initial schema", _migration_initial_schema),
+    ("per-user secondary indexes", _migration_per_user_indexes),
+    ("conversations full-text search", _migration_conversations_fts),
+    ("retention date indexes", _migration_retention_indexes),
+    ("time-ordered ids", _migration_time_ordered_ids),
+    ("notification unread counters", _migration_notification_counters),
+    ("conversations FTS triggers without app functions", _migration_conversations_fts_plain_sql_triggers),
+    ("user last activity", _migration_user_last_active),
+    ("UTC timestamps", _migration_utc_timestamps),
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def get_schema_version(conn) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def run_migrations(pool: ConnectionPool = None) -> int:
+    """تطبيق الترحيلات المعلقة مرة واحدة، مع قفل كتابة يمنع تكرارها بين العمليات"""
+    with db_connection(pool) as conn:
+        current = get_schema_version(conn)
+        if current >= SCHEMA_VERSION:
+            return current
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # إعادة القراءة بعد أخذ القفل - قد تكون عملية أخرى سبقتنا
+            current = get_schema_version(conn)
+            for version, (description, migrate) in enumerate(MIGRATIONS, start=1):
+                if version <= current:
+                    continue
+                migrate(conn)
+                if not conn.in_transaction:
+                    raise RuntimeError(f"الترحيل {version} أنهى معاملة الترحيل")
+                conn.execute(f"PRAGMA user_version = {version}")
+                print(f"✅ ترحيل قاعدة البيانات {version}: {description}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return get_schema_version(conn)
+
+def run_all_migrations():
+    """المخطط نفسه في القاعدة المشتركة وفي كل قسم"""
+    for pool in all_db_pools:
+        try:
+            run_migrations(pool)
+        except Exception as e:
+            print(f"❌ فشل ترحيل قاعدة البيانات {pool.path}: {e}")
+
+def init_db():
+    """للتوافق مع الاستدعاءات القديمة - الترحيلات تعمل مرة واحدة عند التشغيل"""
+    run_all_migrations()
+
+run_all_migrations()
+
+# =============================================================================
+# الكتابة المؤجلة (Write-behind) - كاتب واحد يجمع الإدخالات في معاملة واحدة
+# =============================================================================
+
+# true: الكتابة فورية في خيط الطلب (للاختبارات وأدوات التشغيل)
+WRITE_BEHIND_SYNC = os.getenv("WRITE_BEHIND_SYNC", "false").lower() in ("1", "true", "yes")
+WRITE_BEHIND_BATCH_MS = _env_float("WRITE_BEHIND_BATCH_MS", 5)
+WRITE_BEHIND_MAX_BATCH = _env_int("WRITE_BEHIND_MAX_BATCH", 500)
+
+# آخر الوحدات التي فشلت كتابتها تبقى للفحص (stats / السجل) بدلاً من ضياعها بصمت
+WRITE_BEHIND_DEAD_LETTERS = 100
+
+class WriteBehindQueue:
+    """
+    طابور كتابة بخيط واحد: يجمع ما يصل خلال بضع ميلي ثوانٍ ويثبته بـ commit واحد.
+    كل استدعاء enqueue_many وحدة ذرية: لا تُقسم بين دفعتين، وتُثبت صفوفها كلها أو لا شيء.
+    """
+
+    def __init__(self, pool: ConnectionPool, batch_window: float, max_batch: int, synchronous: bool = False):
+        self.pool = pool
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.synchronous = synchronous
+        self._queue = queue.Queue()
+        self._condition = threading.Condition()
+        self._enqueued = 0
+        self._written = 0
+        self._thread = None
+        self._stopped = False
+        self.batches = 0
+        self.failed = 0
+        self.dead_letters = deque(maxlen=WRITE_BEHIND_DEAD_LETTERS)
+
+    def enqueue(self, sql: str, params: tuple):
+        self.enqueue_many(sql, [params])
+
+    def enqueue_many(self, sql: str, rows: List[tuple]):
+        """إضافة الصفوف كوحدة واحدة تُثبت في معاملة واحدة"""
+        unit = (sql, [tuple(row) for row in rows])
+        if not unit[1]:
+            return
+        # _stopped يُقرأ تحت القفل نفسه الذي تضبطه close() - لا شيء يُضاف بعد علامة الإيقاف
+        with self._condition:
+            queued = not (self.synchronous or self._stopped)
+            if queued:
+                self._ensure_started()
+                self._enqueued += len(unit[1])
+                self._queue.put(unit)
+        if not queued:
+            self._write([unit])
+
+    def pending(self) -> int:
+        with self._condition:
+            return self._enqueued - self._written
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """انتظار تثبيت كل ما أضيف حتى الآن"""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            target = self._enqueued
+            while self._written < target:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def close(self, timeout: float = 10.0):
+        """إيقاف الإضافة إلى الطابور (ما يصل بعدها يُكتب مباشرة)، ثم تفريغه وإيقاف الخيط"""
+        with self._condition:
+            self._stopped = True
+        self.flush(timeout)
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def stats(self) -> Dict[str, int]:
+        return {"pending": self.pending(), "batches": self.batches, "failed": self.failed,
+                "dead_letters": len(self.dead_letters)}
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="clainai-db-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            # max_batch حد للصفوف، لكن الوحدة لا تُقسم ولو تجاوزته وحدها
+            batch = [item]
+            rows = len(item[1])
+            deadline = time.monotonic() + self.batch_window
+            while rows < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+                rows += len(item[1])
+
+            self._write(batch)
+            with self._condition:
+                self._written += rows
+                self._condition.notify_all()
+
+    def _write(self, batch: List[tuple]):
+        """تنفيذ الوحدات في معاملة واحدة؛ عند الفشل تُعاد كل وحدة في معاملتها الخاصة"""
+        try:
+            with db_connection(self.pool) as conn:
+                for sql, rows in batch:
+                    conn.executemany(sql, rows)
+                conn.commit()
+            self.batches += 1
+            return
+        except Exception as e:
+            if len(batch) == 1:
+                self._dead_letter(batch[0], e)
+                return
+            print(f"⚠️ فشل تثبيت دفعة الكتابة ({len(batch)} وحدة): {e}")
+
+        for sql, rows in batch:
+            try:
+                with db_connection(self.pool) as conn:
+                    conn.executemany(sql, rows)
+                    conn.commit()
+            except Exception as e:
+                self._dead_letter((sql, rows), e)
+
+    def _dead_letter(self, unit: tuple, error: Exception):
+        """وحدة فشلت كلها (db_connection يتراجع عن معاملتها) - تُحفظ للفحص مع الخطأ"""
+        sql, rows = unit
+        self.failed += len(rows)
+        self.dead_letters.append({"sql": sql, "rows": rows, "error": str(error), "failed_at": db_timestamp()})
+        print(f"❌ خطأ في الكتابة المؤجلة، لم تُحفظ {len(rows)} صف: {error} - {sql[:80]}")
+
+# كاتب لكل ملف قاعدة بيانات - الأقسام تكتب بالتوازي ولا تنتظر قفلاً مشتركاً
+db_writer = WriteBehindQueue(db_pool, WRITE_BEHIND_BATCH_MS / 1000, WRITE_BEHIND_MAX_BATCH, WRITE_BEHIND_SYNC)
+shard_writers = [
+    db_writer if pool is db_pool else WriteBehindQueue(pool, WRITE_BEHIND_BATCH_MS / 1000, WRITE_BEHIND_MAX_BATCH, WRITE_BEHIND_SYNC)
+    for pool in shard_pools
+]
+all_db_writers = [db_writer] + [writer for writer in shard_writers if writer is not db_writer]
+
+def user_db_writer(user_id: str) -> WriteBehindQueue:
+    return shard_writers[shard_for_user(user_id)]
+
+def flush_writes(user_id: str = None) -> bool:
+    """تثبيت الكتابات المعلقة - لقسم المستخدم فقط إن حُدد؛ False إذا انتهت المهلة قبل التثبيت"""
+    writers = [user_db_writer(user_id)] if user_id else all_db_writers
+    flushed = True
+    for writer in writers:
+        if writer.pending():
+            flushed = writer.flush() and flushed
+    return flushed
+
+for _writer in all_db_writers:
+    atexit.register(_writer.close)
+
+metrics.register(Gauge(
+    "clainai_db_write_behind", "Write-behind queue state", ("state",),
+    lambda: {(state,): sum(writer.stats()[state] for writer in all_db_writers) for state in ("pending", "batches", "failed")}
+))
+
+# =============================================================================
+# الإشعارات الفورية (SSE) - دفع الإشعارات الجديدة بدلاً من الاستطلاع
+# =============================================================================
+
+NOTIFICATION_HEARTBEAT_SECONDS = _env_float("NOTIFICATION_HEARTBEAT_SECONDS", 15)
+NOTIFICATION_QUEUE_SIZE = _env_int("NOTIFICATION_QUEUE_SIZE", 100)
+NOTIFICATION_RESUME_LIMIT = _env_int("NOTIFICATION_RESUME_LIMIT", 100)
+
+class NotificationSubscriber:
+    """اتصال بث واحد: طابور محدود، وعلامة فقدان أحداث عند امتلائه"""
+
+    def __init__(self, user_id: str, max_size: int):
+        self.user_id = user_id
+        self.events = queue.Queue(max_size)
+        self.overflowed = False
+
+class NotificationHub:
+    """توزيع الأحداث على اتصالات البث المفتوحة لكل مستخدم داخل العملية"""
+
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self._subscribers: Dict[str, List[NotificationSubscriber]] = {}
+        self._lock = threading.Lock()
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, user_id: str) -> NotificationSubscriber:
+        subscriber = NotificationSubscriber(user_id, self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(user_id, []).append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: NotificationSubscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.user_id, [])
+            if subscriber in subscribers:
+                subscribers.remove(subscriber)
+            if not subscribers:
+                self._subscribers.pop(subscriber.user_id, None)
+
+    def publish(self, user_id: str, event: str, data: Dict[str, Any]):
+        """لا يحجز أبداً: العميل البطيء يُعلَّم ليعيد المزامنة من القاعدة"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for subscriber in subscribers:
+            try:
+                subscriber.events.put_nowait((event, data))
+                self.published += 1
+            except queue.Full:
+                subscriber.overflowed = True
+                self.dropped += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            connections = sum(len(subscribers) for subscribers in self._subscribers.values())
+            return {"users": len(self._subscribers), "connections": connections,
+                    "published": self.published, "dropped": self.dropped}
+
+notification_hub = NotificationHub(NOTIFICATION_QUEUE_SIZE)
+
+metrics.register(Gauge(
+    "clainai_notification_streams", "Open notification SSE connections", (),
+    lambda: {(): notification_hub.stats()["connections"]}
+))
+
+def unread_notifications_count(user_id: str) -> int:
+    """عدد الإشعارات غير المقروءة من العداد - قراءة صف واحد بالمفتاح الأساسي"""
+    # الإشعارات تُكتب عبر طابور الكتابة المؤجلة؛ العداد لا يشملها قبل تثبيتها
+    flush_writes(user_id)
+    with user_db_connection(user_id) as conn:
+        row = conn.execute('SELECT unread FROM notification_counters WHERE user_id = ?', (user_id,)).fetchone()
+    return row['unread'] if row else 0
+
+def notifications_after(user_id: str, last_id: str) -> List[Dict[str, Any]]:
+    """صفحة من الإشعارات الأحدث من معرف معين (المعرفات ULID مرتبة زمنياً)؛
+    الصفحة الكاملة (NOTIFICATION_RESUME_LIMIT) تعني أن بعدها المزيد"""
+    flush_writes(user_id)
+    with user_db_connection(user_id) as conn:
+        rows = conn.execute(
+            'SELECT id, title, message, created_at, is_read FROM agent_notifications '
+            'WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?',
+            (user_id, last_id, NOTIFICATION_RESUME_LIMIT)
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+# =============================================================================
+# ذاكرة مؤقتة لملفات المستخدمين وتفضيلاتهم - دون قراءة من القاعدة في المسارات المتكررة
+# =============================================================================
+
+USER_CACHE_SIZE = _env_int("USER_CACHE_SIZE", 4096)
+USER_CACHE_TTL = _env_float("USER_CACHE_TTL", 300)
+
+# كل عملية لها ذاكرتها؛ الكتابة عبر save_user_profile تحدثها فوراً، ومدة الصلاحية
+# تحد من قِدم ما كتبته عملية أخرى
+user_cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+# خرائط تفضيلات AgentMemory لكل مستخدم، مع أقفال موزعة على المستخدمين
+AGENT_MEMORY_CACHE_SIZE = _env_int("AGENT_MEMORY_CACHE_SIZE", 2048)
+AGENT_MEMORY_CACHE_TTL = _env_float("AGENT_MEMORY_CACHE_TTL", 600)
+
+agent_memory_cache = LRUCache(AGENT_MEMORY_CACHE_SIZE, AGENT_MEMORY_CACHE_TTL)
+agent_memory_locks = [threading.Lock() for _ in range(64)]
+
+def get_user_profile(user_id: str) -> Optional[Dict[str, str]]:
+    """ملف المستخدم (id, name, email, role) من الذاكرة أو من جدول users عند الغياب"""
+    profile = user_cache.get(user_id)
+    if profile is not None:
+        return profile
+
+    with db_connection() as conn:
+        row = conn.execute('SELECT id, name, email, role FROM users WHERE id = ?', (user_id,)).fetchone()
+    if row is None:
+        return None
+    profile = dict(row)
+    user_cache.set(user_id, profile)
+    return profile
+
+def save_user_profile(user_id: str, name: str, email: str, role: str, replace: bool = True) -> Dict[str, str]:
+    """كتابة المستخدم في users ثم في الذاكرة (Write-through)"""
+    sql = 'INSERT OR REPLACE INTO users (id, name, email, role) VALUES (?, ?, ?, ?)' if replace \
+        else 'INSERT OR IGNORE INTO users (id, name, email, role) VALUES (?, ?, ?, ?)'
+    with db_connection() as conn:
+        inserted = conn.execute(sql, (user_id, name, email, role)).rowcount
+        conn.commit()
+
+    profile = {'id': user_id, 'name': name, 'email': email, 'role': role}
+    if inserted:
+        user_cache.set(user_id, profile)
+    else:
+        # الصف موجود مسبقاً بقيم قد تختلف - يُقرأ من القاعدة عند الطلب التالي
+        user_cache.delete(user_id)
+    return profile
+
+# آخر نشاط يُكتب مرة كل USER_ACTIVITY_INTERVAL على الأكثر لكل مستخدم، عبر طابور الكتابة
+USER_ACTIVITY_INTERVAL = _env_float("USER_ACTIVITY_INTERVAL", 3600)
+user_activity_cache = LRUCache(USER_CACHE_SIZE, USER_ACTIVITY_INTERVAL)
+
+def touch_user_activity(user_id: str):
+    """تحديث users.last_active_at - يمنع انتهاء حساب ضيف ما زال يستخدم التطبيق"""
+    if user_activity_cache.get(user_id):
+        return
+    user_activity_cache.set(user_id, True)
+    db_writer.enqueue('UPDATE users SET last_active_at = CURRENT_TIMESTAMP WHERE id = ?', (user_id,))
+
+@app.before_request
+def track_user_activity():
+    if 'user_id' in session:
+        touch_user_activity(session['user_id'])
+
+# =============================================================================
+# سياسات الاحتفاظ بالبيانات والضغط (Retention / Compaction)
+# =============================================================================
+
+# المهمة تبدأ عند استيراد التطبيق (Vercel يستورد app.py ولا يشغله)؛ أدوات القياس
+# والصيانة التي تستورد app يجب أن تضبط RETENTION_ENABLED=false قبل الاستيراد
+RETENTION_ENABLED = os.getenv("RETENTION_ENABLED", "true").lower() not in ("0", "false", "no")
+# عدد الأيام لكل جدول؛ 0 = الاحتفاظ إلى الأبد
+RETENTION_POLICIES = {
+    "searches": _env_int("RETENTION_SEARCHES_DAYS", 30),
+    "agent_notifications": _env_int("RETENTION_NOTIFICATIONS_DAYS", 90),
+    "conversations": _env_int("RETENTION_CONVERSATIONS_DAYS", 0),
+    "uploaded_files": _env_int("RETENTION_UPLOADS_DAYS", 0),
+    "price_tracking": _env_int("RETENTION_PRICE_TRACKING_DAYS", 90),
+    # حذف حسابات الضيوف غير النشطة مع كل بياناتهم - اختياري
+    "guest_users": _env_int("RETENTION_GUEST_DAYS", 0)
+}
+RETENTION_INTERVAL = _env_float("RETENTION_INTERVAL_HOURS", 6) * 3600
+RETENTION_INITIAL_DELAY = _env_float("RETENTION_INITIAL_DELAY", 60)
+RETENTION_BATCH_SIZE = max(1, _env_int("RETENTION_BATCH_SIZE", 500))
+# استراحة بين الدفعات لتحرير قفل الكتابة للطلبات
+RETENTION_BATCH_PAUSE = _env_float("RETENTION_BATCH_PAUSE_MS", 20) / 1000
+RETENTION_VACUUM_PAGES = _env_int("RETENTION_VACUUM_PAGES", 2000)
+
+# حذف دفعة من الصفوف الأقدم من التاريخ المحدد؛ كل عمود تاريخ له فهرس
+RETENTION_DELETES = {
+    "searches": 'DELETE FROM searches WHERE rowid IN (SELECT rowid FROM searches WHERE created_at < ? LIMIT ?)',
+    "agent_notifications": 'DELETE FROM agent_notifications WHERE rowid IN (SELECT rowid FROM agent_notifications WHERE created_at < ? LIMIT ?)',
+    "conversations": 'DELETE FROM conversations WHERE rowid IN (SELECT rowid FROM conversations WHERE created_at < ? LIMIT ?)',
+    "uploaded_files": 'DELETE FROM uploaded_files WHERE rowid IN (SELECT rowid FROM uploaded_files WHERE uploaded_at < ? LIMIT ?)',
+    "price_tracking": 'DELETE FROM price_tracking WHERE rowid IN (SELECT rowid FROM price_tracking WHERE checked_at < ? LIMIT ?)'
+}
 
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS agent_notifications (
-            id TEXT PRIMARY KEY,
-            user_id TEXT,
-            title TEXT,
-            message TEXT,
-            is_read BOOLEAN DEFAULT FALSE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
+# جداول بيانات المستخدم التي تُحذف مع حساب الضيف المنتهي
+GUEST_DATA_TABLES = ("conversations", "uploaded_files", "searches", "agent_tasks",
+                     "agent_memory", "agent_notifications", "price_tracking")
 
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS price_tracking (
-            id TEXT PRIMARY KEY,
-            user_id TEXT,
-            topic TEXT,
-            price_info TEXT,
-            checked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
+RETENTION_ROWS = metrics.register(Counter(
+    "clainai_retention_deleted_rows_total", "Rows deleted by retention policies", ("policy",)))
+RETENTION_BYTES = metrics.register(Counter(
+    "clainai_retention_reclaimed_bytes_total", "Database bytes reclaimed by incremental vacuum"))
+
+def retention_cutoff(days: int) -> str:
+    """التاريخ الحدي بنفس صيغة أعمدة التاريخ (db_timestamp)"""
+    return db_timestamp(datetime.utcnow() - timedelta(days=days))
+
+def _delete_in_batches(sql: str, cutoff: str, pool: ConnectionPool = None) -> int:
+    deleted = 0
+    while True:
+        with db_connection(pool) as conn:
+            count = conn.execute(sql, (cutoff, RETENTION_BATCH_SIZE)).rowcount
+            conn.commit()
+        deleted += count
+        if count < RETENTION_BATCH_SIZE:
+            return deleted
+        time.sleep(RETENTION_BATCH_PAUSE)
+
+def _delete_expired_guests(cutoff: str) -> int:
+    """حذف حسابات الضيوف التي لم تنشط منذ المدة مع كل بياناتهم، دفعة بعد دفعة"""
+    deleted = 0
+    while True:
+        with db_connection() as conn:
+            # 'guest_' <= id < 'guest`' نطاق على المفتاح الأساسي بدلاً من LIKE
+            guest_ids = [row["id"] for row in conn.execute(
+                "SELECT id FROM users WHERE id >= 'guest_' AND id < 'guest`' "
+                "AND COALESCE(last_active_at, created_at) < ? LIMIT ?",
+                (cutoff, RETENTION_BATCH_SIZE)
+            )]
+        if not guest_ids:
+            return deleted
+
+        # بيانات الأقسام أولاً: إن انقطع الحذف تبقى الحسابات فتُعاد في الدورة التالية
+        ids_by_pool: Dict[ConnectionPool, List[str]] = {}
+        for guest_id in guest_ids:
+            ids_by_pool.setdefault(user_db_pool(guest_id), []).append(guest_id)
+        for pool, ids in ids_by_pool.items():
+            placeholders = ",".join("?" * len(ids))
+            with db_connection(pool) as conn:
+                for table in GUEST_DATA_TABLES:
+                    if table in SHARDED_TABLES:
+                        conn.execute(f"DELETE FROM {table} WHERE user_id IN ({placeholders})", ids)
+                conn.commit()
+
+        placeholders = ",".join("?" * len(guest_ids))
+        with db_connection() as conn:
+            for table in GUEST_DATA_TABLES:
+                if table not in SHARDED_TABLES:
+                    conn.execute(f"DELETE FROM {table} WHERE user_id IN ({placeholders})", guest_ids)
+            conn.execute(f"DELETE FROM users WHERE id IN ({placeholders})", guest_ids)
+            conn.commit()
+        for guest_id in guest_ids:
+            user_cache.delete(guest_id)
+            user_activity_cache.delete(guest_id)
+            agent_memory_cache.delete(guest_id)
+        deleted += len(guest_ids)
+        if len(guest_ids) < RETENTION_BATCH_SIZE:
+            return deleted
+        time.sleep(RETENTION_BATCH_PAUSE)
+
+def _compact_search_results() -> int:
+    """تحويل نتائج البحث المخزنة كرد Serper خام (قبل الضغط) إلى النتائج المعروضة فقط"""
+    compacted = 0
+    last_rowid = 0
+    while True:
+        with db_connection() as conn:
+            rows = conn.execute(
+                "SELECT rowid, results FROM searches WHERE rowid > ? AND substr(results, 1, 1) = '{' "
+                "ORDER BY rowid LIMIT ?",
+                (last_rowid, RETENTION_BATCH_SIZE)
+            ).fetchall()
+            if not rows:
+                return compacted
+            updates = []
+            for row in rows:
+                try:
+                    organic = json.loads(row["results"]).get("organic", [])[:5]
+                except (ValueError, AttributeError):
+                    organic = []
+                compact = [{'title': item.get('title', ''), 'link': item.get('link', ''),
+                            'snippet': item.get('snippet', '')} for item in organic]
+                updates.append((json.dumps(compact, ensure_ascii=False, separators=(",", ":")), row["rowid"]))
+            conn.executemany('UPDATE searches SET results = ? WHERE rowid = ?', updates)
+            conn.commit()
+        compacted += len(rows)
+        last_rowid = rows[-1]["rowid"]
+        time.sleep(RETENTION_BATCH_PAUSE)
+
+def _database_size(conn) -> Dict[str, int]:
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    return {
+        "page_size": page_size,
+        "pages": conn.execute("PRAGMA page_count").fetchone()[0],
+        "free_pages": conn.execute("PRAGMA freelist_count").fetchone()[0]
+    }
+
+def incremental_vacuum(pool: ConnectionPool = None) -> Dict[str, Any]:
+    """إعادة الصفحات الحرة إلى نظام الملفات على دفعات صغيرة"""
+    with db_connection(pool) as conn:
+        before = _database_size(conn)
+        auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        if auto_vacuum != 2:
+            # القواعد المنشأة قبل تفعيل auto_vacuum تحتاج VACUUM كاملاً مرة واحدة (يدوياً)
+            return {"reclaimed_bytes": 0, "free_pages": before["free_pages"],
+                    "note": "auto_vacuum is not INCREMENTAL; run VACUUM once to enable it"}
+
+        remaining = before["free_pages"]
+        while remaining > 0:
+            # execute() في sqlite3 يخطو مرة واحدة فيحرر صفحة واحدة فقط؛ executescript ينفذ حتى النهاية
+            conn.executescript(f"PRAGMA incremental_vacuum({RETENTION_VACUUM_PAGES});")
+            freed = remaining - conn.execute("PRAGMA freelist_count").fetchone()[0]
+            remaining -= freed
+            if remaining > 0 and freed > 0:
+                time.sleep(RETENTION_BATCH_PAUSE)
+            elif freed <= 0:
+                break
+        after = _database_size(conn)
+
+    reclaimed = (before["pages"] - after["pages"]) * before["page_size"]
+    RETENTION_BYTES.inc(amount=reclaimed)
+    return {"reclaimed_bytes": reclaimed, "free_pages": after["free_pages"],
+            "size_bytes": after["pages"] * after["page_size"]}
+
+retention_report: Dict[str, Any] = {}
+
+def run_retention() -> Dict[str, Any]:
+    """تطبيق كل السياسات ثم الضغط؛ يعيد تقريراً بعدد الصفوف والبايتات المستعادة"""
+    started = time.monotonic()
+    # ما زال في طابور الكتابة يُثبت أولاً حتى لا يفلت من الحذف
+    flush_writes()
+
+    deleted: Dict[str, int] = {}
+    for policy, days in RETENTION_POLICIES.items():
+        if days <= 0:
+            continue
+        try:
+            cutoff = retention_cutoff(days)
+            if policy == "guest_users":
+                count = _delete_expired_guests(cutoff)
+            else:
+                pools = shard_pools if policy in SHARDED_TABLES else [db_pool]
+                count = sum(_delete_in_batches(RETENTION_DELETES[policy], cutoff, pool) for pool in pools)
+            deleted[policy] = count
+            RETENTION_ROWS.inc(policy, amount=count)
+        except Exception as e:
+            print(f"❌ خطأ في سياسة الاحتفاظ {policy}: {e}")
+
+    try:
+        compacted = _compact_search_results()
+    except Exception as e:
+        compacted = 0
+        print(f"❌ خطأ في ضغط نتائج البحث: {e}")
+
+    if deleted.get("conversations") or deleted.get("guest_users"):
+        try:
+            # دمج مقاطع فهرس البحث بعد الحذف
+            for pool in shard_pools:
+                with db_connection(pool) as conn:
+                    conn.execute("INSERT INTO conversations_fts (conversations_fts) VALUES ('optimize')")
+                    conn.commit()
+        except Exception as e:
+            print(f"⚠️ تعذر تحسين فهرس البحث: {e}")
+
+    # كل ملف قاعدة بيانات يُضغط على حدة والنتيجة مجموعها
+    vacuum = {"reclaimed_bytes": 0, "free_pages": 0, "size_bytes": 0}
+    for pool in all_db_pools:
+        result = incremental_vacuum(pool)
+        for key in vacuum:
+            vacuum[key] += result.get(key, 0)
+        if "note" in result:
+            vacuum["note"] = result["note"]
+
+    report = {"deleted": deleted, "compacted_searches": compacted, **vacuum,
+              "duration_seconds": round(time.monotonic() - started, 3),
+              "finished_at": datetime.now().isoformat()}
+    retention_report.clear()
+    retention_report.update(report)
+    print(f"🧹 الاحتفاظ بالبيانات: حذف {sum(deleted.values())} صف، استعادة {report['reclaimed_bytes']} بايت")
+    return report
+
+def _retention_loop():
+    time.sleep(RETENTION_INITIAL_DELAY)
+    while True:
+        try:
+            run_retention()
+        except Exception as e:
+            print(f"❌ خطأ في مهمة الاحتفاظ بالبيانات: {e}")
+        time.sleep(RETENTION_INTERVAL)
 
-    conn.commit()
-    conn.close()
-    print("✅ تم إنشاء قاعدة البيانات بنجاح مع جداول الوكيل الذكي")
+if RETENTION_ENABLED:
+    threading.Thread(target=_retention_loop, name="clainai-retention", daemon=True).start()
 
 # CORS headers
 @app.after_request
@@ -777,10 +3069,12 @@ def manifest():
 @app.route("/api/health")
 def health_check():
     try:
-        init_db()
+        with db_connection() as conn:
+            schema_version = get_schema_version(conn)
         return jsonify({
             "status": "healthy",
             "database": "connected",
+            "schema_version": schema_version,
             "message": "✅ ClainAI is working perfectly!",
             "timestamp": datetime.now().isoformat(),
             "base_url": BASE_URL,
@@ -870,15 +3164,8 @@ def check_tables():
 @app.route("/api/guest-login", methods=["POST", "GET"])
 def guest_login():
     try:
-        init_db()
         user_id = f"guest_{secrets.token_hex(8)}"
-        conn = get_db_connection()
-        conn.execute(
-            'INSERT OR IGNORE INTO users (id, name, email, role) VALUES (?, ?, ?, ?)',
-            (user_id, 'ضيف', f'guest_{user_id}@clainai.com', 'user')
-        )
-        conn.commit()
-        conn.close()
+        save_user_profile(user_id, 'ضيف', f'guest_{user_id}@clainai.com', 'user', replace=False)
         session['user_id'] = user_id
         session['user_name'] = 'ضيف'
         session['user_role'] = 'user'
@@ -940,7 +3227,7 @@ def google_callback():
             'redirect_uri': GOOGLE_REDIRECT_URI
         }
 
-        token_response = requests.post(token_url, data=token_data)
+        token_response = provider_post("oauth", token_url, data=token_data)
         token_json = token_response.json()
 
         if 'error' in token_json:
@@ -951,20 +3238,12 @@ def google_callback():
         # Get user info
         user_info_url = "https://www.googleapis.com/oauth2/v2/userinfo"
         headers = {'Authorization': f'Bearer {access_token}'}
-        user_response = requests.get(user_info_url, headers=headers)
+        user_response = provider_get("oauth", user_info_url, headers=headers)
         user_info = user_response.json()
 
         # Create or get user
-        init_db()
         user_id = f"google_{user_info['id']}"
-        conn = get_db_connection()
-
-        conn.execute(
-            'INSERT OR REPLACE INTO users (id, name, email, role) VALUES (?, ?, ?, ?)',
-            (user_id, user_info.get('name', 'User'), user_info.get('email', ''), 'user')
-        )
-        conn.commit()
-        conn.close()
+        save_user_profile(user_id, user_info.get('name', 'User'), user_info.get('email', ''), 'user')
 
         # Set session
         session['user_id'] = user_id
@@ -995,7 +3274,7 @@ def github_callback():
             'code': code
         }
         headers = {'Accept': 'application/json'}
-        token_response = requests.post(token_url, data=token_data, headers=headers)
+        token_response = provider_post("oauth", token_url, data=token_data, headers=headers)
         token_json = token_response.json()
 
         if 'error' in token_json:
@@ -1006,26 +3285,18 @@ def github_callback():
         # Get user info
         user_info_url = "https://api.github.com/user"
         headers = {'Authorization': f'token {access_token}'}
-        user_response = requests.get(user_info_url, headers=headers)
+        user_response = provider_get("oauth", user_info_url, headers=headers)
         user_info = user_response.json()
 
         # Get email (if available)
         email_url = "https://api.github.com/user/emails"
-        email_response = requests.get(email_url, headers=headers)
+        email_response = provider_get("oauth", email_url, headers=headers)
         emails = email_response.json()
         primary_email = next((email['email'] for email in emails if email['primary']), '')
 
         # Create or get user
-        init_db()
         user_id = f"github_{user_info['id']}"
-        conn = get_db_connection()
-
-        conn.execute(
-            'INSERT OR REPLACE INTO users (id, name, email, role) VALUES (?, ?, ?, ?)',
-            (user_id, user_info.get('name', user_info.get('login', 'User')), primary_email, 'user')
-        )
-        conn.commit()
-        conn.close()
+        save_user_profile(user_id, user_info.get('name', user_info.get('login', 'User')), primary_email, 'user')
 
         # Set session
         session['user_id'] = user_id
@@ -1048,13 +3319,7 @@ def get_user():
                 'is_logged_in': False
             }), 401
 
-        user_id = session['user_id']
-        conn = get_db_connection()
-        user = conn.execute(
-            'SELECT id, name, email, role FROM users WHERE id = ?',
-            (user_id,)
-        ).fetchone()
-        conn.close()
+        user = get_user_profile(session['user_id'])
 
         if user:
             return jsonify({
@@ -1092,6 +3357,52 @@ def logout():
 # =============================================================================
 # Routes المحادثة والملفات
 # =============================================================================
+DEVELOPER_INFO = "🤖 **معلومات المطور:**\n\n✅ تم تطويري بواسطة **المهندس السوداني محمد عبد القادر السراج**\n🎓 **المؤهلات:**\n• خريج جامعة العلوم وتقانة المعلومات (IT)\n• خريج تكنولوجيا المعلومات والاتصالات (ICT)\n📧 **البريد الإلكتروني:** mohammedu3615@gmail.com\n\nأعمل دائماً على تطوير وتحسين أدائي لخدمة المستخدمين العرب بأفضل صورة! 💪"
+SEARCH_NOTE = "\n\n🔍 *تم دمج معلومات من البحث على الإنترنت*"
+
+def is_developer_question(message: str) -> bool:
+    return "developer" in match_keywords(message)
+
+def get_search_context(message: str) -> str:
+    """جمع أهم نتائج البحث لدمجها مع السؤال"""
+    search_context = ""
+    if not SERPER_API_KEY:
+        return search_context
+    try:
+        print("🔍 جاري البحث على الإنترنت...")
+        search_response = serper_post("search", {'q': message})
+
+        if search_response.status_code == 200:
+            search_data = search_response.json()
+            if 'organic' in search_data and search_data['organic']:
+                top_results = search_data['organic'][:3]
+                search_context = "\n\n🔍 **معلومات من البحث على الإنترنت:**\n"
+                for i, result in enumerate(top_results, 1):
+                    search_context += f"{i}. **{result.get('title', '')}**: {result.get('snippet', '')}\n"
+                print("✅ تم جمع معلومات من البحث")
+        else:
+            print(f"❌ فشل البحث: {search_response.status_code}")
+    except Exception as search_error:
+        print(f"🔍 خطأ في البحث: {search_error}")
+    return search_context
+
+def save_conversation(user_id: str, message: str, reply: str, model_used: str) -> str:
+    """حفظ المحادثة في قاعدة البيانات"""
+    return save_conversations(user_id, [(message, reply, model_used)])[0]
+
+def save_conversations(user_id: str, items: List[tuple]) -> List[str]:
+    """حفظ عدة محادثات (message, reply, model_used) عبر طابور الكتابة كوحدة واحدة:
+    تُثبت كلها في معاملة واحدة أو لا يُثبت منها شيء"""
+    rows = [
+        (new_id(), user_id, message, reply, model_used)
+        for message, reply, model_used in items
+    ]
+    user_db_writer(user_id).enqueue_many(
+        'INSERT INTO conversations (id, user_id, message, reply, model_used) VALUES (?, ?, ?, ?, ?)',
+        rows
+    )
+    return [row[0] for row in rows]
+
 @app.route("/api/chat", methods=["POST"])
 def chat():
     """المحادثة الرئيسية مع دعم الوكيل الذكي"""
@@ -1107,51 +3418,24 @@ def chat():
             return jsonify({'success': False, 'error': 'الرسالة فارغة'}), 400
 
         user_id = session['user_id']
+        limited = check_user_rate_limit(user_id)
+        if limited:
+            return limited
+
         print(f"📩 رسالة مستلمة من {user_id}: {message}")
 
         # ======== التحقق إذا كان السؤال عن المطور ========
-        developer_keywords = ['مطور', 'مبرمج', 'صاحب', 'خالق', 'من صنع', 'who made you', 'developer', 'creator']
-        message_lower = message.lower()
-        if any(keyword in message_lower for keyword in developer_keywords):
-            developer_info = "🤖 **معلومات المطور:**\n\n✅ تم تطويري بواسطة **المهندس السوداني محمد عبد القادر السراج**\n🎓 **المؤهلات:**\n• خريج جامعة العلوم وتقانة المعلومات (IT)\n• خريج تكنولوجيا المعلومات والاتصالات (ICT)\n📧 **البريد الإلكتروني:** mohammedu3615@gmail.com\n\nأعمل دائماً على تطوير وتحسين أدائي لخدمة المستخدمين العرب بأفضل صورة! 💪"
-
-            conversation_id = hashlib.md5(f"{user_id}_{message}_{datetime.now().timestamp()}".encode()).hexdigest()
-            conn = get_db_connection()
-            conn.execute(
-                'INSERT INTO conversations (id, user_id, message, reply, model_used) VALUES (?, ?, ?, ?, ?)',
-                (conversation_id, user_id, message, developer_info, "developer_info")
-            )
-            conn.commit()
-            conn.close()
+        if is_developer_question(message):
+            save_conversation(user_id, message, DEVELOPER_INFO, "developer_info")
 
             return jsonify({
                 'success': True,
-                'reply': developer_info,
+                'reply': DEVELOPER_INFO,
                 'model_used': 'developer_info'
             })
 
         # ======== البحث على الإنترنت إذا طلب المستخدم ========
-        search_context = ""
-        if use_search and SERPER_API_KEY:
-            try:
-                print("🔍 جاري البحث على الإنترنت...")
-                search_url = "https://google.serper.dev/search"
-                headers = {'X-API-KEY': SERPER_API_KEY, 'Content-Type': 'application/json'}
-                payload = {'q': message}
-                search_response = requests.post(search_url, headers=headers, json=payload, timeout=15)
-
-                if search_response.status_code == 200:
-                    search_data = response.json()
-                    if 'organic' in search_data and search_data['organic']:
-                        top_results = search_data['organic'][:3]
-                        search_context = "\n\n🔍 **معلومات من البحث على الإنترنت:**\n"
-                        for i, result in enumerate(top_results, 1):
-                            search_context += f"{i}. **{result.get('title', '')}**: {result.get('snippet', '')}\n"
-                        print("✅ تم جمع معلومات من البحث")
-                else:
-                    print(f"❌ فشل البحث: {search_response.status_code}")
-            except Exception as search_error:
-                print(f"🔍 خطأ في البحث: {search_error}")
+        search_context = get_search_context(message) if use_search else ""
 
         # ======== استخدام النماذج الذكية المتقدمة للحصول على رد ========
         print("🔄 جاري الحصول على رد ذكي من النماذج المتاحة...")
@@ -1159,17 +3443,10 @@ def chat():
 
         # إضافة علامة إذا تم استخدام البحث
         if search_context:
-            ai_reply += "\n\n🔍 *تم دمج معلومات من البحث على الإنترنت*"
+            ai_reply += SEARCH_NOTE
 
         # حفظ المحادثة في قاعدة البيانات
-        conversation_id = hashlib.md5(f"{user_id}_{message}_{datetime.now().timestamp()}".encode()).hexdigest()
-        conn = get_db_connection()
-        conn.execute(
-            'INSERT INTO conversations (id, user_id, message, reply, model_used) VALUES (?, ?, ?, ?, ?)',
-            (conversation_id, user_id, message, ai_reply, model_used)
-        )
-        conn.commit()
-        conn.close()
+        save_conversation(user_id, message, ai_reply, model_used)
 
         print(f"✅ تم إرسال الرد باستخدام {model_used}")
 
@@ -1189,6 +3466,169 @@ def chat():
             'reply': 'عذراً، حدث خطأ في المعالجة. يرجى المحاولة مرة أخرى.'
         }), 500
 
+BATCH_MAX_ITEMS = _env_int("BATCH_MAX_ITEMS", 50)
+if BATCH_MAX_ITEMS > USER_BATCH_RATE_BURST:
+    # دفعة أكبر من سعة دلو الدفعات تُرفض دائماً بـ 413 - الحد الفعلي هو السعة
+    print(f"⚠️ BATCH_MAX_ITEMS ({BATCH_MAX_ITEMS}) أكبر من USER_BATCH_RATE_BURST - تم تقليله")
+    BATCH_MAX_ITEMS = int(USER_BATCH_RATE_BURST)
+BATCH_MAX_WORKERS = _env_int("BATCH_MAX_WORKERS", 8)
+
+# مجمع عمال مشترك لكل طلبات الدفعات حتى يبقى التوازي الكلي محدوداً
+_batch_executor = ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS, thread_name_prefix="chat-batch")
+
+def run_batch_item(message: str) -> Dict[str, Any]:
+    """معالجة رسالة واحدة من الدفعة وقياس زمنها"""
+    started = time.monotonic()
+    try:
+        if is_developer_question(message):
+            reply, model_used = DEVELOPER_INFO, "developer_info"
+        else:
+            reply, model_used = get_smart_response(message)
+        return {
+            'success': True,
+            'message': message,
+            'reply': reply,
+            'model_used': model_used,
+            'model_name': AI_MODELS.get(model_used, {}).get('name', 'النظام الذكي'),
+            'latency_ms': round((time.monotonic() - started) * 1000, 1)
+        }
+    except Exception as e:
+        print(f"❌ خطأ في عنصر الدفعة: {str(e)}")
+        return {
+            'success': False,
+            'message': message,
+            'error': str(e),
+            'latency_ms': round((time.monotonic() - started) * 1000, 1)
+        }
+
+@app.route("/api/chat/batch", methods=["POST"])
+def chat_batch():
+    """معالجة قائمة رسائل بالتوازي وإرجاع النتائج بنفس الترتيب"""
+    try:
+        if 'user_id' not in session:
+            return jsonify({'success': False, 'error': 'غير مسجل الدخول'}), 401
+
+        data = request.json or {}
+        messages = data.get('messages')
+
+        if not isinstance(messages, list) or not messages:
+            return jsonify({'success': False, 'error': 'قائمة الرسائل فارغة'}), 400
+        if len(messages) > BATCH_MAX_ITEMS:
+            return jsonify({'success': False, 'error': f'الحد الأقصى {BATCH_MAX_ITEMS} رسالة في الدفعة'}), 400
+
+        # كل عنصر يجب أن يكون نصاً غير فارغ - لا تحويل لـ null أو الكائنات إلى نص
+        errors = []
+        for index, message in enumerate(messages):
+            if not isinstance(message, str):
+                errors.append({'index': index, 'error': 'الرسالة يجب أن تكون نصاً'})
+            elif not message.strip():
+                errors.append({'index': index, 'error': 'الرسالة فارغة'})
+        if errors:
+            return jsonify({'success': False, 'error': 'توجد رسائل غير صالحة في الدفعة', 'errors': errors}), 400
+
+        messages = [message.strip() for message in messages]
+
+        user_id = session['user_id']
+        limited = check_user_rate_limit(user_id, cost=len(messages), limiter=batch_rate_limiter)
+        if limited:
+            return limited
+
+        print(f"📦 دفعة من {len(messages)} رسالة من {user_id}")
+        started = time.monotonic()
+
+        results = list(_batch_executor.map(run_batch_item, messages))
+
+        # حفظ كل المحادثات الناجحة في معاملة واحدة
+        succeeded = [result for result in results if result['success']]
+        if succeeded:
+            conversation_ids = save_conversations(
+                user_id,
+                [(result['message'], result['reply'], result['model_used']) for result in succeeded]
+            )
+            for result, conversation_id in zip(succeeded, conversation_ids):
+                result['conversation_id'] = conversation_id
+
+        for index, result in enumerate(results):
+            result['index'] = index
+
+        return jsonify({
+            'success': True,
+            'results': results,
+            'total': len(results),
+            'failed': len(results) - len(succeeded),
+            'latency_ms': round((time.monotonic() - started) * 1000, 1)
+        })
+
+    except Exception as e:
+        print(f"❌ خطأ في دفعة المحادثة: {str(e)}")
+        return jsonify({'success': False, 'error': f'حدث خطأ: {str(e)}'}), 500
+
+def sse_event(event: str, data: Dict[str, Any], event_id: str = None) -> str:
+    """تنسيق حدث Server-Sent Events - المعرف يعود في Last-Event-ID عند إعادة الاتصال"""
+    prefix = f"id: {event_id}\n" if event_id else ""
+    return f"{prefix}event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route("/api/chat/stream", methods=["POST"])
+def chat_stream():
+    """المحادثة مع بث الرد تدريجياً عبر Server-Sent Events"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'غير مسجل الدخول'}), 401
+
+    data = request.json or {}
+    message = data.get('message', '').strip()
+    use_search = data.get('use_search', False)
+
+    if not message:
+        return jsonify({'success': False, 'error': 'الرسالة فارغة'}), 400
+
+    user_id = session['user_id']
+    limited = check_user_rate_limit(user_id)
+    if limited:
+        return limited
+
+    print(f"📩 رسالة بث مستلمة من {user_id}: {message}")
+
+    def generate():
+        try:
+            if is_developer_question(message):
+                yield sse_event("meta", {'model_used': 'developer_info', 'model_name': 'النظام الذكي'})
+                yield sse_event("token", {'text': DEVELOPER_INFO})
+                save_conversation(user_id, message, DEVELOPER_INFO, "developer_info")
+                yield sse_event("done", {'model_used': 'developer_info', 'used_search': False})
+                return
+
+            search_context = get_search_context(message) if use_search else ""
+
+            chunks = []
+            model_used = None
+            for model_type, chunk in stream_smart_response(message + search_context):
+                if model_used is None:
+                    model_used = model_type
+                    yield sse_event("meta", {
+                        'model_used': model_type,
+                        'model_name': AI_MODELS.get(model_type, {}).get('name', 'النظام الذكي')
+                    })
+                chunks.append(chunk)
+                yield sse_event("token", {'text': chunk})
+
+            if search_context:
+                chunks.append(SEARCH_NOTE)
+                yield sse_event("token", {'text': SEARCH_NOTE})
+
+            # حفظ المحادثة بعد اكتمال البث
+            save_conversation(user_id, message, "".join(chunks), model_used)
+            print(f"✅ تم بث الرد باستخدام {model_used}")
+            yield sse_event("done", {'model_used': model_used, 'used_search': bool(search_context)})
+
+        except Exception as e:
+            print(f"❌ خطأ في بث المحادثة: {str(e)}")
+            yield sse_event("error", {'error': f'حدث خطأ: {str(e)}'})
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 @app.route("/api/clear", methods=["POST"])
 def clear_conversations():
     try:
@@ -1196,7 +3636,10 @@ def clear_conversations():
             return jsonify({'success': False, 'error': 'غير مسجل الدخول'}), 401
 
         user_id = session['user_id']
-        conn = get_db_connection()
+        # الرسائل المعلقة في طابور الكتابة يجب أن تُحذف أيضاً - وإلا تعود بعد المسح
+        if not flush_writes(user_id):
+            return jsonify({'success': False, 'error': 'الخادم مشغول بحفظ الرسائل، يرجى المحاولة مرة أخرى'}), 503
+        conn = get_user_db_connection(user_id)
         conn.execute('DELETE FROM conversations WHERE user_id = ?', (user_id,))
         conn.commit()
         conn.close()
@@ -1205,8 +3648,28 @@ def clear_conversations():
     except Exception as e:
         return jsonify({'success': False, 'error': f'حدث خطأ: {str(e)}'}), 500
 
+HISTORY_PAGE_SIZE = _env_int("HISTORY_PAGE_SIZE", 50)
+HISTORY_MAX_PAGE_SIZE = _env_int("HISTORY_MAX_PAGE_SIZE", 200)
+
+def encode_history_cursor(created_at: str, conversation_id: str) -> str:
+    """مؤشر صفحات معتم يمثل الموضع (created_at, id)"""
+    return base64.urlsafe_b64encode(f"{created_at}|{conversation_id}".encode()).decode().rstrip("=")
+
+def decode_history_cursor(cursor: str) -> tuple:
+    padded = cursor + "=" * (-len(cursor) % 4)
+    created_at, separator, conversation_id = base64.urlsafe_b64decode(padded.encode()).decode().partition("|")
+    if not separator or not created_at or not conversation_id:
+        raise ValueError("invalid cursor")
+    return created_at, conversation_id
+
 @app.route("/api/history", methods=["GET"])
 def get_history():
+    """سجل المحادثات بصفحات (keyset) على (created_at, id).
+
+    - بدون مؤشر: أحدث صفحة
+    - before=<cursor>: الصفحة الأقدم من المؤشر (للتمرير للأعلى)
+    - since=<cursor>: ما أضيف بعد المؤشر (مزامنة تدريجية)
+    """
     try:
         if 'user_id' not in session:
             return jsonify({
@@ -1216,44 +3679,73 @@ def get_history():
             }), 401
 
         user_id = session['user_id']
-        conn = get_db_connection()
-
-        # تحقق إذا كان الجدول موجود
-        table_exists = conn.execute(
-            "SELECT name FROM sqlite_master WHERE type='table' AND name='conversations'"
-        ).fetchone()
+        limit = min(max(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), 1), HISTORY_MAX_PAGE_SIZE)
+        before = request.args.get('before')
+        since = request.args.get('since')
+        if before and since:
+            return jsonify({'success': False, 'error': 'استخدم before أو since وليس كليهما', 'messages': []}), 400
 
-        if not table_exists:
-            conn.close()
-            return jsonify({
-                'success': True,
-                'messages': [],
-                'note': 'لا توجد محادثات سابقة'
-            })
+        try:
+            cursor = decode_history_cursor(before or since) if (before or since) else None
+        except (ValueError, UnicodeDecodeError, binascii.Error):
+            return jsonify({'success': False, 'error': 'مؤشر غير صالح', 'messages': []}), 400
+
+        # قراءة ما كتبه المستخدم للتو حتى لو كان ما زال في طابور الكتابة
+        flush_writes(user_id)
+
+        with user_db_connection(user_id) as conn:
+            if since:
+                rows = conn.execute(
+                    'SELECT id, message, reply, created_at FROM conversations '
+                    'WHERE user_id = ? AND (created_at, id) > (?, ?) '
+                    'ORDER BY created_at ASC, id ASC LIMIT ?',
+                    (user_id, cursor[0], cursor[1], limit + 1)
+                ).fetchall()
+            elif before:
+                rows = conn.execute(
+                    'SELECT id, message, reply, created_at FROM conversations '
+                    'WHERE user_id = ? AND (created_at, id) < (?, ?) '
+                    'ORDER BY created_at DESC, id DESC LIMIT ?',
+                    (user_id, cursor[0], cursor[1], limit + 1)
+                ).fetchall()
+            else:
+                rows = conn.execute(
+                    'SELECT id, message, reply, created_at FROM conversations '
+                    'WHERE user_id = ? ORDER BY created_at DESC, id DESC LIMIT ?',
+                    (user_id, limit + 1)
+                ).fetchall()
 
-        conversations = conn.execute(
-            'SELECT message, reply, created_at FROM conversations WHERE user_id = ? ORDER BY created_at ASC',
-            (user_id,)
-        ).fetchall()
-        conn.close()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if not since:
+            rows.reverse()  # الصفحة تُعرض بالترتيب الزمني
 
         messages = []
-        for conv in conversations:
+        for conv in rows:
             messages.append({
                 'role': 'user',
                 'content': conv['message'],
-                'timestamp': conv['created_at']
+                'timestamp': conv['created_at'],
+                'conversation_id': conv['id']
             })
             messages.append({
                 'role': 'assistant',
                 'content': conv['reply'],
-                'timestamp': conv['created_at']
+                'timestamp': conv['created_at'],
+                'conversation_id': conv['id']
             })
 
+        oldest = encode_history_cursor(rows[0]['created_at'], rows[0]['id']) if rows else None
+        newest = encode_history_cursor(rows[-1]['created_at'], rows[-1]['id']) if rows else since
+
         return jsonify({
             'success': True,
             'messages': messages,
-            'total_messages': len(messages)
+            'total_messages': len(messages),
+            'has_more': has_more,
+            # before=next_cursor للصفحة الأقدم، أو since=next_cursor لمتابعة المزامنة
+            'next_cursor': (newest if since else oldest) if has_more else None,
+            'sync_cursor': newest
         })
 
     except Exception as e:
@@ -1263,6 +3755,113 @@ def get_history():
             'messages': []
         }), 500
 
+HISTORY_SEARCH_MAX_OFFSET = _env_int("HISTORY_SEARCH_MAX_OFFSET", 1000)
+
+def fts_terms(query: str) -> List[str]:
+    """كلمات البحث بعد التوحيد - نفس ما يُفهرس في conversations_fts"""
+    return [term for term in normalize_arabic(query).split() if term.strip('"')]
+
+def build_fts_query(query: str, user_id: str) -> str:
+    """تحويل نص المستخدم إلى استعلام FTS5 آمن: كل كلمة بين علامتي تنصيص مع مطابقة البادئة،
+    مقيد بعمود user_id"""
+    terms = [term.replace('"', '""') for term in fts_terms(query)]
+    if not terms:
+        return ""
+    user_filter = user_id.replace('"', '""')
+    return f'user_id : "{user_filter}" AND {{message reply}} : (' + " ".join(f'"{term}"*' for term in terms) + ")"
+
+# كلمة = أحرف وأرقام مع التشكيل والتطويل (تُحذف عند التوحيد ولا تفصل الكلمة)
+SNIPPET_WORD = re.compile("(?:[^\\W_]|[" + "".join(source for source, target in ARABIC_FOLDS if not target) + "])+")
+
+def _fold_for_match(text: str) -> str:
+    """توحيد مطابق لـ unicode61 remove_diacritics: ARABIC_FOLDS ثم حذف العلامات المركبة"""
+    decomposed = unicodedata.normalize("NFKD", normalize_arabic(text))
+    return "".join(char for char in decomposed if not unicodedata.combining(char))
+
+def highlight_snippet(text: str, terms: List[str], max_words: int) -> str:
+    """
+    مقتطف من النص الأصلي (كما كتبه المستخدم) حول أول كلمة مطابقة.
+    النص يُهرب كـ HTML أولاً ثم تُضاف <mark> حول الكلمات التي تبدأ بإحدى كلمات البحث،
+    فيمكن عرض النتيجة كـ HTML بأمان.
+    """
+    if not text:
+        return ""
+    prefixes = tuple(_fold_for_match(term) for term in terms)
+    words = list(SNIPPET_WORD.finditer(text))
+    matched = [bool(prefixes) and _fold_for_match(word.group()).startswith(prefixes) for word in words]
+
+    first = matched.index(True) if True in matched else 0
+    start = max(0, min(first - max_words // 4, len(words) - max_words))
+    window = range(start, min(len(words), start + max_words))
+    if not window:
+        return html.escape(text)
+
+    # النص قبل أول كلمة وبعد آخر كلمة يبقى كما هو؛ الحذف داخل النص فقط يُعلَّم بـ …
+    parts = ["…"] if window[0] > 0 else []
+    position = words[window[0]].start() if window[0] > 0 else 0
+    for index in window:
+        word = words[index]
+        parts.append(html.escape(text[position:word.start()]))
+        escaped = html.escape(word.group())
+        parts.append(f"<mark>{escaped}</mark>" if matched[index] else escaped)
+        position = word.end()
+    parts.append("…" if window[-1] < len(words) - 1 else html.escape(text[position:]))
+    return "".join(parts)
+
+@app.route("/api/history/search", methods=["GET"])
+def search_history():
+    """بحث نصي في محادثات المستخدم مع ترتيب bm25 ومقتطفات مميزة"""
+    try:
+        if 'user_id' not in session:
+            return jsonify({'success': False, 'error': 'غير مسجل الدخول', 'results': []}), 401
+
+        user_id = session['user_id']
+        query = request.args.get('q', '')
+        match = build_fts_query(query, user_id)
+        if not match:
+            return jsonify({'success': False, 'error': 'يرجى إدخال كلمة للبحث', 'results': []}), 400
+
+        limit = min(max(request.args.get('limit', 20, type=int), 1), 50)
+        offset = min(max(request.args.get('offset', 0, type=int), 0), HISTORY_SEARCH_MAX_OFFSET)
+
+        flush_writes(user_id)
+
+        with user_db_connection(user_id) as conn:
+            rows = conn.execute(
+                'SELECT c.id, c.message, c.reply, c.created_at, '
+                'bm25(conversations_fts, 0, 0, 2.0, 1.0) AS score '
+                'FROM conversations_fts JOIN conversations c ON c.rowid = conversations_fts.rowid '
+                'WHERE conversations_fts MATCH ? AND conversations_fts.user_id = ? '
+                'ORDER BY score LIMIT ? OFFSET ?',
+                (match, user_id, limit + 1, offset)
+            ).fetchall()
+
+        has_more = len(rows) > limit
+        # المقتطفات من النص الأصلي لا من النسخة الموحدة في الفهرس، ومهربة HTML
+        terms = fts_terms(query)
+        results = [{
+            'conversation_id': row['id'],
+            'created_at': row['created_at'],
+            'message': row['message'],
+            'message_snippet': highlight_snippet(row['message'], terms, 12),
+            'reply_snippet': highlight_snippet(row['reply'], terms, 24),
+            'score': round(-row['score'], 4)
+        } for row in rows[:limit]]
+
+        return jsonify({
+            'success': True,
+            'query': query,
+            'results': results,
+            'has_more': has_more,
+            'next_offset': offset + limit if has_more and offset + limit <= HISTORY_SEARCH_MAX_OFFSET else None
+        })
+
+    except sqlite3.OperationalError as e:
+        print(f"❌ خطأ في البحث النصي: {e}")
+        return jsonify({'success': False, 'error': 'تعذر تنفيذ البحث', 'results': []}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e), 'results': []}), 500
+
 @app.route("/api/upload", methods=["POST"])
 def upload_file():
     try:
@@ -1277,7 +3876,7 @@ def upload_file():
             return jsonify({'success': False, 'error': 'لم يتم اختيار ملف'}), 400
 
         # حفظ الملف مؤقتاً ومعالجته
-        file_id = hashlib.md5(f"{session['user_id']}_{file.filename}_{datetime.now().timestamp()}".encode()).hexdigest()
+        file_id = new_id()
         file_extension = os.path.splitext(file.filename)[1].lower()
         file_content = ""
 
@@ -1313,7 +3912,7 @@ def upload_file():
         except Exception as processing_error:
             file_content = f"📎 ملف: {file.filename}\nالنوع: {file_extension}\nالحجم: {len(file.read())} bytes\nملاحظة: تعذر تحليل المحتوى بالكامل"
 
-        conn = get_db_connection()
+        conn = get_user_db_connection(session['user_id'])
         conn.execute(
             'INSERT INTO uploaded_files (id, user_id, filename, content, file_type) VALUES (?, ?, ?, ?, ?)',
             (file_id, session['user_id'], file.filename, file_content, file.content_type)
@@ -1354,29 +3953,12 @@ def search_web():
             }), 503
 
         # استخدام Serper API للبحث
-        search_url = "https://google.serper.dev/search"
-        headers = {
-            'X-API-KEY': SERPER_API_KEY,
-            'Content-Type': 'application/json'
-        }
-        payload = {'q': query}
-
-        response = requests.post(search_url, headers=headers, json=payload)
+        response = serper_post("search", {'q': query})
         if response.status_code != 200:
             return jsonify({'success': False, 'error': 'فشل في البحث'}), 500
 
         search_results = response.json()
 
-        # حفظ نتائج البحث
-        search_id = hashlib.md5(f"{session['user_id']}_{query}_{datetime.now().timestamp()}".encode()).hexdigest()
-        conn = get_db_connection()
-        conn.execute(
-            'INSERT INTO searches (id, user_id, query, results) VALUES (?, ?, ?, ?)',
-            (search_id, session['user_id'], query, json.dumps(search_results))
-        )
-        conn.commit()
-        conn.close()
-
         # تنسيق النتائج للعرض
         formatted_results = []
         if 'organic' in search_results:
@@ -1387,6 +3969,13 @@ def search_web():
                     'snippet': result.get('snippet', '')
                 })
 
+        # حفظ النتائج المعروضة فقط بدلاً من رد Serper الخام
+        search_id = new_id()
+        db_writer.enqueue(
+            'INSERT INTO searches (id, user_id, query, results) VALUES (?, ?, ?, ?)',
+            (search_id, session['user_id'], query, json.dumps(formatted_results, ensure_ascii=False, separators=(",", ":")))
+        )
+
         return jsonify({
             'success': True,
             'query': query,
@@ -1403,20 +3992,17 @@ def get_news():
         if 'user_id' not in session:
             return jsonify({'success': False, 'error': 'غير مسجل الدخول'}), 401
 
+        limited = check_user_rate_limit(session['user_id'])
+        if limited:
+            return limited
+
         data = request.json
         query = data.get('query', 'أخبار اليوم')
 
         # استخدام Serper API للأخبار
         if SERPER_API_KEY:
             print("📰 جاري جمع الأخبار...")
-            news_url = "https://google.serper.dev/news"
-            headers = {
-                'X-API-KEY': SERPER_API_KEY,
-                'Content-Type': 'application/json'
-            }
-            payload = {'q': query, 'num': 5}
-
-            response = requests.post(news_url, headers=headers, json=payload)
+            response = serper_post("news", {'q': query, 'num': 5})
 
             if response.status_code == 200:
                 news_data = response.json()
@@ -1597,6 +4183,10 @@ def agent_research():
             return jsonify({'success': False, 'error': 'الموضوع مطلوب'}), 400
 
         user_id = session['user_id']
+        limited = check_user_rate_limit(user_id)
+        if limited:
+            return limited
+
         agent = SmartAgent(user_id)
         task_id = agent.create_research_task(topic, depth)
 
@@ -1635,7 +4225,9 @@ def get_agent_notifications():
             return jsonify({'success': False, 'error': 'غير مسجل الدخول'}), 401
 
         user_id = session['user_id']
-        conn = get_db_connection()
+        flush_writes(user_id)
+
+        conn = get_user_db_connection(user_id)
         notifications = conn.execute(
             'SELECT id, title, message, created_at FROM agent_notifications WHERE user_id = ? ORDER BY created_at DESC LIMIT 10',
             (user_id,)
@@ -1650,6 +4242,151 @@ def get_agent_notifications():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route("/api/agent/notifications/stream", methods=["GET"])
+def stream_agent_notifications():
+    """
+    بث الإشعارات الجديدة فور إرسالها (SSE) مع الاستئناف من Last-Event-ID.
+
+    NotificationHub داخل العملية فقط: إشعار أرسلته عملية أخرى (عدة عمال، أو Vercel
+    حيث كل استدعاء عملية مستقلة) لا يصل عبر الطابور. لذلك يُستعلم عما فات من القاعدة
+    مع كل نبضة (NOTIFICATION_HEARTBEAT_SECONDS) - التأخير في هذه الحالة حتى نبضة واحدة.
+    داخل المولد تُستخدم db_connection فقط (عبر الدوال المساعدة) حتى لا تتراكم الاتصالات.
+    """
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'غير مسجل الدخول'}), 401
+
+    user_id = session['user_id']
+    resume_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id', '')
+    # بدون استئناف يبدأ المؤشر من لحظة الاتصال (ULID جديد أكبر من كل ما سبق)
+    last_id = resume_id or new_id()
+    # الاشتراك قبل قراءة ما فات حتى لا يضيع إشعار يصل بينهما
+    subscriber = notification_hub.subscribe(user_id)
+
+    def generate():
+        nonlocal last_id
+        try:
+            yield f"retry: {int(NOTIFICATION_HEARTBEAT_SECONDS * 1000)}\n\n"
+            # replay: قراءة ما فات من القاعدة؛ live: إشعار وصل عبر الطابور؛
+            # changed: قد يكون العداد تغير - يُرسل unread إن اختلف عن آخر قيمة أُرسلت
+            replay, live, changed = bool(resume_id), [], True
+            sent_unread = None
+
+            while True:
+                while replay:
+                    # صفحة بعد صفحة حتى نفاد ما فات، مهما كان عدده
+                    page = notifications_after(user_id, last_id)
+                    for notification in page:
+                        last_id = notification['id']
+                        yield sse_event("notification", notification, event_id=notification['id'])
+                    changed = changed or bool(page)
+                    replay = len(page) >= NOTIFICATION_RESUME_LIMIT
+
+                for notification in live:
+                    last_id = notification['id']
+                    yield sse_event("notification", notification, event_id=notification['id'])
+                    changed = True
+
+                if changed:
+                    changed = False
+                    unread = unread_notifications_count(user_id)
+                    if unread != sent_unread:
+                        sent_unread = unread
+                        yield sse_event("unread", {'unread': unread})
+
+                try:
+                    event, data = subscriber.events.get(timeout=NOTIFICATION_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    # تعليق SSE يبقي الاتصال حياً ويكشف انقطاع العميل؛ ثم مزامنة ما كتبته
+                    # العمليات الأخرى (استعلام مفهرس بـ user_id و id)
+                    yield ": ping\n\n"
+                    replay, live, changed = True, [], True
+                    continue
+
+                if subscriber.overflowed:
+                    # امتلأ الطابور وضاعت أحداث - إعادة المزامنة من القاعدة
+                    subscriber.overflowed = False
+                    while not subscriber.events.empty():
+                        subscriber.events.get_nowait()
+                    replay, live, changed = True, [], True
+                elif event == "notification":
+                    live = [data] if data['id'] > last_id else []
+                else:
+                    live = []
+                    if event == "unread":
+                        sent_unread = data['unread']
+                    yield sse_event(event, data)
+        finally:
+            notification_hub.unsubscribe(subscriber)
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+def mark_notifications_read(user_id: str, notification_ids: List[str] = None) -> int:
+    """تعليم إشعارات محددة (أو الكل) كمقروءة؛ المشغلات تحدث العداد"""
+    # ما زال في طابور الكتابة يجب أن يصل إلى القاعدة قبل تعديله
+    flush_writes(user_id)
+    with user_db_connection(user_id) as conn:
+        if notification_ids is None:
+            updated = conn.execute(
+                'UPDATE agent_notifications SET is_read = TRUE WHERE user_id = ? AND is_read = FALSE',
+                (user_id,)
+            ).rowcount
+        else:
+            placeholders = ",".join("?" * len(notification_ids))
+            updated = conn.execute(
+                f"UPDATE agent_notifications SET is_read = TRUE "
+                f"WHERE user_id = ? AND is_read = FALSE AND id IN ({placeholders})",
+                [user_id, *notification_ids]
+            ).rowcount
+        conn.commit()
+
+    if updated:
+        notification_hub.publish(user_id, "unread", {'unread': unread_notifications_count(user_id)})
+    return updated
+
+@app.route("/api/agent/notifications/<notification_id>/read", methods=["POST"])
+def read_agent_notification(notification_id):
+    """تعليم إشعار واحد كمقروء"""
+    try:
+        if 'user_id' not in session:
+            return jsonify({'success': False, 'error': 'غير مسجل الدخول'}), 401
+
+        user_id = session['user_id']
+        updated = mark_notifications_read(user_id, [notification_id])
+        return jsonify({'success': True, 'updated': updated, 'unread': unread_notifications_count(user_id)})
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+NOTIFICATION_BULK_READ_LIMIT = 500
+
+@app.route("/api/agent/notifications/read", methods=["POST"])
+def read_agent_notifications():
+    """تعليم عدة إشعارات كمقروءة: {"ids": [...]} أو {"all": true}"""
+    try:
+        if 'user_id' not in session:
+            return jsonify({'success': False, 'error': 'غير مسجل الدخول'}), 401
+
+        data = request.get_json(silent=True) or {}
+        ids = data.get('ids')
+        if not data.get('all'):
+            if not isinstance(ids, list) or not ids:
+                return jsonify({'success': False, 'error': 'يرجى تحديد الإشعارات أو all'}), 400
+            if len(ids) > NOTIFICATION_BULK_READ_LIMIT:
+                return jsonify({'success': False, 'error': f'الحد الأقصى {NOTIFICATION_BULK_READ_LIMIT} إشعار'}), 400
+            ids = [str(notification_id) for notification_id in ids]
+        else:
+            ids = None
+
+        user_id = session['user_id']
+        updated = mark_notifications_read(user_id, ids)
+        return jsonify({'success': True, 'updated': updated, 'unread': unread_notifications_count(user_id)})
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route("/api/agent/status", methods=["GET"])
 def agent_status():
     """حالة الوكيل الذكي"""
@@ -1661,12 +4398,7 @@ def agent_status():
         task_manager = TaskManager(user_id)
         tasks = task_manager.get_pending_tasks()
 
-        conn = get_db_connection()
-        notifications_count = conn.execute(
-            'SELECT COUNT(*) as count FROM agent_notifications WHERE user_id = ? AND is_read = FALSE',
-            (user_id,)
-        ).fetchone()['count']
-        conn.close()
+        notifications_count = unread_notifications_count(user_id)
 
         return jsonify({
             'success': True,
@@ -1683,7 +4415,8 @@ def agent_status():
             'ai_models_status': {
                 model: config["enabled"]
                 for model, config in AI_MODELS.items()
-            }
+            },
+            'ai_models_health': get_providers_health()
         })
 
     except Exception as e:
@@ -1754,8 +4487,8 @@ def save_location():
             return jsonify({'success': False, 'error': 'إحداثيات الموقع مطلوبة'}), 400
 
         # حفظ الموقع في قاعدة البيانات
-        location_id = hashlib.md5(f"{session['user_id']}_{lat}_{lng}_{datetime.now().timestamp()}".encode()).hexdigest()
-        conn = get_db_connection()
+        location_id = new_id()
+        conn = get_user_db_connection(session['user_id'])
         conn.execute(
             'INSERT INTO uploaded_files (id, user_id, filename, content, file_type) VALUES (?, ?, ?, ?, ?)',
             (location_id, session['user_id'], f"location_{lat}_{lng}", f"الموقع: {lat}, {lng}", "location")
@@ -1778,7 +4511,8 @@ def get_models_info():
                 'name': model['name'],
                 'enabled': model['enabled'],
                 'has_key': bool(model['key']),
-                'key_length': len(model['key']) if model['key'] else 0
+                'key_length': len(model['key']) if model['key'] else 0,
+                'circuit': provider_breakers[model_type].snapshot()
             }
 
         return jsonify({
@@ -1786,7 +4520,11 @@ def get_models_info():
             'models': models_info,
             'total_models': len(models_info),
             'enabled_models': sum(1 for model in models_info.values() if model['enabled']),
-            'setup_required': sum(1 for model in models_info.values() if not model['enabled']) > 0
+            'setup_required': sum(1 for model in models_info.values() if not model['enabled']) > 0,
+            'response_cache': response_cache.stats(),
+            'user_cache': user_cache.stats(),
+            'agent_memory_cache': agent_memory_cache.stats(),
+            'request_coalescing': llm_single_flight.stats()
         })
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -1819,6 +4557,51 @@ def debug_session():
             'error': str(e)
         }), 500
 
+metrics.register(Gauge(
+    "clainai_cache_hit_ratio", "Hit ratio of in-process caches", ("cache",),
+    lambda: {("response",): response_cache.stats()["hit_ratio"], ("user",): user_cache.stats()["hit_ratio"],
+             ("agent_memory",): agent_memory_cache.stats()["hit_ratio"]}
+))
+metrics.register(CallbackCounter(
+    "clainai_cache_lookups_total", "Lookups of in-process caches by result", ("cache", "result"),
+    lambda: {
+        ("response", "hit"): response_cache.stats()["hits"],
+        ("response", "miss"): response_cache.stats()["misses"],
+        ("user", "hit"): user_cache.stats()["hits"],
+        ("user", "miss"): user_cache.stats()["misses"],
+        ("agent_memory", "hit"): agent_memory_cache.stats()["hits"],
+        ("agent_memory", "miss"): agent_memory_cache.stats()["misses"]
+    }
+))
+metrics.register(CallbackCounter(
+    "clainai_coalesced_requests_total", "Requests that joined an identical in-flight provider call", (),
+    lambda: {(): llm_single_flight.stats()["coalesced"]}
+))
+metrics.register(Gauge(
+    "clainai_provider_circuit_open", "1 when the provider circuit breaker is open", ("provider",),
+    lambda: {(model_type,): int(state["state"] == CircuitBreaker.OPEN) for model_type, state in get_providers_health().items()}
+))
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """المقاييس بصيغة Prometheus النصية"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+@app.route("/api/debug/routing")
+def debug_routing():
+    """جدول التوجيه الحالي بين النماذج"""
+    try:
+        return jsonify({
+            'success': True,
+            'routing': provider_router.table(),
+            'circuits': get_providers_health()
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
 @app.route("/api/debug/login-test")
 def debug_login_test():
     """اختبار تسجيل الدخول"""
@@ -1844,9 +4627,10 @@ def debug_login_test():
 # تشغيل التطبيق
 # =============================================================================
 
+PORT = _env_int("PORT", 5000)
+
 if __name__ == "__main__":
     with app.app_context():
-        init_db()
         print("=" * 60)
         print("🚀 ClainAI - المساعد الذكي الإبداعي المتقدم!")
         print("🤖 نظام الوكيل الذكي (AI Agent) مفعل!")
@@ -1863,6 +4647,6 @@ if __name__ == "__main__":
         print(f"📝 Word Support: {'✅' if docx else '❌'}")
         print(f"🤖 AI Agent System: ✅")
         print(f"👑 Developer: محمد عبد القادر السراج - mohammedu3615@gmail.com")
-        print(f"🌐 التطبيق جاهز على: http://127.0.0.1:5000")
+        print(f"🌐 التطبيق جاهز على: http://127.0.0.1:{PORT}")
 
-    app.run(host='0.0.0.0', port=5000, debug=False)
+    app.run(host='0.0.0.0', port=PORT, debug=False, threaded=True)
@@ -0,0 +1,84 @@
+"""
+مقارنة أداء مطابق الكلمات المفتاحية مع الحلقات الخطية السابقة.
+
+الطريقة القديمة كانت تمر على قوائم الكلمات في ثلاثة مسارات منفصلة لكل رسالة
+(analyze_intent، فحص سؤال المطور، والردود الاحتياطية) مع إعادة بناء قاموس
+الردود في كل استدعاء. هذا السكربت يقيس الطريقتين على رسائل بأطوال مختلفة.
+
+التشغيل:
+    python bench_keywords.py --iterations 20000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# استيراد app.py ينشئ clainai.db في المجلد الحالي ويشغل مهمة الاحتفاظ بالبيانات:
+# القياس يستورده من مجلد مؤقت ومع تعطيل المهمة حتى لا يمس قاعدة حقيقية
+os.environ.setdefault("RETENTION_ENABLED", "false")
+sys.path.insert(0, ROOT)
+_previous_cwd = os.getcwd()
+os.chdir(tempfile.mkdtemp(prefix="clainai-bench-"))
+try:
+    import app
+finally:
+    os.chdir(_previous_cwd)
+
+WORDS = [
+    "الذكاء", "الاصطناعي", "هو", "مجال", "من", "علوم", "الحاسوب", "يهتم", "بتطوير",
+    "أنظمة", "قادرة", "على", "التعلم", "والتفكير", "وحل", "المشكلات", "بطريقة", "ذكية",
+    "تابع", "سعر", "الذهب", "ذكرني", "غداً", "ابحث", "عن", "معلومات", "مطورك"
+]
+
+def legacy_scan(message: str):
+    """نسخة من المنطق السابق: ثلاث حلقات خطية وقاموس يُبنى في كل مرة"""
+    message_lower = message.lower()
+    detected_intents = [
+        intent for intent, keywords in dict(app.AGENT_INTENTS).items()
+        if any(keyword in message_lower for keyword in keywords)
+    ]
+    is_instruction = any(word in message_lower for word in ["افعل", "نفذ", "اعمل", "اتمتع"])
+    is_developer = any(keyword in message_lower for keyword in app.DEVELOPER_KEYWORDS)
+    fallback_key = None
+    for key in dict(app.FALLBACK_RESPONSES):
+        if key in message_lower:
+            fallback_key = key
+            break
+    return detected_intents, is_instruction, is_developer, fallback_key
+
+def matcher_scan(message: str):
+    """تمريرة واحدة بالمطابق المبني مسبقاً دون ذاكرة تخزين"""
+    return app.KEYWORD_MATCHER.match(message)
+
+def cached_scan(message: str):
+    """ما تدفعه المسارات الثلاثة فعلياً: المطابقة تُحسب مرة وتُشارك"""
+    app.match_keywords(message)
+    app.match_keywords(message)
+    return app.match_keywords(message)
+
+def make_message(words: int) -> str:
+    return " ".join(random.choice(WORDS) for _ in range(words))
+
+def main():
+    parser = argparse.ArgumentParser(description="ClainAI keyword matcher microbenchmark")
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--lengths", default="5,40,200", help="أطوال الرسائل بالكلمات")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    print(f"\n{'words':>6} {'chars':>6} {'legacy µs':>10} {'matcher µs':>11} {'cached µs':>10}")
+    for length in (int(value) for value in args.lengths.split(",")):
+        message = make_message(length)
+        results = []
+        for scan in (legacy_scan, matcher_scan, cached_scan):
+            seconds = timeit.timeit(lambda: scan(message), number=args.iterations)
+            results.append(seconds / args.iterations * 1e6)
+        print(f"{length:>6} {len(message):>6} {results[0]:>10.2f} {results[1]:>11.2f} {results[2]:>10.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+قياس إنتاجية الكتابة في SQLite حسب عدد الأقسام (SHARD_COUNT).
+
+لكل عدد أقسام يُشغّل السكربت نفسه في عملية فرعية داخل مجلد مؤقت (SHARD_COUNT
+يُقرأ عند استيراد التطبيق)، ثم تكتب عدة خيوط لمستخدمين مختلفين عبر مسارين:
+- direct: إنشاء مهمة بمعاملة مستقلة لكل كتابة (مسار TaskManager)
+- write-behind: حفظ المحادثات عبر طابور الكتابة المؤجلة ثم تثبيتها
+
+التشغيل:
+    python bench_storage.py --shards 1,2,4 --threads 16 --duration 5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+def run_writers(threads: int, duration: float, write):
+    """تشغيل write(user_id) من عدة خيوط لمدة محددة؛ يعيد عدد الكتابات"""
+    counts = [0] * threads
+    stop_at = time.monotonic() + duration
+
+    def loop(index: int):
+        user_ids = [f"bench_{index}_{n}" for n in range(32)]
+        while time.monotonic() < stop_at:
+            write(user_ids[counts[index] % len(user_ids)])
+            counts[index] += 1
+
+    workers = [threading.Thread(target=loop, args=(index,)) for index in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sum(counts)
+
+def measure(threads: int, duration: float):
+    """يعمل داخل العملية الفرعية بعد ضبط SHARD_COUNT"""
+    sys.path.insert(0, ROOT)
+    import app
+
+    direct = run_writers(threads, duration, lambda user_id: app.TaskManager(user_id).create_task(
+        "bench", "قياس الكتابة", {"source": "bench_storage"}))
+
+    started = time.monotonic()
+    queued = run_writers(threads, duration, lambda user_id: app.save_conversations(
+        user_id, [("رسالة قياس", "رد قياس " * 20, "bench")]))
+    app.flush_writes()
+    behind_elapsed = time.monotonic() - started
+
+    return {
+        "shards": app.SHARD_COUNT,
+        "direct_writes_per_second": round(direct / duration, 1),
+        "write_behind_rows_per_second": round(queued / behind_elapsed, 1)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="ClainAI SQLite write throughput by shard count")
+    parser.add_argument("--shards", default="1,2,4", help="أعداد الأقسام المقارنة")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=5, help="بالثواني لكل مسار")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.threads, args.duration)))
+        return
+
+    print(f"\n{'shards':>6} {'direct/s':>10} {'write-behind/s':>15}")
+    for shard_count in (int(value) for value in args.shards.split(",")):
+        env = dict(os.environ, SHARD_COUNT=str(shard_count), RETENTION_ENABLED="false")
+        with tempfile.TemporaryDirectory(prefix="clainai-storage-") as workdir:
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--child",
+                 "--threads", str(args.threads), "--duration", str(args.duration)],
+                cwd=workdir, env=env, capture_output=True, text=True, check=True
+            ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{result['shards']:>6} {result['direct_writes_per_second']:>10} "
+              f"{result['write_behind_rows_per_second']:>15}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+فحص /api/chat/batch: دفعة أكبر من مجمع العمال (BATCH_MAX_WORKERS) تعيد نتيجة لكل
+رسالة وبنفس ترتيب الإرسال، مع زمن لكل عنصر، وتحفظ المحادثات كلها.
+
+يشغل السكربت خادم المزودين التجريبي (mock_providers.py) داخل العملية بزمن استجابة
+عشوائي - فتكتمل العناصر بترتيب مختلف عن ترتيب إرسالها - ثم يستورد app.py من مجلد
+مؤقت موجهاً إليه ويرسل الدفعة. يفشل (رمز خروج 1) عند أي اختلاف.
+
+التشغيل:
+    python check_batch_order.py
+    python check_batch_order.py --workers 4 --items 30
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+
+from werkzeug.serving import make_server
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+def start_mock_providers(latency_ms: float):
+    """خادم المزودين التجريبي في خيط؛ يعيد عنوانه"""
+    sys.path.insert(0, ROOT)
+    import mock_providers
+
+    # انحراف كبير حتى يختلف ترتيب الاكتمال عن ترتيب الإرسال
+    mock_providers.MOCK_CONFIG.update({"latency_median": latency_ms, "latency_sigma": 1.0, "reply_words": 12})
+    server = make_server("127.0.0.1", 0, mock_providers.mock_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+def import_app(mock_url: str, workers: int):
+    """استيراد app.py من مجلد مؤقت موجهاً إلى المزودين التجريبيين"""
+    os.environ.update({
+        "GOOGLE_API_KEY": "mock-google-key-0000",
+        "OPENAI_API_KEY": "mock-openai-key-0000",
+        "CLAUDE_API_KEY": "mock-claude-key-0000",
+        "OPENROUTER_API_KEY": "mock-openrouter-key-0000",
+        "GOOGLE_API_BASE": mock_url,
+        "OPENAI_API_BASE": mock_url,
+        "ANTHROPIC_API_BASE": mock_url,
+        "OPENROUTER_API_BASE": f"{mock_url}/api",
+        "SERPER_API_BASE": mock_url,
+        "BATCH_MAX_WORKERS": str(workers),
+        "PROVIDER_RATE_PER_MINUTE": "1000000",
+        "PROVIDER_RATE_BURST": "100000",
+        "RETENTION_ENABLED": "false",
+        "WRITE_BEHIND_SYNC": "true"
+    })
+    previous_cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp(prefix="clainai-batch-"))
+    try:
+        import app
+        return app
+    finally:
+        os.chdir(previous_cwd)
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that /api/chat/batch keeps request order")
+    parser.add_argument("--workers", type=int, default=4, help="BATCH_MAX_WORKERS للتطبيق")
+    parser.add_argument("--items", type=int, default=20, help="عدد رسائل الدفعة (أكبر من العمال)")
+    parser.add_argument("--latency", type=float, default=40, help="وسيط زمن المزود بالميلي ثانية")
+    args = parser.parse_args()
+
+    app = import_app(start_mock_providers(args.latency), args.workers)
+    items = min(args.items, app.BATCH_MAX_ITEMS)
+    client = app.app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = "batch_order_check"
+
+    # رسائل فريدة حتى لا تُخدم من الذاكرة المؤقتة أو تُدمج مع طلب مماثل
+    token = os.urandom(4).hex()
+    messages = [f"سؤال رقم {index} للفحص {token}" for index in range(items)]
+    response = client.post("/api/chat/batch", json={"messages": messages})
+    data = response.get_json() or {}
+    results = data.get("results", [])
+
+    problems = []
+    if response.status_code != 200:
+        problems.append(f"HTTP {response.status_code}: {data.get('error')}")
+    if len(results) != len(messages):
+        problems.append(f"{len(results)} results for {len(messages)} messages")
+    for index, (message, result) in enumerate(zip(messages, results)):
+        if result.get("message") != message:
+            problems.append(f"result {index} belongs to {result.get('message')!r}")
+        if not result.get("success"):
+            problems.append(f"result {index} failed: {result.get('error')}")
+        if "latency_ms" not in result:
+            problems.append(f"result {index} has no latency_ms")
+
+    latencies = [result.get("latency_ms", 0) for result in results]
+    with app.user_db_connection("batch_order_check") as conn:
+        saved = conn.execute(
+            "SELECT COUNT(*) FROM conversations WHERE user_id = ? AND message LIKE ?",
+            ("batch_order_check", f"%{token}")
+        ).fetchone()[0]
+    if saved != len(messages):
+        problems.append(f"{saved} conversations saved for {len(messages)} messages")
+
+    print(f"\n{len(messages)} items over {app.BATCH_MAX_WORKERS} workers, "
+          f"latency {min(latencies, default=0)}-{max(latencies, default=0)} ms, {saved} saved")
+    for problem in problems:
+        print(f"❌ {problem}")
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,248 @@
+"""
+فحص خطط تنفيذ استعلامات SQLite في app.py.
+
+يستخرج السكربت كل SQL يُمرر إلى execute/executemany (أو طابور الكتابة المؤجلة)
+في app.py - نصاً ثابتاً أو عبر متغير أو ثابت على مستوى الوحدة أو f-string قابلة
+للحل - ثم يطبق الترحيلات على قاعدة بيانات مؤقتة ويشغل EXPLAIN QUERY PLAN لكل
+استعلام. يفشل (رمز خروج 1) إذا لجأ أي استعلام إلى مسح كامل لجدول دون فهرس، أو
+إذا تعذر تحديد SQL في دالة غير مدرجة في ALLOWED_DYNAMIC.
+
+التشغيل:
+    python check_query_plans.py            # ملخص + الأخطاء
+    python check_query_plans.py --verbose  # طباعة خطة كل استعلام
+"""
+import argparse
+import ast
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+APP_FILE = os.path.join(ROOT, "app.py")
+
+DML = re.compile(r"^\s*(SELECT|INSERT|UPDATE|DELETE|REPLACE|WITH)\b", re.IGNORECASE)
+# "SCAN t" فقط؛ "SCAN t USING INDEX" و "SCAN t VIRTUAL TABLE INDEX" (FTS5) مقبولة
+TABLE_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)$")
+
+# الدوال التي تستقبل SQL كأول وسيط (الكتابة المؤجلة تمر عبر enqueue)
+SQL_METHODS = ("execute", "executemany", "enqueue", "enqueue_many")
+
+# مسح مقصود - مع السبب
+ALLOWED_SCANS = {
+    "sqlite_master": "catalog lookup in /api/check-tables",
+    "sqlite_schema": "catalog lookup in /api/check-tables",
+}
+
+# دوال تمرر SQL وصلها من المستدعي ولا يمكن حله هنا - مع مكان فحصه
+ALLOWED_DYNAMIC = {
+    "InstrumentedConnection.execute": "wrapper; SQL is checked at the caller",
+    "InstrumentedConnection.executemany": "wrapper; SQL is checked at the caller",
+    "WriteBehindQueue.enqueue": "forwards to enqueue_many; SQL is checked at the caller",
+    "WriteBehindQueue._write": "runs queued SQL, checked at the enqueue/enqueue_many call sites",
+    "_delete_in_batches": "runs RETENTION_DELETES values, checked as module constants",
+}
+
+def _is_placeholder_join(node) -> bool:
+    """",".join("?" * n) - قائمة معاملات IN تُمثل بمعامل واحد"""
+    return (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == "join"
+            and isinstance(node.func.value, ast.Constant) and len(node.args) == 1
+            and isinstance(node.args[0], ast.BinOp)
+            and any(isinstance(side, ast.Constant) and side.value == "?"
+                    for side in (node.args[0].left, node.args[0].right)))
+
+class SqlResolver:
+    """حل القيم الممكنة لتعبير SQL: نصوص ثابتة، ثوابت الوحدة، متغيرات الدالة، وf-strings"""
+
+    def __init__(self, module_names: dict):
+        self.module_names = module_names  # اسم -> عقدة القيمة على مستوى الوحدة
+
+    def resolve(self, node, local_names: dict, depth: int = 0):
+        """قائمة النصوص الممكنة أو None إذا تعذر الحل"""
+        if depth > 10:
+            return None
+        if isinstance(node, ast.Constant):
+            return [node.value] if isinstance(node.value, str) else None
+        if isinstance(node, ast.IfExp):
+            return self._combine([node.body, node.orelse], local_names, depth)
+        if isinstance(node, (ast.Tuple, ast.List, ast.Set)):
+            return self._combine(node.elts, local_names, depth)
+        if isinstance(node, ast.Dict):
+            return self._combine(node.values, local_names, depth)
+        if isinstance(node, ast.Subscript):
+            # قاموس ثوابت مفهرس بمفتاح متغير: كل القيم ممكنة
+            return self.resolve(node.value, local_names, depth + 1)
+        if _is_placeholder_join(node):
+            return ["?"]
+        if isinstance(node, ast.Name):
+            if node.id in local_names:
+                return self._combine(local_names[node.id], local_names, depth)
+            if node.id in self.module_names:
+                return self.resolve(self.module_names[node.id], {}, depth + 1)
+            return None
+        if isinstance(node, ast.JoinedStr):
+            variants = [""]
+            for part in node.values:
+                if isinstance(part, ast.Constant):
+                    options = [part.value]
+                else:
+                    options = self.resolve(part.value, local_names, depth + 1)
+                    if options is None:
+                        return None
+                variants = [prefix + str(option) for prefix in variants for option in options]
+            return variants
+        return None
+
+    def _combine(self, nodes, local_names, depth):
+        values = []
+        for node in nodes:
+            resolved = self.resolve(node, local_names, depth + 1)
+            if resolved is None:
+                return None
+            values.extend(resolved)
+        return values
+
+def _local_names(function) -> dict:
+    """المتغيرات المسندة داخل الدالة: اسم -> عقد القيم (كل الإسنادات، وعناصر حلقات for)"""
+    names = {}
+    for node in ast.walk(function):
+        if isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    names.setdefault(target.id, []).append(node.value)
+        elif isinstance(node, ast.For) and isinstance(node.target, ast.Name):
+            # قيم متغير الحلقة هي عناصر المجموعة؛ Subscript وحده لا يعني عنصراً
+            names.setdefault(node.target.id, []).append(node.iter)
+    for argument in function.args.args + function.args.kwonlyargs:
+        names.pop(argument.arg, None)
+    return names
+
+def _module_names(tree) -> dict:
+    names = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    names[target.id] = node.value
+    return names
+
+def extract_queries(path: str):
+    """
+    (رقم السطر، نص SQL) لكل استعلام في app.py، مع قائمة ما تعذر حله.
+    يشمل النصوص الثابتة، وSQL الممرر عبر متغيرات أو ثوابت الوحدة أو f-strings
+    قابلة للحل، وقيم ثوابت SQL المعرفة على مستوى الوحدة.
+    """
+    tree = ast.parse(open(path, encoding="utf-8").read(), filename=path)
+    module_names = _module_names(tree)
+    resolver = SqlResolver(module_names)
+    queries, unresolved = set(), []
+
+    def add(lineno, values):
+        for value in values:
+            if DML.match(value):
+                queries.add((lineno, " ".join(value.split())))
+
+    # ثوابت SQL على مستوى الوحدة (مثل RETENTION_DELETES) تُفحص أينما استُخدمت
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and isinstance(node.value, (ast.Constant, ast.Dict)):
+            values = resolver.resolve(node.value, {})
+            if values:
+                add(node.lineno, values)
+
+    def visit(node, qualname, local_names):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, ast.ClassDef):
+                visit(child, child.name, {})
+            elif isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                # الترحيلات تعمل مرة واحدة وقد تمسح الجداول عمداً
+                if child.name.startswith("_migration_"):
+                    continue
+                name = f"{qualname}.{child.name}" if qualname else child.name
+                visit(child, name, {**local_names, **_local_names(child)})
+            else:
+                if (isinstance(child, ast.Call) and isinstance(child.func, ast.Attribute)
+                        and child.func.attr in SQL_METHODS and child.args):
+                    check_call(child, qualname, local_names)
+                visit(child, qualname, local_names)
+
+    def check_call(call, qualname, local_names):
+        sql = call.args[0]
+        if isinstance(sql, ast.JoinedStr):
+            head = sql.values[0] if sql.values else None
+            # PRAGMA وALTER وغيرها ليست استعلامات لها خطة
+            if isinstance(head, ast.Constant) and not DML.match(head.value):
+                return
+        values = resolver.resolve(sql, local_names)
+        if values is None:
+            if qualname not in ALLOWED_DYNAMIC:
+                unresolved.append((call.lineno, qualname or "<module>", ast.unparse(sql)))
+            return
+        add(call.lineno, values)
+
+    visit(tree, "", {})
+    return sorted(queries), sorted(unresolved)
+
+def build_schema(db_path: str):
+    """تطبيق ترحيلات app.py على قاعدة بيانات مؤقتة"""
+    # app.py يستخدم clainai.db في المجلد الحالي - نستورده من مجلد مؤقت دون مهمة الاحتفاظ
+    os.environ.setdefault("RETENTION_ENABLED", "false")
+    sys.path.insert(0, ROOT)
+    previous_cwd = os.getcwd()
+    os.chdir(os.path.dirname(db_path))
+    try:
+        import app
+        return app, os.path.abspath(app.DB_PATH)
+    finally:
+        os.chdir(previous_cwd)
+
+def explain(conn, sql: str):
+    params = [None] * sql.count("?")
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+def main():
+    parser = argparse.ArgumentParser(description="Fail when an app.py query falls back to a full table scan")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    queries, unresolved = extract_queries(APP_FILE)
+    with tempfile.TemporaryDirectory() as workdir:
+        app, db_file = build_schema(os.path.join(workdir, "clainai.db"))
+        conn = sqlite3.connect(db_file)
+        # المشغلات تستدعي دوال مسجلة من التطبيق
+        app.register_sql_functions(conn)
+
+        failures = []
+        for lineno, sql in queries:
+            try:
+                plan = explain(conn, sql)
+            except sqlite3.Error as e:
+                failures.append((lineno, sql, [f"error: {e}"]))
+                continue
+
+            scans = [
+                detail for detail in plan
+                if TABLE_SCAN.match(detail) and TABLE_SCAN.match(detail).group(1) not in ALLOWED_SCANS
+            ]
+            if scans:
+                failures.append((lineno, sql, plan))
+            if args.verbose:
+                print(f"app.py:{lineno}: {sql}")
+                for detail in plan:
+                    print(f"    {detail}")
+        conn.close()
+
+    for lineno, function, expression in unresolved:
+        print(f"❌ app.py:{lineno}: تعذر تحديد SQL في {function}: {expression} "
+              f"(استخدم نصاً ثابتاً أو أضف الدالة إلى ALLOWED_DYNAMIC مع السبب)")
+
+    for lineno, sql, plan in failures:
+        print(f"❌ app.py:{lineno}: {sql}")
+        for detail in plan:
+            print(f"    {detail}")
+
+    print(f"\n{len(queries)} queries checked, {len(failures)} full table scans, {len(unresolved)} unresolved")
+    return 1 if failures or unresolved else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
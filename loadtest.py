@@ -0,0 +1,273 @@
+"""
+مولد حمل لتطبيق ClainAI يقيس الإنتاجية وزمن الاستجابة (p50/p95/p99) ونسب الأخطاء لكل مسار.
+
+تشغيل كامل ذاتي (يشغّل mock_providers.py والتطبيق على منافذ محلية):
+    python loadtest.py --spawn --concurrency 20 --duration 30 --scenario chat,stream,news,history
+
+أو ضد تطبيق يعمل مسبقاً:
+    python loadtest.py --target http://127.0.0.1:5000 --scenario chat --concurrency 10
+"""
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Any
+
+import requests
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PROMPTS = [
+    "ما هو الذكاء الاصطناعي",
+    "عرف الحوسبة السحابية",
+    "اشرح التعلم الآلي بمثال بسيط",
+    "ما الفرق بين الشبكات العصبية والتعلم العميق",
+    "كيف أتعلم البرمجة بلغة بايثون",
+    "ما هي فوائد الطاقة الشمسية",
+    "اكتب نصيحة قصيرة للدراسة",
+    "ما هي أشهر لغات البرمجة"
+]
+
+class EndpointStats:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.first_byte: List[float] = []
+        self.ok = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.statuses: Dict[int, int] = {}
+        self.lock = threading.Lock()
+
+    def record(self, status: int, latency: float, first_byte: float = None):
+        with self.lock:
+            self.latencies.append(latency)
+            if first_byte is not None:
+                self.first_byte.append(first_byte)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if status == 429:
+                self.rate_limited += 1
+            elif 200 <= status < 300:
+                self.ok += 1
+            else:
+                self.errors += 1
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    # الرتبة الأقرب (nearest-rank): أصغر قيمة تغطي pct% من العينات
+    rank = max(0, min(len(ordered) - 1, math.ceil(pct / 100.0 * len(ordered)) - 1))
+    return ordered[rank]
+
+def make_prompt(unique_ratio: float) -> str:
+    prompt = random.choice(PROMPTS)
+    if random.random() < unique_ratio:
+        prompt += f" ({random.getrandbits(32):x})"
+    return prompt
+
+def call_endpoint(http: requests.Session, target: str, endpoint: str, unique_ratio: float, batch_size: int):
+    """تنفيذ طلب واحد؛ يرجع (status, latency, first_byte)"""
+    started = time.perf_counter()
+
+    if endpoint == "chat":
+        response = http.post(f"{target}/api/chat", json={"message": make_prompt(unique_ratio)}, timeout=120)
+    elif endpoint == "stream":
+        response = http.post(f"{target}/api/chat/stream", json={"message": make_prompt(unique_ratio)},
+                             stream=True, timeout=120)
+        first_byte = None
+        for chunk in response.iter_content(chunk_size=None):
+            if first_byte is None and chunk:
+                first_byte = time.perf_counter() - started
+        response.close()
+        return response.status_code, time.perf_counter() - started, first_byte
+    elif endpoint == "batch":
+        messages = [make_prompt(unique_ratio) for _ in range(batch_size)]
+        response = http.post(f"{target}/api/chat/batch", json={"messages": messages}, timeout=300)
+    elif endpoint == "news":
+        response = http.post(f"{target}/api/news", json={"query": "أخبار اليوم"}, timeout=120)
+    elif endpoint == "search":
+        response = http.post(f"{target}/api/search", json={"query": make_prompt(unique_ratio)}, timeout=60)
+    elif endpoint == "history":
+        response = http.get(f"{target}/api/history", timeout=60)
+    elif endpoint == "status":
+        response = http.get(f"{target}/api/user", timeout=60)
+    else:
+        raise ValueError(f"unknown endpoint: {endpoint}")
+
+    response.content  # قراءة الجسم كاملاً ضمن القياس
+    return response.status_code, time.perf_counter() - started, None
+
+def worker(target: str, endpoints: List[str], stats: Dict[str, EndpointStats], stop_at: float,
+           unique_ratio: float, batch_size: int, max_requests: int, counter: Dict[str, int], counter_lock):
+    http = requests.Session()
+    try:
+        http.post(f"{target}/api/guest-login", timeout=30)
+    except requests.RequestException as e:
+        print(f"❌ فشل تسجيل الدخول كضيف: {e}")
+        return
+
+    index = random.randrange(len(endpoints))
+    while time.time() < stop_at:
+        with counter_lock:
+            if max_requests and counter["sent"] >= max_requests:
+                return
+            counter["sent"] += 1
+
+        endpoint = endpoints[index % len(endpoints)]
+        index += 1
+        started = time.perf_counter()
+        try:
+            status, latency, first_byte = call_endpoint(http, target, endpoint, unique_ratio, batch_size)
+        except requests.RequestException:
+            # الزمن الفعلي حتى الفشل (مثل المهلة) - الصفر كان يخفض كل النسب المئوية
+            status, latency, first_byte = 599, time.perf_counter() - started, None
+        stats[endpoint].record(status, latency, first_byte)
+
+def build_report(stats: Dict[str, EndpointStats], elapsed: float) -> Dict[str, Any]:
+    report = {"elapsed_seconds": round(elapsed, 2), "endpoints": {}}
+    for endpoint, endpoint_stats in stats.items():
+        total = len(endpoint_stats.latencies)
+        report["endpoints"][endpoint] = {
+            "requests": total,
+            "ok": endpoint_stats.ok,
+            "errors": endpoint_stats.errors,
+            "rate_limited": endpoint_stats.rate_limited,
+            "error_rate": round(endpoint_stats.errors / total, 4) if total else 0.0,
+            "throughput_rps": round(total / elapsed, 2) if elapsed else 0.0,
+            "p50_ms": round(percentile(endpoint_stats.latencies, 50) * 1000, 1),
+            "p95_ms": round(percentile(endpoint_stats.latencies, 95) * 1000, 1),
+            "p99_ms": round(percentile(endpoint_stats.latencies, 99) * 1000, 1),
+            "ttfb_p50_ms": round(percentile(endpoint_stats.first_byte, 50) * 1000, 1) if endpoint_stats.first_byte else None,
+            "ttfb_p95_ms": round(percentile(endpoint_stats.first_byte, 95) * 1000, 1) if endpoint_stats.first_byte else None,
+            "statuses": endpoint_stats.statuses
+        }
+    return report
+
+def print_report(report: Dict[str, Any]):
+    print(f"\n📊 نتائج اختبار الحمل ({report['elapsed_seconds']}s)")
+    header = f"{'endpoint':<10}{'reqs':>7}{'rps':>8}{'err%':>7}{'429':>6}{'p50':>9}{'p95':>9}{'p99':>9}{'ttfb50':>9}"
+    print(header)
+    print("-" * len(header))
+    for endpoint, row in report["endpoints"].items():
+        ttfb = row["ttfb_p50_ms"] if row["ttfb_p50_ms"] is not None else "-"
+        print(f"{endpoint:<10}{row['requests']:>7}{row['throughput_rps']:>8}{row['error_rate'] * 100:>6.1f}%"
+              f"{row['rate_limited']:>6}{row['p50_ms']:>9}{row['p95_ms']:>9}{row['p99_ms']:>9}{ttfb:>9}")
+
+def wait_for(url: str, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=2)
+            return True
+        except requests.RequestException:
+            time.sleep(0.2)
+    return False
+
+def spawn_stack(args) -> List[subprocess.Popen]:
+    """تشغيل الخادم التجريبي والتطبيق كعمليات فرعية موجهة إليه"""
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    mock = subprocess.Popen([
+        sys.executable, os.path.join(BASE_DIR, "mock_providers.py"),
+        "--port", str(args.mock_port),
+        "--latency-median", str(args.mock_latency),
+        "--error-rate", str(args.mock_error_rate)
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    env = dict(os.environ)
+    env.update({
+        "PORT": str(args.app_port),
+        "GOOGLE_API_KEY": "mock-google-key-0000",
+        "OPENAI_API_KEY": "mock-openai-key-0000",
+        "CLAUDE_API_KEY": "mock-claude-key-0000",
+        "OPENROUTER_API_KEY": "mock-openrouter-key-0000",
+        "SERPER_API_KEY": "mock-serper-key",
+        "GOOGLE_API_BASE": mock_url,
+        "OPENAI_API_BASE": mock_url,
+        "ANTHROPIC_API_BASE": mock_url,
+        "OPENROUTER_API_BASE": f"{mock_url}/api",
+        "SERPER_API_BASE": mock_url,
+        "USER_RATE_PER_MINUTE": env.get("USER_RATE_PER_MINUTE", "100000"),
+        "USER_RATE_BURST": env.get("USER_RATE_BURST", "100000"),
+        "USER_BATCH_RATE_PER_MINUTE": env.get("USER_BATCH_RATE_PER_MINUTE", "1000000"),
+        "USER_BATCH_RATE_BURST": env.get("USER_BATCH_RATE_BURST", "100000"),
+        "PROVIDER_RATE_PER_MINUTE": env.get("PROVIDER_RATE_PER_MINUTE", "1000000"),
+        "PROVIDER_RATE_BURST": env.get("PROVIDER_RATE_BURST", "100000"),
+        "SHARD_COUNT": str(args.shards)
+    })
+    # قاعدة بيانات مؤقتة مستقلة لكل تشغيل
+    workdir = tempfile.mkdtemp(prefix="clainai-load-")
+    app_process = subprocess.Popen(
+        [sys.executable, os.path.join(BASE_DIR, "app.py")],
+        cwd=workdir, env=env,
+        stdout=subprocess.DEVNULL if not args.verbose else None,
+        stderr=subprocess.DEVNULL if not args.verbose else None
+    )
+
+    if not wait_for(f"{mock_url}/_mock/stats") or not wait_for(f"http://127.0.0.1:{args.app_port}/api/status"):
+        for process in (mock, app_process):
+            process.terminate()
+        raise SystemExit("❌ تعذر تشغيل الخادم التجريبي أو التطبيق")
+
+    print(f"🧪 الخادم التجريبي: {mock_url} | التطبيق: http://127.0.0.1:{args.app_port} | DB: {workdir}")
+    return [mock, app_process]
+
+def main():
+    parser = argparse.ArgumentParser(description="ClainAI load generator")
+    parser.add_argument("--target", default=None, help="عنوان التطبيق (الافتراضي: التطبيق المشغل عبر --spawn)")
+    parser.add_argument("--scenario", default="chat", help="chat,stream,batch,news,search,history,status")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=30, help="بالثواني")
+    parser.add_argument("--requests", type=int, default=0, help="حد أقصى لعدد الطلبات (0 = بلا حد)")
+    parser.add_argument("--unique-ratio", type=float, default=1.0, help="نسبة الرسائل الفريدة لتجاوز الذاكرة المؤقتة")
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--json", action="store_true", help="طباعة التقرير بصيغة JSON")
+    parser.add_argument("--spawn", action="store_true", help="تشغيل mock_providers.py والتطبيق تلقائياً")
+    parser.add_argument("--app-port", type=int, default=5055)
+    parser.add_argument("--mock-port", type=int, default=8900)
+    parser.add_argument("--mock-latency", type=float, default=300, help="وسيط زمن المزود التجريبي بالمللي ثانية")
+    parser.add_argument("--mock-error-rate", type=float, default=0.0)
+    parser.add_argument("--shards", type=int, default=1, help="SHARD_COUNT للتطبيق المشغل عبر --spawn")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    processes = spawn_stack(args) if args.spawn else []
+    target = (args.target or f"http://127.0.0.1:{args.app_port if args.spawn else 5000}").rstrip("/")
+    endpoints = [endpoint.strip() for endpoint in args.scenario.split(",") if endpoint.strip()]
+    stats = {endpoint: EndpointStats() for endpoint in endpoints}
+    counter = {"sent": 0}
+    counter_lock = threading.Lock()
+
+    try:
+        print(f"🚀 {args.concurrency} عامل لمدة {args.duration}s على {target} ({', '.join(endpoints)})")
+        started = time.time()
+        stop_at = started + args.duration
+        threads = [
+            threading.Thread(target=worker, args=(
+                target, endpoints, stats, stop_at, args.unique_ratio, args.batch_size,
+                args.requests, counter, counter_lock
+            ), daemon=True)
+            for _ in range(args.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        report = build_report(stats, time.time() - started)
+        if args.json:
+            print(json.dumps(report, ensure_ascii=False, indent=2))
+        else:
+            print_report(report)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait(timeout=10)
+
+if __name__ == "__main__":
+    main()
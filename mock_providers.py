@@ -0,0 +1,267 @@
+"""
+خادم محلي يحاكي مزودي النماذج وخدمة Serper لاختبارات الحمل دون تكلفة.
+
+يدعم صيغ:
+- Google Gemini: /v1/models/<model>:generateContent و :streamGenerateContent?alt=sse
+- OpenAI: /v1/chat/completions
+- OpenRouter: /api/v1/chat/completions
+- Anthropic: /v1/messages
+- Serper: /search و /news
+
+التشغيل:
+    python mock_providers.py --port 8900 --latency-median 800 --latency-sigma 0.5 --error-rate 0.02
+
+ثم تشغيل التطبيق موجهاً إليه:
+    GOOGLE_API_BASE=http://127.0.0.1:8900 OPENAI_API_BASE=http://127.0.0.1:8900 \\
+    ANTHROPIC_API_BASE=http://127.0.0.1:8900 OPENROUTER_API_BASE=http://127.0.0.1:8900/api \\
+    SERPER_API_BASE=http://127.0.0.1:8900 python app.py
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from typing import Dict, Any
+
+from flask import Flask, request, jsonify, Response
+
+mock_app = Flask(__name__)
+
+# الإعدادات الافتراضية - تُستبدل من سطر الأوامر
+MOCK_CONFIG: Dict[str, Any] = {
+    "latency_median": 800.0,   # ms
+    "latency_sigma": 0.5,      # انحراف التوزيع اللوغاريتمي الطبيعي
+    "error_rate": 0.0,         # نسبة ردود 500
+    "rate_limit_rate": 0.0,    # نسبة ردود 429
+    "retry_after": 1,          # قيمة Retry-After مع 429
+    "reply_words": 120,        # طول الرد بالكلمات
+    "chunk_words": 4,          # كلمات في كل جزء بث
+    "chunk_delay": 30.0,       # ms بين أجزاء البث
+    "provider_latency": {}     # google/openai/claude/llama/serper -> median ms
+}
+
+_stats_lock = threading.Lock()
+_stats: Dict[str, Dict[str, int]] = {}
+
+ARABIC_WORDS = [
+    "الذكاء", "الاصطناعي", "هو", "مجال", "من", "علوم", "الحاسوب", "يهتم", "بتطوير",
+    "أنظمة", "قادرة", "على", "التعلم", "والتفكير", "وحل", "المشكلات", "بطريقة", "ذكية"
+]
+
+def count(provider: str, outcome: str):
+    with _stats_lock:
+        provider_stats = _stats.setdefault(provider, {})
+        provider_stats[outcome] = provider_stats.get(outcome, 0) + 1
+
+def sample_latency(provider: str) -> float:
+    """زمن الاستجابة بالثواني من توزيع لوغاريتمي طبيعي حول الوسيط"""
+    median = MOCK_CONFIG["provider_latency"].get(provider, MOCK_CONFIG["latency_median"])
+    return median * random.lognormvariate(0, MOCK_CONFIG["latency_sigma"]) / 1000.0
+
+def reply_text() -> str:
+    return " ".join(random.choice(ARABIC_WORDS) for _ in range(MOCK_CONFIG["reply_words"]))
+
+def injected_failure(provider: str):
+    """إرجاع رد خطأ محقون حسب النسب المضبوطة أو None"""
+    roll = random.random()
+    if roll < MOCK_CONFIG["rate_limit_rate"]:
+        count(provider, "429")
+        return jsonify({"error": {"message": "rate limited (mock)"}}), 429, {
+            "Retry-After": str(MOCK_CONFIG["retry_after"])
+        }
+    if roll < MOCK_CONFIG["rate_limit_rate"] + MOCK_CONFIG["error_rate"]:
+        count(provider, "500")
+        return jsonify({"error": {"message": "internal error (mock)"}}), 500
+    return None
+
+def simulate(provider: str, streaming: bool = False):
+    """تطبيق زمن الاستجابة وحقن الأخطاء؛ في البث يُطبق الزمن حتى أول جزء فقط"""
+    time.sleep(sample_latency(provider) / (3 if streaming else 1))
+    return injected_failure(provider)
+
+def sse_stream(events):
+    def generate():
+        for index, event in enumerate(events):
+            if index:
+                time.sleep(MOCK_CONFIG["chunk_delay"] / 1000.0)
+            yield event
+    return Response(generate(), mimetype="text/event-stream")
+
+def word_chunks(text: str):
+    words = text.split(" ")
+    size = max(1, MOCK_CONFIG["chunk_words"])
+    for start in range(0, len(words), size):
+        yield " ".join(words[start:start + size]) + " "
+
+@mock_app.route("/v1/models/<path:model_action>", methods=["POST"])
+def gemini(model_action):
+    streaming = model_action.endswith(":streamGenerateContent")
+    failure = simulate("google", streaming)
+    if failure:
+        return failure
+    count("google", "200")
+    text = reply_text()
+
+    if streaming:
+        return sse_stream(
+            "data: " + json.dumps({"candidates": [{"content": {"parts": [{"text": chunk}], "role": "model"}}]},
+                                  ensure_ascii=False) + "\r\n\r\n"
+            for chunk in word_chunks(text)
+        )
+
+    return jsonify({
+        "candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "STOP"}],
+        "usageMetadata": {"promptTokenCount": 20, "candidatesTokenCount": MOCK_CONFIG["reply_words"]}
+    })
+
+def chat_completions(provider: str):
+    payload = request.get_json(silent=True) or {}
+    streaming = bool(payload.get("stream"))
+    failure = simulate(provider, streaming)
+    if failure:
+        return failure
+    count(provider, "200")
+    text = reply_text()
+    model = payload.get("model", "mock")
+
+    if streaming:
+        events = [
+            "data: " + json.dumps({"model": model, "choices": [{"index": 0, "delta": {"content": chunk}}]},
+                                  ensure_ascii=False) + "\n\n"
+            for chunk in word_chunks(text)
+        ]
+        events.append("data: [DONE]\n\n")
+        return sse_stream(events)
+
+    return jsonify({
+        "id": "chatcmpl-mock",
+        "object": "chat.completion",
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 20, "completion_tokens": MOCK_CONFIG["reply_words"]}
+    })
+
+@mock_app.route("/v1/chat/completions", methods=["POST"])
+def openai_chat():
+    return chat_completions("openai")
+
+@mock_app.route("/api/v1/chat/completions", methods=["POST"])
+def openrouter_chat():
+    return chat_completions("llama")
+
+@mock_app.route("/v1/messages", methods=["POST"])
+def anthropic_messages():
+    payload = request.get_json(silent=True) or {}
+    streaming = bool(payload.get("stream"))
+    failure = simulate("claude", streaming)
+    if failure:
+        return failure
+    count("claude", "200")
+    text = reply_text()
+
+    if streaming:
+        def event(name, data):
+            return f"event: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+        events = [
+            event("message_start", {"type": "message_start", "message": {"id": "msg_mock", "role": "assistant"}}),
+            event("content_block_start", {"type": "content_block_start", "index": 0,
+                                          "content_block": {"type": "text", "text": ""}})
+        ]
+        events += [
+            event("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                          "delta": {"type": "text_delta", "text": chunk}})
+            for chunk in word_chunks(text)
+        ]
+        events += [
+            event("content_block_stop", {"type": "content_block_stop", "index": 0}),
+            event("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn"}}),
+            event("message_stop", {"type": "message_stop"})
+        ]
+        return sse_stream(events)
+
+    return jsonify({
+        "id": "msg_mock",
+        "type": "message",
+        "role": "assistant",
+        "content": [{"type": "text", "text": text}],
+        "stop_reason": "end_turn",
+        "usage": {"input_tokens": 20, "output_tokens": MOCK_CONFIG["reply_words"]}
+    })
+
+@mock_app.route("/search", methods=["POST"])
+def serper_search():
+    failure = simulate("serper")
+    if failure:
+        return failure
+    count("serper", "200")
+    query = (request.get_json(silent=True) or {}).get("q", "")
+    return jsonify({
+        "searchParameters": {"q": query},
+        "organic": [
+            {"title": f"{query} - نتيجة {i}", "link": f"https://example.com/{i}", "snippet": reply_text()[:160]}
+            for i in range(1, 11)
+        ]
+    })
+
+@mock_app.route("/news", methods=["POST"])
+def serper_news():
+    failure = simulate("serper")
+    if failure:
+        return failure
+    count("serper", "200")
+    query = (request.get_json(silent=True) or {}).get("q", "")
+    return jsonify({
+        "searchParameters": {"q": query, "type": "news"},
+        "news": [
+            {"title": f"{query} - خبر {i}", "link": f"https://example.com/news/{i}", "source": "Mock News",
+             "date": "منذ ساعة", "snippet": reply_text()[:160]}
+            for i in range(1, 6)
+        ]
+    })
+
+@mock_app.route("/_mock/stats", methods=["GET"])
+def mock_stats():
+    with _stats_lock:
+        return jsonify({"config": MOCK_CONFIG, "requests": _stats})
+
+def parse_provider_latency(values):
+    latencies = {}
+    for value in values or []:
+        name, _, median = value.partition("=")
+        latencies[name.strip()] = float(median)
+    return latencies
+
+def main():
+    parser = argparse.ArgumentParser(description="ClainAI mock LLM/Serper provider server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency-median", type=float, default=MOCK_CONFIG["latency_median"], help="ms")
+    parser.add_argument("--latency-sigma", type=float, default=MOCK_CONFIG["latency_sigma"])
+    parser.add_argument("--provider-latency", action="append", metavar="NAME=MS",
+                        help="وسيط زمن خاص بمزود، مثل google=1500 (قابل للتكرار)")
+    parser.add_argument("--error-rate", type=float, default=MOCK_CONFIG["error_rate"])
+    parser.add_argument("--rate-limit-rate", type=float, default=MOCK_CONFIG["rate_limit_rate"])
+    parser.add_argument("--retry-after", type=int, default=MOCK_CONFIG["retry_after"])
+    parser.add_argument("--reply-words", type=int, default=MOCK_CONFIG["reply_words"])
+    parser.add_argument("--chunk-words", type=int, default=MOCK_CONFIG["chunk_words"])
+    parser.add_argument("--chunk-delay", type=float, default=MOCK_CONFIG["chunk_delay"], help="ms")
+    args = parser.parse_args()
+
+    MOCK_CONFIG.update({
+        "latency_median": args.latency_median,
+        "latency_sigma": args.latency_sigma,
+        "error_rate": args.error_rate,
+        "rate_limit_rate": args.rate_limit_rate,
+        "retry_after": args.retry_after,
+        "reply_words": args.reply_words,
+        "chunk_words": args.chunk_words,
+        "chunk_delay": args.chunk_delay,
+        "provider_latency": parse_provider_latency(args.provider_latency)
+    })
+
+    print(f"🧪 خادم المزودين التجريبي يعمل على http://{args.host}:{args.port}")
+    mock_app.run(host=args.host, port=args.port, threaded=True, debug=False)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+إعادة توزيع بيانات المستخدمين بين ملفات الأقسام عند تغيير SHARD_COUNT.
+
+يعمل دون اتصال: أوقف التطبيق أولاً (طابور الكتابة المؤجلة يجب أن يكون فارغاً)،
+ثم شغّل السكربت من مجلد قاعدة البيانات، ثم أعد تشغيل التطبيق بالعدد الجديد.
+كل صف في الجداول المقسمة يُنسخ إلى قسمه الجديد (INSERT OR IGNORE حتى تبقى
+المشغلات وفهرس البحث متزامنة) ثم يُحذف من مصدره، دفعة بعد دفعة؛ لذلك يمكن
+إعادة التشغيل بأمان بعد أي انقطاع. العدد 1 يعني القاعدة المشتركة (clainai.db).
+
+التشغيل:
+    python rebalance_shards.py --from-count 1 --to-count 4 --dry-run
+    python rebalance_shards.py --from-count 1 --to-count 4
+"""
+import argparse
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+def database_paths(app, shard_count: int):
+    """مسار ملف كل قسم؛ بدون تقسيم القاعدة المشتركة هي القسم الوحيد"""
+    if shard_count == 1:
+        return [app.DB_PATH]
+    return [app.shard_path(index) for index in range(shard_count)]
+
+def open_pool(app, path: str, pools: dict):
+    """مجمع واحد لكل ملف - بنفس إعدادات التطبيق وترحيلاته"""
+    if path not in pools:
+        pools[path] = app.ConnectionPool(path, 1)
+        app.run_migrations(pools[path])
+    return pools[path]
+
+def rebalance_table(app, table: str, source: str, targets: list, to_count: int, pools: dict,
+                    batch_size: int, dry_run: bool):
+    """نقل صفوف جدول واحد من ملف المصدر إلى أقسامها الجديدة؛ يعيد {مسار الهدف: عدد الصفوف}"""
+    source_pool = open_pool(app, source, pools)
+    moved = {}
+    last_rowid = 0
+    with app.db_connection(source_pool) as conn:
+        columns = [row["name"] for row in conn.execute(f"PRAGMA table_info({table})")]
+    column_list = ", ".join(columns)
+    insert_sql = f"INSERT OR IGNORE INTO {table} ({column_list}) VALUES ({', '.join('?' * len(columns))})"
+
+    while True:
+        with app.db_connection(source_pool) as conn:
+            rows = conn.execute(
+                f"SELECT rowid AS _rowid, {column_list} FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                (last_rowid, batch_size)
+            ).fetchall()
+        if not rows:
+            return moved
+        last_rowid = rows[-1]["_rowid"]
+
+        by_target = {}
+        for row in rows:
+            target = targets[app.shard_for_user(row["user_id"], to_count)]
+            if target != source:
+                by_target.setdefault(target, []).append(row)
+
+        for target, target_rows in by_target.items():
+            moved[target] = moved.get(target, 0) + len(target_rows)
+            if dry_run:
+                continue
+            # النسخ يُثبت قبل الحذف: الانقطاع بينهما يترك نسخة مكررة تتجاهلها الإعادة
+            with app.db_connection(open_pool(app, target, pools)) as conn:
+                conn.executemany(insert_sql, [tuple(row[column] for column in columns) for row in target_rows])
+                conn.commit()
+            with app.db_connection(source_pool) as conn:
+                conn.executemany(f"DELETE FROM {table} WHERE rowid = ?", [(row["_rowid"],) for row in target_rows])
+                conn.commit()
+
+def main():
+    parser = argparse.ArgumentParser(description="Move per-user rows between SQLite shard files")
+    parser.add_argument("--from-count", type=int, required=True, help="عدد الأقسام الحالي")
+    parser.add_argument("--to-count", type=int, required=True, help="عدد الأقسام الجديد")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--dry-run", action="store_true", help="عرض عدد الصفوف التي ستُنقل دون تعديل")
+    args = parser.parse_args()
+
+    if args.from_count < 1 or args.to_count < 1:
+        parser.error("عدد الأقسام يجب أن يكون 1 أو أكثر")
+    if args.from_count == args.to_count:
+        print("لا شيء لنقله: العددان متساويان")
+        return 0
+
+    # التطبيق يقرأ SHARD_COUNT عند الاستيراد فيرحّل ملفات الأقسام الجديدة
+    os.environ["SHARD_COUNT"] = str(args.to_count)
+    os.environ.setdefault("RETENTION_ENABLED", "false")
+    sys.path.insert(0, ROOT)
+    import app
+
+    sources = [path for path in database_paths(app, args.from_count) if os.path.exists(path)]
+    targets = database_paths(app, args.to_count)
+    pools = {}
+    total = 0
+
+    for source in sources:
+        for table in app.SHARDED_TABLES:
+            moved = rebalance_table(app, table, source, targets, args.to_count, pools,
+                                    args.batch_size, args.dry_run)
+            for target, count in sorted(moved.items()):
+                total += count
+                print(f"{'🔎' if args.dry_run else '📦'} {table}: {count} صف {source} -> {target}")
+
+    if not args.dry_run:
+        # المساحة التي حررها الحذف من ملفات المصدر
+        for source in sources:
+            result = app.incremental_vacuum(pools[source]) if source in pools else {}
+            if result.get("reclaimed_bytes"):
+                print(f"🧹 {source}: استعادة {result['reclaimed_bytes']} بايت")
+
+    for pool in pools.values():
+        pool.close_all()
+    print(f"\n{total} rows {'would move' if args.dry_run else 'moved'} "
+          f"({args.from_count} -> {args.to_count} shards)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
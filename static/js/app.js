@@ -8,6 +8,11 @@ class ClainAIChat {
             typing: false,
             hasUploadedFile: false
         };
+        this.historyPageSize = 30;
+        this.historyCursor = null;
+        this.historyLoading = false;
+        this.historyScrollBound = false;
+        this.pageTitle = document.title;
         this.init();
     }
 
@@ -19,9 +24,33 @@ class ClainAIChat {
         await this.loadChatHistory();
         this.setupEventListeners();
         this.showWelcomeMessage();
+        this.subscribeAgentNotifications();
         console.log('✅ تم تهيئة ClainAI بنجاح!');
     }
 
+    // استقبال إشعارات الوكيل فور إرسالها (يعيد المتصفح الاتصال تلقائياً مع Last-Event-ID)
+    subscribeAgentNotifications() {
+        if (!window.EventSource || !this.currentSession.user || !this.currentSession.user.success) {
+            return;
+        }
+        const source = new EventSource('/api/agent/notifications/stream');
+        source.addEventListener('notification', (event) => {
+            const notification = JSON.parse(event.data);
+            this.showNotification(`🔔 ${notification.title}: ${notification.message}`, 'info');
+        });
+        source.addEventListener('unread', (event) => {
+            this.updateUnreadNotifications(JSON.parse(event.data).unread);
+        });
+        this.notificationSource = source;
+    }
+
+    // عدد الإشعارات غير المقروءة في شارة المستخدم وعنوان الصفحة
+    updateUnreadNotifications(unread) {
+        this.currentSession.unreadNotifications = unread;
+        this.updateUIUserInfo(this.currentSession.user);
+        document.title = unread ? `(${unread}) ${this.pageTitle}` : this.pageTitle;
+    }
+
     // فحص حالة السيرفر
     async checkServerStatus() {
         try {
@@ -83,7 +112,8 @@ class ClainAIChat {
     updateUIUserInfo(user) {
         const userBadge = document.getElementById('userBadge');
         if (userBadge) {
-            userBadge.innerHTML = `👤 ${user.name}`;
+            const unread = this.currentSession.unreadNotifications;
+            userBadge.innerHTML = unread ? `👤 ${user.name} · 🔔 ${unread}` : `👤 ${user.name}`;
         }
     }
 
@@ -264,37 +294,43 @@ class ClainAIChat {
         try {
             console.log('🔄 إرسال الرسالة:', message);
 
-            const response = await fetch('/api/chat', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({
-                    message: message,
-                    use_search: this.isGeneralSearchRequest(message)
-                })
-            });
+            const useSearch = this.isGeneralSearchRequest(message);
+            const streamed = await this.streamMessage(message, useSearch);
+
+            if (!streamed) {
+                // السيرفر أو المتصفح لا يدعم البث - استخدام الطلب العادي
+                const response = await fetch('/api/chat', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json',
+                    },
+                    body: JSON.stringify({
+                        message: message,
+                        use_search: useSearch
+                    })
+                });
+
+                if (!response.ok) {
+                    throw new Error(`خطأ في السيرفر: ${response.status}`);
+                }
 
-            if (!response.ok) {
-                throw new Error(`خطأ في السيرفر: ${response.status}`);
-            }
+                const data = await response.json();
+                console.log('✅ تم استلام الرد:', data);
 
-            const data = await response.json();
-            console.log('✅ تم استلام الرد:', data);
+                // إخفاء مؤشر الكتابة
+                this.hideTypingIndicator();
 
-            // إخفاء مؤشر الكتابة
-            this.hideTypingIndicator();
+                if (data.success) {
+                    // إضافة رد المساعد
+                    this.addMessageToUI('assistant', data.reply);
 
-            if (data.success) {
-                // إضافة رد المساعد
-                this.addMessageToUI('assistant', data.reply);
-
-                // إذا كان هناك معلومات عن النموذج المستخدم
-                if (data.thinking) {
-                    this.addMessageToUI('thinking', `🤔 ${data.thinking}`);
+                    // إذا كان هناك معلومات عن النموذج المستخدم
+                    if (data.thinking) {
+                        this.addMessageToUI('thinking', `🤔 ${data.thinking}`);
+                    }
+                } else {
+                    throw new Error(data.error || 'حدث خطأ غير معروف');
                 }
-            } else {
-                throw new Error(data.error || 'حدث خطأ غير معروف');
             }
 
         } catch (error) {
@@ -311,8 +347,103 @@ class ClainAIChat {
         }
     }
 
+    // بث الرد عبر Server-Sent Events وعرض الأجزاء فور وصولها
+    async streamMessage(message, useSearch) {
+        if (!window.ReadableStream || !window.TextDecoder) {
+            return false;
+        }
+
+        const response = await fetch('/api/chat/stream', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'Accept': 'text/event-stream'
+            },
+            body: JSON.stringify({
+                message: message,
+                use_search: useSearch
+            })
+        });
+
+        if (!response.ok || !response.body) {
+            if (response.status === 404 || response.status === 405) {
+                return false;
+            }
+            throw new Error(`خطأ في السيرفر: ${response.status}`);
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder('utf-8');
+        let buffer = '';
+        let reply = '';
+        let bubble = null;
+        let record = null;
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+
+            buffer += decoder.decode(value, { stream: true });
+            const events = buffer.split('\n\n');
+            buffer = events.pop();
+
+            for (const rawEvent of events) {
+                const { event, data } = this.parseSSEEvent(rawEvent);
+                if (!data) continue;
+
+                if (event === 'token') {
+                    if (!bubble) {
+                        // أول جزء: استبدال مؤشر الكتابة بفقاعة الرد
+                        this.hideTypingIndicator();
+                        const messageElement = this.addMessageToUI('assistant', '');
+                        bubble = messageElement.querySelector('.message-bubble');
+                        record = this.currentSession.messages[this.currentSession.messages.length - 1];
+                    }
+                    reply += data.text;
+                    bubble.innerHTML = this.formatContent(reply);
+                    record.content = reply;
+                    this.scrollToBottom();
+                } else if (event === 'meta') {
+                    console.log('🤖 النموذج المستخدم:', data.model_used);
+                } else if (event === 'error') {
+                    throw new Error(data.error || 'حدث خطأ غير معروف');
+                } else if (event === 'done') {
+                    console.log('✅ اكتمل بث الرد:', data);
+                }
+            }
+        }
+
+        this.hideTypingIndicator();
+        return true;
+    }
+
+    // تحليل حدث SSE واحد
+    parseSSEEvent(rawEvent) {
+        let event = 'message';
+        const dataLines = [];
+
+        rawEvent.split('\n').forEach(line => {
+            if (line.startsWith('event:')) {
+                event = line.slice(6).trim();
+            } else if (line.startsWith('data:')) {
+                dataLines.push(line.slice(5).trim());
+            }
+        });
+
+        if (dataLines.length === 0) {
+            return { event, data: null };
+        }
+
+        try {
+            return { event, data: JSON.parse(dataLines.join('\n')) };
+        } catch (error) {
+            console.warn('⚠️ حدث بث غير صالح:', rawEvent);
+            return { event, data: null };
+        }
+    }
+
     // إضافة رسالة للواجهة
-    addMessageToUI(role, content) {
+    addMessageToUI(role, content, options = {}) {
         const chatContainer = document.getElementById('chatContainer');
         if (!chatContainer) {
             console.error('❌ لم يتم العثور على حاوية المحادثة');
@@ -368,20 +499,32 @@ class ClainAIChat {
         }
 
         messageElement.innerHTML = bubbleContent;
-        chatContainer.appendChild(messageElement);
 
         // إضافة ميزة النسخ
         this.addCopyFeature(messageElement.querySelector('.message-bubble'));
 
+        const entry = {
+            role,
+            content,
+            timestamp: new Date()
+        };
+
+        if (options.before !== undefined) {
+            // رسائل أقدم من السجل - تُدرج فوق الموجود دون تمرير؛
+            // المستدعي يضيف الصفحة كاملة إلى currentSession.messages بترتيبها
+            chatContainer.insertBefore(messageElement, options.before);
+            return messageElement;
+        }
+
+        chatContainer.appendChild(messageElement);
+
         // التمرير للأسفل
         this.scrollToBottom();
 
         // حفظ في السجل
-        this.currentSession.messages.push({
-            role,
-            content,
-            timestamp: new Date()
-        });
+        this.currentSession.messages.push(entry);
+
+        return messageElement;
     }
 
     // تنسيق المحتوى
@@ -473,26 +616,77 @@ class ClainAIChat {
     // تحميل سجل المحادثة
     async loadChatHistory() {
         try {
-            const response = await fetch('/api/history');
+            // أحدث صفحة فقط؛ الصفحات الأقدم تُحمل عند التمرير للأعلى
+            const response = await fetch(`/api/history?limit=${this.historyPageSize}`);
             if (response.ok) {
                 const history = await response.json();
                 const chatContainer = document.getElementById('chatContainer');
 
                 if (chatContainer && history.messages && history.messages.length > 0) {
                     // احتفظ بالرسالة الترحيبية فقط إذا لم توجد محادثات سابقة
-                    const welcomeMessage = chatContainer.innerHTML;
                     chatContainer.innerHTML = '';
 
                     history.messages.forEach(msg => {
                         this.addMessageToUI(msg.role, msg.content);
                     });
                 }
+
+                this.historyCursor = history.has_more ? history.next_cursor : null;
+                this.setupHistoryScroll();
             }
         } catch (error) {
             console.log('📝 لا يوجد سجل محادثات سابق');
         }
     }
 
+    // تحميل الصفحات الأقدم عند الاقتراب من أعلى المحادثة
+    setupHistoryScroll() {
+        const chatContainer = document.getElementById('chatContainer');
+        if (!chatContainer || this.historyScrollBound) return;
+        this.historyScrollBound = true;
+
+        chatContainer.addEventListener('scroll', () => {
+            if (chatContainer.scrollTop < 80) {
+                this.loadOlderHistory();
+            }
+        });
+    }
+
+    async loadOlderHistory() {
+        if (!this.historyCursor || this.historyLoading) return;
+        this.historyLoading = true;
+
+        try {
+            const cursor = encodeURIComponent(this.historyCursor);
+            const response = await fetch(`/api/history?limit=${this.historyPageSize}&before=${cursor}`);
+            if (!response.ok) return;
+
+            const history = await response.json();
+            const chatContainer = document.getElementById('chatContainer');
+            if (chatContainer && history.messages && history.messages.length > 0) {
+                // الإدراج في الأعلى مع الحفاظ على موضع القراءة الحالي
+                const previousHeight = chatContainer.scrollHeight;
+                const firstMessage = chatContainer.firstChild;
+                history.messages.forEach(msg => {
+                    this.addMessageToUI(msg.role, msg.content, { before: firstMessage });
+                });
+                // unshift واحد للصفحة كلها يحافظ على الترتيب الزمني
+                this.currentSession.messages.unshift(...history.messages.map(msg => ({
+                    role: msg.role,
+                    content: msg.content,
+                    timestamp: new Date()
+                })));
+                chatContainer.scrollTop += chatContainer.scrollHeight - previousHeight;
+            }
+
+            this.historyCursor = history.has_more ? history.next_cursor : null;
+        } catch (error) {
+            console.error('❌ خطأ في تحميل الرسائل الأقدم:', error);
+        } finally {
+            this.historyLoading = false;
+        }
+    }
+
     // عرض رسالة ترحيب
     showWelcomeMessage() {
         const chatContainer = document.getElementById('chatContainer');
@@ -531,6 +725,7 @@ class ClainAIChat {
                 if (chatContainer) {
                     chatContainer.innerHTML = '';
                     this.currentSession.messages = [];
+                    this.historyCursor = null;
                     this.currentSession.hasUploadedFile = false;
                     this.showWelcomeMessage();
                 }
@@ -1,5 +1,5 @@
 // Service Worker for ClainAI
-const CACHE_NAME = 'clainai-v2';
+const CACHE_NAME = 'clainai-v7';
 const urlsToCache = [
   '/',
   '/static/css/style.css',
@@ -17,6 +17,18 @@ self.addEventListener('install', function(event) {
   );
 });
 
+self.addEventListener('activate', function(event) {
+  // حذف النسخ القديمة من الكاش حتى يصل app.js المحدث للمستخدمين
+  event.waitUntil(
+    caches.keys().then(function(names) {
+      return Promise.all(
+        names.filter(function(name) { return name !== CACHE_NAME; })
+          .map(function(name) { return caches.delete(name); })
+      );
+    })
+  );
+});
+
 self.addEventListener('fetch', function(event) {
   event.respondWith(
     caches.match(event.request)